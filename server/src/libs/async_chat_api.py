@@ -0,0 +1,36 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+from libs.openai_chat_api import OpenAIChatAPI
+
+
+class AsyncChatAPI:
+    """OpenAIChatAPI 的异步外观，所有同步调用都在专用线程池中执行，避免阻塞事件循环
+
+    用法与 OpenAIChatAPI 相同，只是每个方法都需要 await：
+        config = await Utils.async_api.get_session_ai_config(session_id)
+    """
+
+    def __init__(self, api: OpenAIChatAPI, executor: Optional[ThreadPoolExecutor]):
+        self.api = api
+        self.executor = executor
+
+    async def run(self, func: Callable, *args: Any, **kwargs: Any) -> Any:
+        """在线程池中执行同步函数并等待结果"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs)
+        )
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.api, name)
+        if not callable(attr) or asyncio.iscoroutinefunction(attr):
+            return attr
+
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            return await self.run(attr, *args, **kwargs)
+
+        wrapper.__name__ = name
+        wrapper.__doc__ = attr.__doc__
+        return wrapper
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Set
+from libs.log_config import logger
+
+
+class AudioCache:
+    """按内容寻址的语音缓存，所有会话共享
+
+    键为 (文本, 音色, 语速, 音频格式) 的哈希，相同内容只合成一次；
+    index.db 记录每个文件的大小和最近使用时间，总大小超过 max_bytes 时
+    按最近最少使用（LRU）淘汰。正在被 hold 的文件不会被淘汰，remove 时推迟到释放后删除。
+    线程安全。
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._held: Counter = Counter()
+        # 被 remove 但仍被持有的键，释放后删除；期间 lookup 视为未命中
+        self._removing: Set[str] = set()
+        self._conn = sqlite3.connect(
+            os.path.join(root, "index.db"), check_same_thread=False
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_entries_last_used ON entries (last_used)"
+        )
+        self._conn.commit()
+        self._reconcile()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(text: str, voice_name: str, speech_rate: float, fmt: str) -> str:
+        payload = json.dumps([text, voice_name, float(speech_rate), fmt])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        """缓存文件路径，按哈希前两位分目录"""
+        return os.path.join(self.root, key[:2], f"{key}.wav")
+
+    def temp_path(self, key: str) -> str:
+        """合成时写入的临时文件路径，完成后通过 commit 放入缓存"""
+        os.makedirs(os.path.join(self.root, key[:2]), exist_ok=True)
+        return f"{self.path(key)}.{threading.get_ident()}.part"
+
+    @contextmanager
+    def hold(self, key: str) -> Iterator[None]:
+        """持有期间该键的文件不会被淘汰，用于查找到读取完文件之间"""
+        with self._lock:
+            self._held[key] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._held[key] -= 1
+                if self._held[key] <= 0:
+                    del self._held[key]
+                    if key in self._removing:
+                        self._removing.discard(key)
+                        self._delete(key)
+                        self._conn.commit()
+
+    def lookup(self, key: str) -> Optional[str]:
+        """命中时返回文件路径并更新最近使用时间"""
+        path = self.path(key)
+        with self._lock:
+            if key in self._removing or not os.path.isfile(path):
+                self.misses += 1
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self.hits += 1
+            cursor = self._conn.execute(
+                "UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            if cursor.rowcount == 0:
+                # 文件已放入缓存但索引项未写入（如写入前进程退出），补上索引
+                self._index(key, path)
+                self._evict(protect=key)
+            self._conn.commit()
+            return path
+
+    def commit(self, key: str, temp_path: str) -> str:
+        """把合成完成的临时文件放入缓存，必要时淘汰旧文件"""
+        path = self.path(key)
+        os.replace(temp_path, path)
+        with self._lock:
+            # 重新合成的文件取代了待删除的旧文件
+            self._removing.discard(key)
+            self._index(key, path)
+            self._evict(protect=key)
+            self._conn.commit()
+        return path
+
+    def remove(self, key: str) -> None:
+        """删除缓存项；正被其他线程读取时推迟到释放后删除"""
+        with self._lock:
+            if key in self._held:
+                self._removing.add(key)
+                return
+            self._delete(key)
+            self._conn.commit()
+
+    def _delete(self, key: str) -> None:
+        self._remove_file(self.path(key))
+        self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def _index(self, key: str, path: str) -> None:
+        self._conn.execute(
+            """
+            INSERT OR REPLACE INTO entries (key, size, last_used) 
+            VALUES (?, ?, ?)
+            """,
+            (key, os.path.getsize(path), time.time()),
+        )
+
+    def _evict(self, protect: Optional[str] = None) -> None:
+        total = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT key, size FROM entries ORDER BY last_used"
+        ).fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            if key == protect or key in self._held:
+                continue
+            self._delete(key)
+            total -= size
+            logger.info(f"淘汰语音缓存 {key}")
+
+    def _reconcile(self) -> None:
+        """启动时去掉文件已不存在的索引项，补上没有索引的文件，并清理未完成的临时文件"""
+        with self._lock:
+            keys = {row[0] for row in self._conn.execute("SELECT key FROM entries")}
+            missing = [(key,) for key in keys if not os.path.isfile(self.path(key))]
+            self._conn.executemany("DELETE FROM entries WHERE key = ?", missing)
+            for directory, _, names in os.walk(self.root):
+                for name in names:
+                    path = os.path.join(directory, name)
+                    if name.endswith(".part"):
+                        self._remove_file(path)
+                    elif name.endswith(".wav") and name[:-4] not in keys:
+                        self._index(name[:-4], path)
+            self._evict()
+            self._conn.commit()
+
+    @staticmethod
+    def _remove_file(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+        return {
+            "entries": count,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
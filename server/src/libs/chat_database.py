@@ -1,31 +1,146 @@
 import sqlite3
 import json
-from typing import Optional, List, Dict, Any, Tuple
+import queue
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, List, Dict, Any, Tuple, Iterator
 from datetime import datetime
 from libs.log_config import logger
 
 
+class ConnectionPool:
+    """SQLite连接池：WAL模式下单个串行写连接 + 多个并发读连接"""
+
+    # 连接级别的性能参数
+    PRAGMAS = (
+        "PRAGMA foreign_keys = ON",
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA temp_store = MEMORY",
+        "PRAGMA cache_size = -16000",
+        "PRAGMA mmap_size = 134217728",
+        "PRAGMA busy_timeout = 5000",
+    )
+    # 每累计多少次写入或间隔多少秒执行一次被动checkpoint
+    CHECKPOINT_WRITES = 200
+    CHECKPOINT_INTERVAL = 60.0
+
+    def __init__(self, db_path: str, max_readers: int = 4, timeout: float = 10.0):
+        self.db_path = db_path
+        self.max_readers = max_readers
+        self.timeout = timeout
+        self._write_lock = threading.RLock()
+        self._writer = self._connect()
+        self._enable_wal(self._writer)
+        self._readers: queue.LifoQueue = queue.LifoQueue()
+        self._reader_count = 0
+        self._reader_count_lock = threading.Lock()
+        self._all_readers: List[sqlite3.Connection] = []
+        self._writes_since_checkpoint = 0
+        self._last_checkpoint = time.monotonic()
+        self._closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        """创建一个已配置好参数的连接"""
+        conn = sqlite3.connect(
+            self.db_path, timeout=self.timeout, check_same_thread=False
+        )
+        conn.row_factory = sqlite3.Row  # 使用字典形式返回结果
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        # 验证外键约束是否启用
+        if conn.execute("PRAGMA foreign_keys").fetchone()[0] != 1:
+            raise RuntimeError("无法启用外键约束")
+        return conn
+
+    def _enable_wal(self, conn: sqlite3.Connection) -> None:
+        """切换为WAL日志模式"""
+        mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        if str(mode).lower() != "wal":
+            logger.warning(f"无法启用WAL模式，当前日志模式: {mode}")
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """获取写连接，写操作串行执行并在退出时提交事务"""
+        with self._write_lock:
+            with self._writer:
+                yield self._writer
+            self._writes_since_checkpoint += 1
+            self._maybe_checkpoint()
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """从连接池借出一个读连接"""
+        conn = self._acquire_reader()
+        try:
+            yield conn
+        finally:
+            # 结束可能残留的读事务，避免阻止checkpoint
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+
+    def _acquire_reader(self) -> sqlite3.Connection:
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._reader_count_lock:
+            if self._reader_count < self.max_readers:
+                self._reader_count += 1
+                conn = self._connect()
+                self._all_readers.append(conn)
+                return conn
+        try:
+            return self._readers.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RuntimeError("获取数据库读连接超时")
+
+    def _maybe_checkpoint(self) -> None:
+        """定期将WAL内容回写到主数据库，防止WAL文件无限增长"""
+        now = time.monotonic()
+        if (
+            self._writes_since_checkpoint < self.CHECKPOINT_WRITES
+            and now - self._last_checkpoint < self.CHECKPOINT_INTERVAL
+        ):
+            return
+        self.checkpoint("PASSIVE")
+
+    def checkpoint(self, mode: str = "PASSIVE") -> None:
+        """执行WAL checkpoint"""
+        with self._write_lock:
+            try:
+                self._writer.execute(f"PRAGMA wal_checkpoint({mode})")
+            except sqlite3.Error as e:
+                logger.warning(f"WAL checkpoint失败: {e}")
+            self._writes_since_checkpoint = 0
+            self._last_checkpoint = time.monotonic()
+
+    def close(self) -> None:
+        """关闭所有连接"""
+        if self._closed:
+            return
+        self._closed = True
+        self.checkpoint("TRUNCATE")
+        for conn in self._all_readers:
+            conn.close()
+        self._all_readers.clear()
+        self._writer.close()
+
+
 class ChatDatabase:
-    def __init__(self, db_path: str):
-        self.conn = sqlite3.connect(db_path)
-        self.conn.row_factory = sqlite3.Row  # 使用字典形式返回结果
-        self._setup_foreign_keys()
+    def __init__(self, db_path: str, max_readers: int = 4):
+        self.pool = ConnectionPool(db_path, max_readers=max_readers)
+        self._seq_lock = threading.Lock()
         self._create_tables()
-
-    def _setup_foreign_keys(self) -> None:
-        """确保外键约束启用"""
-        with self.conn:
-            self.conn.execute("PRAGMA foreign_keys = ON")
-            # 验证约束是否启用
-            cursor = self.conn.cursor()
-            cursor.execute("PRAGMA foreign_keys")
-            if cursor.fetchone()[0] != 1:
-                raise RuntimeError("无法启用外键约束")
+        self._migrate()
+        self._last_seq = self._load_last_seq()
 
     def _create_tables(self) -> None:
         """创建会话和消息表"""
-        with self.conn:
-            cursor = self.conn.cursor()
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
             # 创建会话表
             cursor.execute(
                 """
@@ -56,26 +171,355 @@ class ChatDatabase:
                 "CREATE INDEX IF NOT EXISTS idx_messages_session_time ON messages (session_id, timestamp);"
             )
 
+    def _migrate(self) -> None:
+        """按 PRAGMA user_version 依次执行尚未应用的数据库迁移"""
+        migrations = [
+            self._migrate_message_seq,
+            self._migrate_messages_fts,
+            self._migrate_session_summary,
+            self._migrate_session_revisions,
+            self._migrate_session_fork,
+            self._migrate_message_tokens,
+            self._migrate_conversation_summaries,
+            self._migrate_generation_metrics,
+            self._migrate_fork_message_counts,
+        ]
+        with self.pool.writer() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for target_version, migration in enumerate(migrations, start=1):
+            if version >= target_version:
+                continue
+            logger.info(f"数据库迁移到版本 {target_version}: {migration.__name__}")
+            with self.pool.writer() as conn:
+                # DDL 不会自动开启事务，显式开启，使迁移的每条语句和版本号一起提交，
+                # 中途失败时整体回滚；迁移中不能使用会先提交事务的 executescript
+                conn.execute("BEGIN")
+                migration(conn)
+                conn.execute(f"PRAGMA user_version = {target_version}")
+
+    def _migrate_message_seq(self, conn: sqlite3.Connection) -> None:
+        """v1: 为消息添加整数排序键 seq（微秒级epoch，单调递增）并回填"""
+        columns = [row["name"] for row in conn.execute("PRAGMA table_info(messages)")]
+        if "seq" not in columns:
+            conn.execute("ALTER TABLE messages ADD COLUMN seq INTEGER")
+        # timestamp为本地时间，转换为UTC epoch；同一秒内的消息按id排序
+        conn.execute(
+            """
+            UPDATE messages SET seq = 
+                CAST(strftime('%s', timestamp, 'utc') AS INTEGER) * 1000000 + (
+                    SELECT COUNT(*) FROM messages AS m 
+                    WHERE m.session_id = messages.session_id 
+                    AND m.timestamp = messages.timestamp 
+                    AND m.id < messages.id
+                )
+            WHERE seq IS NULL
+            """
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_session_seq ON messages (session_id, seq)"
+        )
+
+    def _migrate_messages_fts(self, conn: sqlite3.Connection) -> None:
+        """v2: 建立消息全文索引 messages_fts，并用触发器与 messages 表保持同步"""
+        # trigram 分词支持中文子串检索，旧版本SQLite不支持时退回 unicode61
+        try:
+            conn.execute(
+                """
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    raw_text, content='messages', content_rowid='id', 
+                    tokenize='trigram'
+                )
+                """
+            )
+        except sqlite3.OperationalError as e:
+            logger.warning(f"FTS5 trigram 分词不可用，使用 unicode61: {e}")
+            conn.execute(
+                """
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    raw_text, content='messages', content_rowid='id'
+                )
+                """
+            )
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS messages_fts_insert 
+            AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, raw_text) 
+                VALUES (new.id, new.raw_text);
+            END
+            """
+        )
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS messages_fts_delete 
+            AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, raw_text) 
+                VALUES ('delete', old.id, old.raw_text);
+            END
+            """
+        )
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS messages_fts_update 
+            AFTER UPDATE OF raw_text ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, raw_text) 
+                VALUES ('delete', old.id, old.raw_text);
+                INSERT INTO messages_fts (rowid, raw_text) 
+                VALUES (new.id, new.raw_text);
+            END
+            """
+        )
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+    def _migrate_session_summary(self, conn: sqlite3.Connection) -> None:
+        """v3: 会话列表摘要表 session_summary，由触发器维护"""
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS session_summary (
+                id INTEGER PRIMARY KEY,
+                title TEXT,
+                top INTEGER NOT NULL DEFAULT 0,
+                last_active_time REAL NOT NULL DEFAULT 0,
+                ai_avatar_url TEXT NOT NULL DEFAULT '',
+                message_count INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_session_summary_order 
+                ON session_summary (top DESC, last_active_time DESC)
+            """
+        )
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS session_summary_insert 
+            AFTER INSERT ON sessions BEGIN
+                INSERT INTO session_summary 
+                    (id, title, top, last_active_time, ai_avatar_url) 
+                VALUES (
+                    new.id, new.title, 
+                    COALESCE(json_extract(new.ai_config, '$.top'), 0), 
+                    COALESCE(json_extract(new.ai_config, '$.last_active_time'), 0), 
+                    COALESCE(json_extract(new.ai_config, '$.ai_avatar_url'), '')
+                );
+            END
+            """
+        )
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS session_summary_update 
+            AFTER UPDATE OF title, ai_config ON sessions BEGIN
+                UPDATE session_summary SET 
+                    title = new.title, 
+                    top = COALESCE(json_extract(new.ai_config, '$.top'), 0), 
+                    last_active_time = 
+                        COALESCE(json_extract(new.ai_config, '$.last_active_time'), 0), 
+                    ai_avatar_url = 
+                        COALESCE(json_extract(new.ai_config, '$.ai_avatar_url'), '') 
+                WHERE id = new.id;
+            END
+            """
+        )
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS session_summary_delete 
+            AFTER DELETE ON sessions BEGIN
+                DELETE FROM session_summary WHERE id = old.id;
+            END
+            """
+        )
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS session_summary_message_insert 
+            AFTER INSERT ON messages BEGIN
+                UPDATE session_summary SET message_count = message_count + 1 
+                WHERE id = new.session_id;
+            END
+            """
+        )
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS session_summary_message_delete 
+            AFTER DELETE ON messages BEGIN
+                UPDATE session_summary SET message_count = message_count - 1 
+                WHERE id = old.session_id;
+            END
+            """
+        )
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO session_summary 
+                (id, title, top, last_active_time, ai_avatar_url, message_count) 
+            SELECT s.id, s.title, 
+                COALESCE(json_extract(s.ai_config, '$.top'), 0), 
+                COALESCE(json_extract(s.ai_config, '$.last_active_time'), 0), 
+                COALESCE(json_extract(s.ai_config, '$.ai_avatar_url'), ''), 
+                (SELECT COUNT(*) FROM messages AS m WHERE m.session_id = s.id) 
+            FROM sessions AS s
+            """
+        )
+
+    def _migrate_session_revisions(self, conn: sqlite3.Connection) -> None:
+        """v4: 会话列表版本日志，每个会话只保留最新一次变更（删除的会话保留墓碑）"""
+        next_revision = (
+            "(SELECT COALESCE(MAX(revision), 0) + 1 FROM session_revisions)"
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS session_revisions (
+                session_id INTEGER PRIMARY KEY,
+                revision INTEGER NOT NULL,
+                removed INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_session_revisions_revision 
+                ON session_revisions (revision)
+            """
+        )
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS session_revisions_insert 
+            AFTER INSERT ON session_summary BEGIN
+                INSERT OR REPLACE INTO session_revisions 
+                VALUES (new.id, {next_revision}, 0);
+            END
+            """
+        )
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS session_revisions_update 
+            AFTER UPDATE ON session_summary BEGIN
+                INSERT OR REPLACE INTO session_revisions 
+                VALUES (new.id, {next_revision}, 0);
+            END
+            """
+        )
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS session_revisions_delete 
+            AFTER DELETE ON session_summary BEGIN
+                INSERT OR REPLACE INTO session_revisions 
+                VALUES (old.id, {next_revision}, 1);
+            END
+            """
+        )
+        conn.execute(
+            """
+            INSERT OR IGNORE INTO session_revisions (session_id, revision, removed) 
+            SELECT id, ROW_NUMBER() OVER (ORDER BY id), 0 FROM session_summary
+            """
+        )
+
+    def _migrate_session_fork(self, conn: sqlite3.Connection) -> None:
+        """v5: 会话分叉，子会话引用父会话 fork_seq 之前（含）的消息，只存储新增消息"""
+        columns = [row["name"] for row in conn.execute("PRAGMA table_info(sessions)")]
+        if "parent_id" not in columns:
+            conn.execute("ALTER TABLE sessions ADD COLUMN parent_id INTEGER")
+        if "fork_seq" not in columns:
+            conn.execute("ALTER TABLE sessions ADD COLUMN fork_seq INTEGER")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_sessions_parent ON sessions (parent_id)"
+        )
+
+    def _migrate_message_tokens(self, conn: sqlite3.Connection) -> None:
+        """v6: 缓存每条消息的token数及所用分词器，NULL表示尚未统计，构建提示时补算"""
+        columns = [row["name"] for row in conn.execute("PRAGMA table_info(messages)")]
+        if "token_count" not in columns:
+            conn.execute("ALTER TABLE messages ADD COLUMN token_count INTEGER")
+        if "token_family" not in columns:
+            conn.execute("ALTER TABLE messages ADD COLUMN token_family TEXT")
+
+    def _migrate_conversation_summaries(self, conn: sqlite3.Connection) -> None:
+        """v7: 每个会话的滚动摘要，概括 seq 不大于 covered_seq 的历史消息"""
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS conversation_summaries (
+                session_id INTEGER PRIMARY KEY,
+                summary TEXT NOT NULL,
+                covered_seq INTEGER NOT NULL,
+                token_count INTEGER,
+                token_family TEXT,
+                updated_at TEXT,
+                FOREIGN KEY (session_id) REFERENCES sessions (id) ON DELETE CASCADE
+            )
+            """
+        )
+
+    def _migrate_generation_metrics(self, conn: sqlite3.Connection) -> None:
+        """v8: 每条助手消息的生成指标（首字延迟、耗时、分块数、token用量、服务商）"""
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS generation_metrics (
+                message_id INTEGER PRIMARY KEY,
+                provider TEXT,
+                model TEXT,
+                created_at REAL NOT NULL,
+                ttft_ms REAL,
+                duration_ms REAL NOT NULL,
+                chunk_count INTEGER NOT NULL,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                usage_reported INTEGER NOT NULL DEFAULT 0,
+                cancelled INTEGER NOT NULL DEFAULT 0,
+                FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_generation_metrics_created 
+            ON generation_metrics (created_at)
+            """
+        )
+
+    def _migrate_fork_message_counts(self, conn: sqlite3.Connection) -> None:
+        """v9: 分叉会话的消息数包含继承的消息，重新统计已有的分叉会话"""
+        rows = conn.execute(
+            "SELECT id FROM sessions WHERE parent_id IS NOT NULL"
+        ).fetchall()
+        for row in rows:
+            self._refresh_message_count(conn, row["id"])
+
+    def _load_last_seq(self) -> int:
+        with self.pool.reader() as conn:
+            row = conn.execute("SELECT MAX(seq) FROM messages").fetchone()
+            return row[0] or 0
+
+    def _next_seq(self) -> int:
+        """生成下一个消息排序键：当前微秒时间戳，且严格大于已分配的值"""
+        with self._seq_lock:
+            self._last_seq = max(time.time_ns() // 1000, self._last_seq + 1)
+            return self._last_seq
+
     def create_session(self, title: str, ai_config: dict) -> Optional[int]:
         """创建新会话并返回会话ID"""
         create_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with self.conn:
-            cursor = self.conn.cursor()
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO sessions (title, create_time, ai_config) VALUES (?, ?, ?)",
                 (title, create_time, json.dumps(ai_config, ensure_ascii=False)),
             )
             return cursor.lastrowid
 
-    def delete_session_and_messages(self, session_id: int) -> None:
-        """删除会话及其所有消息"""
-        with self.conn:
-            self.conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+    def delete_session_and_messages(self, session_id: int) -> List[int]:
+        """删除会话及其所有消息
+
+        仍被分叉会话引用的消息会先复制到子会话中，返回因此被实体化的会话ID
+        """
+        with self.pool.writer() as conn:
+            materialized = self._materialize_children(conn, session_id)
+            conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            return materialized
 
     def copy_session(self, session_id: int) -> Optional[int]:
         """复制会话基本信息，不包含消息"""
-        with self.conn:
-            cursor = self.conn.cursor()
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
             # 获取源会话信息
             cursor.execute(
                 "SELECT title, ai_config FROM sessions WHERE id = ?", (session_id,)
@@ -98,48 +542,210 @@ class ChatDatabase:
         self, src_session_id: int, dst_session_id: int
     ) -> None:
         """复制源会话的系统消息到目标会话"""
-        with self.conn:
-            self.conn.execute(
+        with self.pool.writer() as conn:
+            rows = self._select_session_messages(
+                conn,
+                src_session_id,
+                "role, raw_text, parsed_text, timestamp, seq, "
+                "token_count, token_family",
+                "role = 'system'",
+            )
+            conn.executemany(
                 """
-                INSERT INTO messages (session_id, role, raw_text, parsed_text, timestamp) 
-                SELECT ?, role, raw_text, parsed_text, timestamp 
-                FROM messages 
-                WHERE session_id = ? AND role = 'system'
+                INSERT INTO messages 
+                    (session_id, role, raw_text, parsed_text, timestamp, seq, 
+                     token_count, token_family) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
                 """,
-                (dst_session_id, src_session_id),
+                [(dst_session_id, *tuple(row)) for row in rows],
             )
 
-    def copy_session_and_messages(self, session_id: int) -> Optional[int]:
-        """复制会话及其所有消息"""
-        new_session_id = self.copy_session(session_id)
-        if new_session_id is None:
-            return None
+    def fork_session(self, session_id: int) -> Optional[int]:
+        """分叉会话：新会话引用源会话当前可见的全部消息，不复制消息行"""
+        with self.pool.writer() as conn:
+            row = conn.execute(
+                "SELECT title, ai_config FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+            if not row:
+                return None
+
+            create_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            # 源会话当前可见消息的seq都不大于已分配的最大seq，之后新增的消息都大于它
+            fork_seq = self._last_seq
+            cursor = conn.execute(
+                """
+                INSERT INTO sessions 
+                    (title, create_time, ai_config, parent_id, fork_seq) 
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (row["title"], create_time, row["ai_config"], session_id, fork_seq),
+            )
+            self._refresh_message_count(conn, cursor.lastrowid)
+            return cursor.lastrowid
+
+    def _materialize_session(self, conn: sqlite3.Connection, session_id: int) -> None:
+        """把会话从祖先继承的消息复制为自己的消息，并断开继承关系
 
-        with self.conn:
-            self.conn.execute(
+        会话没有自己的滚动摘要时，沿用的祖先摘要一并复制；
+        生成指标仍只属于原消息，复制会在指标统计中重复计数。
+        """
+        lineage = self._get_lineage(conn, session_id)
+        for member_id, max_seq in lineage[1:]:
+            conn.execute(
+                """
+                INSERT OR IGNORE INTO conversation_summaries 
+                    (session_id, summary, covered_seq, token_count, token_family, 
+                     updated_at) 
+                SELECT ?, summary, covered_seq, token_count, token_family, updated_at 
+                FROM conversation_summaries 
+                WHERE session_id = ? AND covered_seq <= ?
+                """,
+                (session_id, member_id, max_seq),
+            )
+        for member_id, max_seq in lineage[1:]:
+            conn.execute(
                 """
-                INSERT INTO messages (session_id, role, raw_text, parsed_text, timestamp) 
-                SELECT ?, role, raw_text, parsed_text, timestamp 
+                INSERT INTO messages 
+                    (session_id, role, raw_text, parsed_text, timestamp, seq, 
+                     token_count, token_family) 
+                SELECT ?, role, raw_text, parsed_text, timestamp, seq, 
+                    token_count, token_family 
                 FROM messages 
-                WHERE session_id = ?
+                WHERE session_id = ? AND seq <= ?
                 """,
-                (new_session_id, session_id),
+                (session_id, member_id, max_seq),
+            )
+        conn.execute(
+            "UPDATE sessions SET parent_id = NULL, fork_seq = NULL WHERE id = ?",
+            (session_id,),
+        )
+        # 复制的消息由触发器重复计数，按实际拥有的消息重新统计
+        self._refresh_message_count(conn, session_id)
+
+    def _refresh_message_count(self, conn: sqlite3.Connection, session_id: int) -> None:
+        """重新统计会话列表中显示的消息数，包含从祖先会话继承的消息"""
+        count = 0
+        for member_id, max_seq in self._get_lineage(conn, session_id):
+            query = "SELECT COUNT(*) FROM messages WHERE session_id = ?"
+            params: List[Any] = [member_id]
+            if max_seq is not None:
+                query += " AND seq <= ?"
+                params.append(max_seq)
+            count += conn.execute(query, params).fetchone()[0]
+        conn.execute(
+            "UPDATE session_summary SET message_count = ? WHERE id = ?",
+            (count, session_id),
+        )
+
+    def _materialize_children(
+        self, conn: sqlite3.Connection, session_id: int, seq: Optional[int] = None
+    ) -> List[int]:
+        """实体化继承了该会话消息的直接子会话（指定seq时只处理可见该消息的子会话）
+
+        孙会话通过子会话继承，子会话实体化后持有相同seq的副本，无需处理。
+        """
+        query = "SELECT id FROM sessions WHERE parent_id = ?"
+        params: List[Any] = [session_id]
+        if seq is not None:
+            query += " AND fork_seq >= ?"
+            params.append(seq)
+        children = [row["id"] for row in conn.execute(query, params).fetchall()]
+        for child_id in children:
+            self._materialize_session(conn, child_id)
+        return children
+
+    def _prepare_message_write(
+        self, conn: sqlite3.Connection, session_id: int, message_id: int
+    ) -> Tuple[Optional[int], List[int]]:
+        """写时复制：修改会话中的某条消息前，保证修改不会影响其他会话
+
+        若消息继承自祖先会话，先实体化当前会话并定位到自己的副本；
+        若消息被子会话继承，先实体化这些子会话。
+        返回 (实际要修改的消息ID, 被实体化的会话ID列表)。
+        """
+        row = conn.execute(
+            "SELECT session_id, seq FROM messages WHERE id = ?", (message_id,)
+        ).fetchone()
+        if row is None:
+            return None, []
+
+        materialized = []
+        if row["session_id"] != session_id:
+            self._materialize_session(conn, session_id)
+            materialized.append(session_id)
+            own = conn.execute(
+                "SELECT id FROM messages WHERE session_id = ? AND seq = ?",
+                (session_id, row["seq"]),
+            ).fetchone()
+            if own is None:
+                return None, materialized
+            message_id = own["id"]
+
+        materialized.extend(self._materialize_children(conn, session_id, row["seq"]))
+        return message_id, materialized
+
+    def edit_message(
+        self,
+        session_id: int,
+        message_id: int,
+        raw_text: str,
+        parsed_text: str,
+    ) -> Tuple[Optional[int], List[int]]:
+        """用户编辑会话中的消息（写时复制），返回实际修改的消息ID和被实体化的会话ID"""
+        with self.pool.writer() as conn:
+            message_id, materialized = self._prepare_message_write(
+                conn, session_id, message_id
             )
-        return new_session_id
+            if message_id is not None:
+                self._invalidate_conversation_summary(conn, session_id, message_id)
+                conn.execute(
+                    """
+                    UPDATE messages 
+                    SET raw_text = ?, parsed_text = ?, token_count = NULL 
+                    WHERE id = ?
+                    """,
+                    (raw_text, parsed_text, message_id),
+                )
+            return message_id, materialized
+
+    def remove_message(self, session_id: int, message_id: int) -> List[int]:
+        """用户删除会话中的消息（写时复制），返回被实体化的会话ID"""
+        with self.pool.writer() as conn:
+            message_id, materialized = self._prepare_message_write(
+                conn, session_id, message_id
+            )
+            if message_id is not None:
+                self._invalidate_conversation_summary(conn, session_id, message_id)
+                conn.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+            return materialized
+
+    def _invalidate_conversation_summary(
+        self, conn: sqlite3.Connection, session_id: int, message_id: int
+    ) -> None:
+        """修改已被摘要概括的消息后，摘要失效，下次需要时重新生成"""
+        conn.execute(
+            """
+            DELETE FROM conversation_summaries 
+            WHERE session_id = ? 
+                AND covered_seq >= (SELECT seq FROM messages WHERE id = ?)
+            """,
+            (session_id, message_id),
+        )
 
     def update_session_title(self, session_id: int, title: str) -> None:
         """更新会话标题"""
-        with self.conn:
-            self.conn.execute(
+        with self.pool.writer() as conn:
+            conn.execute(
                 "UPDATE sessions SET title = ? WHERE id = ?", (title, session_id)
             )
 
     def get_session_title(self, session_id: int) -> Optional[str]:
         """获取会话标题"""
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT title FROM sessions WHERE id = ?", (session_id,))
-        row = cursor.fetchone()
-        return row["title"] if row else None
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT title FROM sessions WHERE id = ?", (session_id,))
+            row = cursor.fetchone()
+            return row["title"] if row else None
 
     def add_message(
         self,
@@ -148,17 +754,30 @@ class ChatDatabase:
         raw_text: str,
         parsed_text: str,
         timestamp: Optional[str] = None,
+        token_count: Optional[int] = None,
+        token_family: Optional[str] = None,
     ) -> Optional[int]:
-        """添加消息到会话"""
+        """添加消息到会话，token_count 为 raw_text 按 token_family 分词器统计的token数"""
         timestamp = timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with self.conn:
-            cursor = self.conn.cursor()
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
             cursor.execute(
                 """
-                INSERT INTO messages (session_id, role, raw_text, parsed_text, timestamp) 
-                VALUES (?, ?, ?, ?, ?)
+                INSERT INTO messages 
+                    (session_id, role, raw_text, parsed_text, timestamp, seq, 
+                     token_count, token_family) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
                 """,
-                (session_id, role, raw_text, parsed_text, timestamp),
+                (
+                    session_id,
+                    role,
+                    raw_text,
+                    parsed_text,
+                    timestamp,
+                    self._next_seq(),
+                    token_count,
+                    token_family,
+                ),
             )
             return cursor.lastrowid
 
@@ -167,8 +786,10 @@ class ChatDatabase:
         message_id: int,
         parsed_text: Optional[str] = None,
         raw_text: Optional[str] = None,
+        token_count: Optional[int] = None,
+        token_family: Optional[str] = None,
     ) -> None:
-        """更新消息内容"""
+        """更新消息内容，token_count 为新 raw_text 的token数，未提供时缓存失效"""
         if parsed_text is None and raw_text is None:
             return
 
@@ -176,8 +797,8 @@ class ChatDatabase:
         params = []
 
         if raw_text is not None:
-            update_fields.append("raw_text = ?")
-            params.append(raw_text)
+            update_fields.append("raw_text = ?, token_count = ?, token_family = ?")
+            params.extend([raw_text, token_count, token_family])
 
         if parsed_text is not None:
             update_fields.append("parsed_text = ?")
@@ -187,104 +808,566 @@ class ChatDatabase:
 
         query = f"UPDATE messages SET {', '.join(update_fields)} WHERE id = ?"
 
-        with self.conn:
-            self.conn.execute(query, params)
+        with self.pool.writer() as conn:
+            conn.execute(query, params)
 
     def delete_message(self, message_id: int) -> None:
         """删除消息"""
-        with self.conn:
-            self.conn.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+        with self.pool.writer() as conn:
+            conn.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+
+    MESSAGE_COLUMNS = "id, role, raw_text, parsed_text, timestamp, seq"
+
+    def _get_lineage(
+        self, conn: sqlite3.Connection, session_id: int
+    ) -> List[Tuple[int, Optional[int]]]:
+        """获取会话的继承链 [(会话ID, 可见的最大seq)]，自身在最前，None表示不限"""
+        lineage: List[Tuple[int, Optional[int]]] = []
+        current: Optional[int] = session_id
+        max_seq: Optional[int] = None
+        while current is not None:
+            lineage.append((current, max_seq))
+            row = conn.execute(
+                "SELECT parent_id, fork_seq FROM sessions WHERE id = ?", (current,)
+            ).fetchone()
+            if row is None or row["parent_id"] is None:
+                break
+            fork_seq = row["fork_seq"]
+            max_seq = fork_seq if max_seq is None else min(max_seq, fork_seq)
+            current = row["parent_id"]
+        return lineage
+
+    def _select_session_messages(
+        self,
+        conn: sqlite3.Connection,
+        session_id: int,
+        columns: str,
+        condition: str = "",
+        params: Tuple = (),
+        descending: bool = False,
+        limit: int = -1,
+    ) -> List[sqlite3.Row]:
+        """按 seq 顺序查询会话可见的消息，透明地包含从祖先会话继承的部分
+
+        普通会话只有一段查询，直接走 idx_messages_session_seq 索引。
+        """
+        parts = []
+        all_params: List[Any] = []
+        for member_id, max_seq in self._get_lineage(conn, session_id):
+            part = f"SELECT {columns} FROM messages WHERE session_id = ?"
+            all_params.append(member_id)
+            if max_seq is not None:
+                part += " AND seq <= ?"
+                all_params.append(max_seq)
+            if condition:
+                part += f" AND {condition}"
+                all_params.extend(params)
+            parts.append(part)
+        query = " UNION ALL ".join(parts)
+        query += f" ORDER BY seq {'DESC' if descending else 'ASC'} LIMIT ?"
+        all_params.append(limit)
+        return conn.execute(query, all_params).fetchall()
 
     def get_session_messages(
         self, session_id: int, limit: int = -1
     ) -> List[Dict[str, Any]]:
-        """获取会话的消息列表"""
-        cursor = self.conn.cursor()
-        query = """
-            SELECT id, role, raw_text, parsed_text, timestamp 
-            FROM messages 
-            WHERE session_id = ? 
-            ORDER BY timestamp DESC
+        """获取会话的消息列表，按 seq 升序（显示顺序）返回
+
+        指定limit时返回最近的limit条消息
         """
-        if limit != -1:
-            query += " LIMIT ?"
-            cursor.execute(query, (session_id, limit))
-        else:
-            cursor.execute(query, (session_id,))
+        with self.pool.reader() as conn:
+            if limit == -1:
+                rows = self._select_session_messages(
+                    conn, session_id, self.MESSAGE_COLUMNS
+                )
+                return [dict(row) for row in rows]
+
+            rows = self._select_session_messages(
+                conn, session_id, self.MESSAGE_COLUMNS, descending=True, limit=limit
+            )
+            return [dict(row) for row in reversed(rows)]
+
+    def get_session_messages_page(
+        self,
+        session_id: int,
+        limit: int,
+        before_seq: Optional[int] = None,
+    ) -> Tuple[List[Dict[str, Any]], bool]:
+        """按 seq 游标分页获取消息
+
+        返回 seq 小于 before_seq 的最近 limit 条消息（按显示顺序）以及是否还有更早的消息，
+        由索引 idx_messages_session_seq 直接倒序扫描。
+        """
+        condition, params = "", ()
+        if before_seq is not None:
+            condition, params = "seq < ?", (before_seq,)
 
-        return [dict(row) for row in cursor.fetchall()]
+        with self.pool.reader() as conn:
+            rows = self._select_session_messages(
+                conn,
+                session_id,
+                self.MESSAGE_COLUMNS,
+                condition,
+                params,
+                descending=True,
+                limit=limit + 1,
+            )
+
+        has_more = len(rows) > limit
+        return [dict(row) for row in reversed(rows[:limit])], has_more
+
+    def get_session_messages_from(
+        self, session_id: int, from_seq: Optional[int]
+    ) -> Tuple[List[Dict[str, Any]], bool]:
+        """获取 seq 不小于 from_seq 的消息（按显示顺序）以及是否还有更早的消息
+
+        用于按客户端已加载的窗口重新发送消息，from_seq 为 None 时返回全部消息。
+        """
+        with self.pool.reader() as conn:
+            if from_seq is None:
+                rows = self._select_session_messages(
+                    conn, session_id, self.MESSAGE_COLUMNS
+                )
+                return [dict(row) for row in rows], False
+            rows = self._select_session_messages(
+                conn, session_id, self.MESSAGE_COLUMNS, "seq >= ?", (from_seq,)
+            )
+            older = self._select_session_messages(
+                conn, session_id, "seq", "seq < ?", (from_seq,), limit=1
+            )
+        return [dict(row) for row in rows], bool(older)
+
+    PROMPT_COLUMNS = "id, role, raw_text, seq, token_count, token_family"
+
+    def get_session_prompt_messages(
+        self, session_id: int, limit: int = -1
+    ) -> List[Dict[str, Any]]:
+        """获取构建提示用的最近limit条消息（含缓存的token数），按显示顺序返回"""
+        with self.pool.reader() as conn:
+            rows = self._select_session_messages(
+                conn, session_id, self.PROMPT_COLUMNS, descending=True, limit=limit
+            )
+            return [dict(row) for row in reversed(rows)]
+
+    def set_message_token_counts(self, counts: List[Tuple[int, int, str]]) -> None:
+        """批量写入消息的token数缓存 [(消息ID, token数, 分词器名)]"""
+        if not counts:
+            return
+        with self.pool.writer() as conn:
+            conn.executemany(
+                "UPDATE messages SET token_count = ?, token_family = ? WHERE id = ?",
+                [(count, family, message_id) for message_id, count, family in counts],
+            )
+
+    def get_session_messages_after(
+        self, session_id: int, after_seq: int, upto_seq: int, limit: int = -1
+    ) -> List[Dict[str, Any]]:
+        """获取 after_seq < seq <= upto_seq 的用户/助手消息，按显示顺序返回"""
+        with self.pool.reader() as conn:
+            rows = self._select_session_messages(
+                conn,
+                session_id,
+                self.PROMPT_COLUMNS,
+                "seq > ? AND seq <= ? AND role != 'system'",
+                (after_seq, upto_seq),
+                limit=limit,
+            )
+            return [dict(row) for row in rows]
+
+    def get_conversation_summary(self, session_id: int) -> Optional[Dict[str, Any]]:
+        """获取会话的滚动摘要，分叉会话可沿用祖先会话在分叉点之前生成的摘要"""
+        with self.pool.reader() as conn:
+            for member_id, max_seq in self._get_lineage(conn, session_id):
+                row = conn.execute(
+                    """
+                    SELECT summary, covered_seq, token_count, token_family 
+                    FROM conversation_summaries WHERE session_id = ?
+                    """,
+                    (member_id,),
+                ).fetchone()
+                if row and (max_seq is None or row["covered_seq"] <= max_seq):
+                    return dict(row)
+            return None
+
+    def save_conversation_summary(
+        self,
+        session_id: int,
+        summary: str,
+        covered_seq: int,
+        token_count: Optional[int] = None,
+        token_family: Optional[str] = None,
+    ) -> None:
+        """保存会话的滚动摘要"""
+        updated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.pool.writer() as conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO conversation_summaries 
+                    (session_id, summary, covered_seq, token_count, token_family, 
+                     updated_at) 
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    session_id,
+                    summary,
+                    covered_seq,
+                    token_count,
+                    token_family,
+                    updated_at,
+                ),
+            )
+
+    def add_generation_metrics(self, message_id: int, metrics: Dict[str, Any]) -> None:
+        """记录助手消息的生成指标"""
+        with self.pool.writer() as conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO generation_metrics 
+                    (message_id, provider, model, created_at, ttft_ms, duration_ms, 
+                     chunk_count, prompt_tokens, completion_tokens, usage_reported, 
+                     cancelled) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    message_id,
+                    metrics.get("provider"),
+                    metrics.get("model"),
+                    metrics.get("created_at", time.time()),
+                    metrics.get("ttft_ms"),
+                    metrics["duration_ms"],
+                    metrics["chunk_count"],
+                    metrics.get("prompt_tokens"),
+                    metrics.get("completion_tokens"),
+                    int(metrics.get("usage_reported", False)),
+                    int(metrics.get("cancelled", False)),
+                ),
+            )
+
+    def get_generation_metrics(self, since: float) -> List[Dict[str, Any]]:
+        """获取 since（时间戳）之后的生成指标"""
+        with self.pool.reader() as conn:
+            rows = conn.execute(
+                """
+                SELECT message_id, provider, model, created_at, ttft_ms, duration_ms, 
+                       chunk_count, prompt_tokens, completion_tokens, usage_reported, 
+                       cancelled 
+                FROM generation_metrics WHERE created_at >= ? 
+                ORDER BY created_at
+                """,
+                (since,),
+            ).fetchall()
+            return [dict(row) for row in rows]
 
     def get_session_system_message(self, session_id: int) -> Optional[str]:
         """获取会话的系统消息"""
-        cursor = self.conn.cursor()
-        cursor.execute(
-            """
-            SELECT raw_text 
-            FROM messages 
-            WHERE session_id = ? AND role = 'system' 
-            ORDER BY timestamp
-            """,
-            (session_id,),
-        )
-        row = cursor.fetchone()
-        return row["raw_text"] if row else None
+        with self.pool.reader() as conn:
+            rows = self._select_session_messages(
+                conn, session_id, "raw_text, seq", "role = 'system'", limit=1
+            )
+            return rows[0]["raw_text"] if rows else None
+
+    def get_session_system_message_row(
+        self, session_id: int
+    ) -> Optional[Dict[str, Any]]:
+        """获取会话的系统消息（完整字段），分页加载时随第一页发送给客户端"""
+        with self.pool.reader() as conn:
+            rows = self._select_session_messages(
+                conn, session_id, self.MESSAGE_COLUMNS, "role = 'system'", limit=1
+            )
+            return dict(rows[0]) if rows else None
 
     def get_session_ai_config(self, session_id: int) -> Optional[Dict[str, Any]]:
         """获取会话的AI配置"""
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT ai_config FROM sessions WHERE id = ?", (session_id,))
-        row = cursor.fetchone()
-        return json.loads(row["ai_config"]) if row else {}
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT ai_config FROM sessions WHERE id = ?", (session_id,))
+            row = cursor.fetchone()
+            return json.loads(row["ai_config"]) if row else {}
 
     def update_session_ai_config(self, session_id: int, ai_config: dict) -> None:
         """更新会话的AI配置"""
-        with self.conn:
-            self.conn.execute(
+        with self.pool.writer() as conn:
+            conn.execute(
                 "UPDATE sessions SET ai_config = ? WHERE id = ?",
                 (json.dumps(ai_config, ensure_ascii=False), session_id),
             )
 
+    # 配置键会拼入 JSON 路径，只允许不需要转义的字符
+    _CONFIG_KEY_PATTERN = re.compile(r"[A-Za-z0-9_]+")
+
+    def patch_session_ai_config(self, session_id: int, patch: Dict[str, Any]) -> None:
+        """用一条 json_set 语句原子地更新AI配置中的若干顶层键，无需读出整个配置"""
+        if not patch:
+            return
+        paths = []
+        params: List[Any] = []
+        for key, value in patch.items():
+            if not self._CONFIG_KEY_PATTERN.fullmatch(key):
+                raise ValueError(f"无效的配置键: {key!r}")
+            paths.append("?, json(?)")
+            params.append(f'$."{key}"')
+            params.append(json.dumps(value, ensure_ascii=False))
+        params.append(session_id)
+        query = f"""
+            UPDATE sessions 
+            SET ai_config = json_set(COALESCE(ai_config, '{{}}'), {", ".join(paths)}) 
+            WHERE id = ?
+        """
+        with self.pool.writer() as conn:
+            conn.execute(query, params)
+
     def is_session_exist(self, session_id: int) -> bool:
         """检查会话是否存在"""
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,))
-        return cursor.fetchone() is not None
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,))
+            return cursor.fetchone() is not None
 
     def get_session(self, session_id: int) -> Optional[Dict[str, Any]]:
         """获取会话信息"""
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT * FROM sessions WHERE id = ?", (session_id,))
-        row = cursor.fetchone()
-        return dict(row) if row else None
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM sessions WHERE id = ?", (session_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
 
     def get_all_session_id_title_config(self) -> List[Dict[str, Any]]:
         """获取所有会话的ID、标题和配置"""
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT id, title, ai_config FROM sessions")
-        return [dict(row) for row in cursor.fetchall()]
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, title, ai_config FROM sessions")
+            return [dict(row) for row in cursor.fetchall()]
+
+    # 短词退回子串扫描时的时间预算（秒），超时返回已找到的结果
+    SHORT_TERM_SCAN_SECONDS = 0.5
+
+    def search_messages(
+        self, query: str, limit: int = 20, session_id: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """全文检索消息，按相关度返回命中的消息、所属会话和摘要片段
+
+        分叉会话继承的消息在每个可见它的会话下各返回一条；指定 session_id 时
+        检索该会话可见的全部消息（含继承的部分）。
+        trigram 索引无法检索少于3个字符的词：有较长的词时先用索引缩小范围，
+        再对短词做子串过滤；全部是短词时从最新的消息开始扫描，
+        最多 SHORT_TERM_SCAN_SECONDS 秒，超时只返回已找到的结果。
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        long_terms = [term for term in terms if len(term) >= 3]
+        short_terms = [term for term in terms if len(term) < 3]
+
+        sql = """
+            SELECT m.id AS message_id, m.session_id, m.seq, m.role, m.timestamp, 
+                s.title, {snippet} AS snippet 
+            FROM {source} 
+            JOIN sessions AS s ON s.id = m.session_id 
+            WHERE {match}
+        """
+        params: List[Any] = []
+        if long_terms:
+            # 每个词作为短语匹配，多个词之间为AND关系
+            match_query = " ".join(
+                '"' + t.replace('"', '""') + '"' for t in long_terms
+            )
+            sql = sql.format(
+                snippet="snippet(messages_fts, 0, '<mark>', '</mark>', '…', 32)",
+                source="messages_fts JOIN messages AS m ON m.id = messages_fts.rowid",
+                match="messages_fts MATCH ?",
+            )
+            params.append(match_query)
+            order_by = " ORDER BY messages_fts.rank"
+        else:
+            sql = sql.format(
+                snippet="substr(m.raw_text, 1, 64)",
+                source="messages AS m",
+                match="1",
+            )
+            # 按 id 倒序可以边扫描边返回，超时中断时保留最新的结果
+            order_by = " ORDER BY m.id DESC"
+        for term in short_terms:
+            sql += " AND m.raw_text LIKE ?"
+            params.append(f"%{term}%")
+
+        with self.pool.reader() as conn:
+            if session_id is not None:
+                lineage = self._get_lineage(conn, session_id)
+                visible = []
+                for member_id, max_seq in lineage:
+                    if max_seq is None:
+                        visible.append("m.session_id = ?")
+                        params.append(member_id)
+                    else:
+                        visible.append("(m.session_id = ? AND m.seq <= ?)")
+                        params.extend([member_id, max_seq])
+                sql += f" AND ({' OR '.join(visible)})"
+            sql += order_by + " LIMIT ?"
+            params.append(limit)
+
+            if long_terms:
+                rows = [dict(row) for row in conn.execute(sql, params).fetchall()]
+            else:
+                rows = self._scan_with_budget(conn, sql, params)
+
+            if session_id is not None:
+                # 继承的消息归属于被检索的会话
+                title = conn.execute(
+                    "SELECT title FROM sessions WHERE id = ?", (session_id,)
+                ).fetchone()
+                for row in rows:
+                    row["session_id"] = session_id
+                    row["title"] = title["title"] if title else row["title"]
+            else:
+                rows = self._expand_inherited_hits(conn, rows)[:limit]
+        for row in rows:
+            del row["seq"]
+        return rows
+
+    def _scan_with_budget(
+        self, conn: sqlite3.Connection, sql: str, params: List[Any]
+    ) -> List[Dict[str, Any]]:
+        """执行子串扫描，超过时间预算时中断并返回已取到的行"""
+        deadline = time.monotonic() + self.SHORT_TERM_SCAN_SECONDS
+        rows: List[Dict[str, Any]] = []
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+        try:
+            for row in conn.execute(sql, params):
+                rows.append(dict(row))
+        except sqlite3.OperationalError as e:
+            if "interrupted" not in str(e):
+                raise
+            logger.warning(f"短词检索超过 {self.SHORT_TERM_SCAN_SECONDS} 秒，返回部分结果")
+        finally:
+            conn.set_progress_handler(None, 0)
+        return rows
+
+    def _expand_inherited_hits(
+        self, conn: sqlite3.Connection, rows: List[Dict[str, Any]]
+    ) -> List[Dict[str, Any]]:
+        """为每条命中的消息补上继承了它的分叉会话（含子孙会话）"""
+        expanded = []
+        for row in rows:
+            expanded.append(row)
+            heirs = conn.execute(
+                """
+                WITH RECURSIVE heirs (id) AS (
+                    SELECT id FROM sessions WHERE parent_id = ? AND fork_seq >= ? 
+                    UNION ALL 
+                    SELECT s.id FROM sessions AS s JOIN heirs ON s.parent_id = heirs.id 
+                    WHERE s.fork_seq >= ?
+                )
+                SELECT s.id, s.title FROM heirs JOIN sessions AS s ON s.id = heirs.id
+                """,
+                (row["session_id"], row["seq"], row["seq"]),
+            ).fetchall()
+            for heir in heirs:
+                expanded.append(
+                    {**row, "session_id": heir["id"], "title": heir["title"]}
+                )
+        return expanded
+
+    def get_session_summaries(
+        self, offset: int = 0, limit: int = -1
+    ) -> List[Dict[str, Any]]:
+        """获取会话列表摘要，置顶优先，其次按最后活动时间倒序"""
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT id, title, top, last_active_time, ai_avatar_url, message_count 
+                FROM session_summary 
+                ORDER BY top DESC, last_active_time DESC 
+                LIMIT ? OFFSET ?
+                """,
+                (limit, offset),
+            )
+            return [self._session_summary(row) for row in cursor.fetchall()]
+
+    @staticmethod
+    def _session_summary(row: sqlite3.Row) -> Dict[str, Any]:
+        return {
+            "id": row["id"],
+            "title": row["title"],
+            "top": bool(row["top"]),
+            "last_active_time": row["last_active_time"],
+            "ai_avatar_url": row["ai_avatar_url"],
+            "message_count": row["message_count"],
+        }
+
+    def get_session_revision(self) -> int:
+        """获取会话列表的当前版本号"""
+        with self.pool.reader() as conn:
+            row = conn.execute("SELECT MAX(revision) FROM session_revisions").fetchone()
+            return row[0] or 0
+
+    def get_session_changes(
+        self, since_revision: int
+    ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], int]:
+        """获取某版本之后变更的会话
+
+        返回 (更新或新增的会话摘要, 被删除的会话, 最新版本号)，
+        每项都带有对应的 revision。
+        """
+        with self.pool.reader() as conn:
+            rows = conn.execute(
+                """
+                SELECT r.session_id, r.revision, r.removed, 
+                    s.id, s.title, s.top, s.last_active_time, s.ai_avatar_url, 
+                    s.message_count 
+                FROM session_revisions AS r 
+                LEFT JOIN session_summary AS s ON s.id = r.session_id 
+                WHERE r.revision > ? 
+                ORDER BY r.revision
+                """,
+                (since_revision,),
+            ).fetchall()
+
+        upserted = []
+        removed = []
+        revision = since_revision
+        for row in rows:
+            revision = row["revision"]
+            if row["removed"] or row["id"] is None:
+                removed.append({"session_id": row["session_id"], "revision": revision})
+            else:
+                upserted.append(
+                    {"session": self._session_summary(row), "revision": revision}
+                )
+        return upserted, removed, revision
+
+    def get_session_count(self) -> int:
+        """获取会话总数"""
+        with self.pool.reader() as conn:
+            return conn.execute("SELECT COUNT(*) FROM session_summary").fetchone()[0]
 
     def get_parsed_text(self, message_id: int) -> Optional[str]:
         """获取消息的解析文本"""
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT parsed_text FROM messages WHERE id = ?", (message_id,))
-        row = cursor.fetchone()
-        return row["parsed_text"] if row else None
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT parsed_text FROM messages WHERE id = ?", (message_id,)
+            )
+            row = cursor.fetchone()
+            return row["parsed_text"] if row else None
 
     def close(self) -> None:
         """关闭数据库连接"""
-        self.conn.close()
+        self.pool.close()
 
 
 # 数据库操作辅助函数
 def get_db_session_count(db: ChatDatabase) -> int:
     """获取数据库中的会话总数"""
-    cursor = db.conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM sessions")
-    return cursor.fetchone()[0]
+    with db.pool.reader() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM sessions")
+        return cursor.fetchone()[0]
 
 
 def get_db_message_count(db: ChatDatabase) -> int:
     """获取数据库中的消息总数"""
-    cursor = db.conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM messages")
-    return cursor.fetchone()[0]
+    with db.pool.reader() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM messages")
+        return cursor.fetchone()[0]
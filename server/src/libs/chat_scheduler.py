@@ -0,0 +1,167 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Set
+from libs.config import UtilsBase
+from libs.log_config import logger
+
+
+class _ChatJob:
+    def __init__(self, session_id: int, run: Callable[[], Awaitable]):
+        self.session_id = session_id
+        self.run = run
+        self.submitted_at = time.monotonic()
+
+
+class _ProviderSlot:
+    """服务商并发槽位"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit)
+        self.running = 0
+        self.waiting = 0
+
+
+class ChatScheduler:
+    """聊天任务调度器，运行在主事件循环中
+
+    - 同一会话的输入按提交顺序（FIFO）逐个执行；
+    - 每个服务商同时进行的请求数受 apis 配置中该服务商的 max_concurrency 限制，
+      由 ProviderRouter 在实际请求的服务商上获取槽位（含备用服务商）；
+    - 排队总数或单个会话的排队数超过上限时拒绝新的输入（准入控制）；
+    - stats() 提供队列深度、等待时间等指标。
+    """
+
+    MAX_PENDING = 64
+    MAX_PENDING_PER_SESSION = 4
+    DEFAULT_PROVIDER_CONCURRENCY = 4
+
+    _session_queues: Dict[int, Deque[_ChatJob]] = {}
+    _providers: Dict[str, _ProviderSlot] = {}
+    # 正在运行的会话工作协程，保持引用避免被垃圾回收
+    _workers: Set[asyncio.Task] = set()
+    _pending = 0
+    _metrics: Dict[str, Any] = {
+        "admitted": 0,
+        "rejected": 0,
+        "started": 0,
+        "completed": 0,
+        "failed": 0,
+        "wait_total": 0.0,
+        "wait_max": 0.0,
+    }
+
+    @staticmethod
+    def submit(session_id: int, run: Callable[[], Awaitable]) -> bool:
+        """提交会话的一次聊天，返回是否被接受"""
+        queue = ChatScheduler._session_queues.get(session_id)
+        depth = len(queue) if queue else 0
+        if (
+            ChatScheduler._pending >= ChatScheduler.MAX_PENDING
+            or depth >= ChatScheduler.MAX_PENDING_PER_SESSION
+        ):
+            ChatScheduler._metrics["rejected"] += 1
+            logger.warning(
+                f"聊天队列已满，拒绝会话 {session_id} 的输入"
+                f"（总排队 {ChatScheduler._pending}，会话排队 {depth}）"
+            )
+            return False
+
+        job = _ChatJob(session_id, run)
+        ChatScheduler._pending += 1
+        ChatScheduler._metrics["admitted"] += 1
+        if queue is None:
+            queue = deque([job])
+            ChatScheduler._session_queues[session_id] = queue
+            worker = asyncio.create_task(ChatScheduler._drain(session_id, queue))
+            ChatScheduler._workers.add(worker)
+            worker.add_done_callback(ChatScheduler._workers.discard)
+        else:
+            queue.append(job)
+        return True
+
+    @staticmethod
+    def _provider_limit(provider: str) -> int:
+        """服务商的并发上限，取自 apis 配置中名称或 base_url 匹配的项"""
+        for api in UtilsBase.APIS:
+            if provider in (api.get("name"), api.get("base_url")):
+                limit = api.get(
+                    "max_concurrency", ChatScheduler.DEFAULT_PROVIDER_CONCURRENCY
+                )
+                return max(1, int(limit))
+        return ChatScheduler.DEFAULT_PROVIDER_CONCURRENCY
+
+    @staticmethod
+    async def acquire_provider(provider: str) -> None:
+        """等待服务商的并发槽位，请求结束后需调用 release_provider"""
+        slot = ChatScheduler._providers.get(provider)
+        if slot is None:
+            slot = _ProviderSlot(ChatScheduler._provider_limit(provider))
+            ChatScheduler._providers[provider] = slot
+        slot.waiting += 1
+        try:
+            await slot.semaphore.acquire()
+        finally:
+            slot.waiting -= 1
+        slot.running += 1
+
+    @staticmethod
+    def release_provider(provider: str) -> None:
+        slot = ChatScheduler._providers[provider]
+        slot.running -= 1
+        slot.semaphore.release()
+
+    @staticmethod
+    async def _drain(session_id: int, queue: Deque[_ChatJob]) -> None:
+        """依次执行会话队列中的任务，队列清空后退出"""
+        try:
+            while queue:
+                job = queue.popleft()
+                ChatScheduler._pending -= 1
+                ChatScheduler._record_wait(time.monotonic() - job.submitted_at)
+                try:
+                    await job.run()
+                    ChatScheduler._metrics["completed"] += 1
+                except Exception as e:
+                    ChatScheduler._metrics["failed"] += 1
+                    logger.error(f"会话 {session_id} 聊天任务失败: {e}", exc_info=True)
+        finally:
+            ChatScheduler._pending -= len(queue)
+            ChatScheduler._session_queues.pop(session_id, None)
+
+    @staticmethod
+    def _record_wait(wait: float) -> None:
+        metrics = ChatScheduler._metrics
+        metrics["started"] += 1
+        metrics["wait_total"] += wait
+        metrics["wait_max"] = max(metrics["wait_max"], wait)
+
+    @staticmethod
+    def stats() -> Dict[str, Any]:
+        """调度指标：排队深度、运行数、准入/拒绝次数和排队等待时间"""
+        metrics = ChatScheduler._metrics
+        started = metrics["started"]
+        running = sum(slot.running for slot in ChatScheduler._providers.values())
+        return {
+            "pending": ChatScheduler._pending,
+            "running": running,
+            "admitted": metrics["admitted"],
+            "rejected": metrics["rejected"],
+            "completed": metrics["completed"],
+            "failed": metrics["failed"],
+            "avg_wait_ms": metrics["wait_total"] / started * 1000 if started else 0.0,
+            "max_wait_ms": metrics["wait_max"] * 1000,
+            "sessions": {
+                session_id: len(queue)
+                for session_id, queue in ChatScheduler._session_queues.items()
+            },
+            "providers": {
+                provider: {
+                    "limit": slot.limit,
+                    "running": slot.running,
+                    "waiting": slot.waiting,
+                }
+                for provider, slot in ChatScheduler._providers.items()
+            },
+        }
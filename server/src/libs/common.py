@@ -1,8 +1,10 @@
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Optional
 from libs.chat_database import ChatDatabase
 from libs.openai_chat_api import OpenAIChatAPI
+from libs.async_chat_api import AsyncChatAPI
 from libs.speaker import Speaker
 from libs.recognizer import Recognizer
 from libs.config import UtilsBase
@@ -11,21 +13,18 @@ from libs.websocket_client import WsClient
 class Utils(UtilsBase):
     # 初始化服务
     db = ChatDatabase(UtilsBase.DATABASE_PATH)
-    api = OpenAIChatAPI(db)
+    # 数据库等阻塞调用的专用线程池，事件循环只负责I/O调度
+    db_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="voichai-db")
+    api = OpenAIChatAPI(db, db_executor)
+    async_api = AsyncChatAPI(api, db_executor)
     speaker = Speaker(UtilsBase.CONFIG, UtilsBase.VOICHAI_STORAGE_PATH)
     recognizer = Recognizer(UtilsBase.CONFIG)
     iwin_ws_client: WsClient
 
-    @staticmethod
-    def create_api() -> OpenAIChatAPI:
-        db = ChatDatabase(UtilsBase.DATABASE_PATH)
-        api = OpenAIChatAPI(db)
-        return api
-
     @staticmethod
     def init_services():
-        Utils.db = ChatDatabase(UtilsBase.DATABASE_PATH)
-        Utils.api = OpenAIChatAPI(Utils.db)
+        Utils.api = OpenAIChatAPI(Utils.db, Utils.db_executor)
+        Utils.async_api = AsyncChatAPI(Utils.api, Utils.db_executor)
         Utils.speaker = Speaker(UtilsBase.CONFIG, UtilsBase.VOICHAI_STORAGE_PATH)
         Utils.recognizer = Recognizer(UtilsBase.CONFIG)
 
@@ -106,7 +105,12 @@ class Utils(UtilsBase):
             Utils.createDirIfnotExists(avatar_dir)
             src_avatar_path = Utils.Avatar.get_path_from_ai_avatar_url(ai_avatar_url)
             _, filename = Utils.Avatar.get_filename_from_ai_avatar_url(ai_avatar_url)
-            shutil.copyfile(src_avatar_path, avatar_dir + f"/{filename}")
+            dst_avatar_path = avatar_dir + f"/{filename}"
+            # 硬链接共享同一份文件数据，各会话仍可独立删除或替换自己的头像
+            try:
+                os.link(src_avatar_path, dst_avatar_path)
+            except OSError:
+                shutil.copyfile(src_avatar_path, dst_avatar_path)
             return f"{UtilsBase.AVATAR_BASE_URL}/{session_id}/{filename}"
 
         @staticmethod
@@ -0,0 +1,119 @@
+import asyncio
+import itertools
+import time
+from typing import Any, Dict, List, Optional, Set
+import openai
+from libs.log_config import logger
+
+
+class GenerationCancelled(Exception):
+    """生成在收到首字之前被取消"""
+
+
+class Generation:
+    """一次进行中的AI回复生成"""
+
+    def __init__(self, generation_id: int, session_id: int, model: str):
+        self.id = generation_id
+        self.session_id = session_id
+        self.model = model
+        # 助手消息ID，收到第一段回复时才分配
+        self.message_id = -1
+        self.started_at = time.time()
+        self.response_chars = 0
+        self.cancelled = False
+        self.stream: Optional[openai.AsyncStream] = None
+        # 尚未收到首字的上游请求（含故障切换、对冲请求），取消时一并关闭
+        self._pending_streams: Set[openai.AsyncStream] = set()
+        self._cancelled_event = asyncio.Event()
+
+    async def attach_stream(self, stream: openai.AsyncStream) -> None:
+        """记录上游流；若在请求发出期间已被取消，立即关闭"""
+        self.stream = stream
+        if self.cancelled:
+            await self.close_stream()
+
+    async def track_stream(self, stream: openai.AsyncStream) -> None:
+        """登记一个等待首字的上游流；若已被取消，立即关闭"""
+        self._pending_streams.add(stream)
+        if self.cancelled:
+            await self._close(stream)
+
+    def untrack_stream(self, stream: openai.AsyncStream) -> None:
+        self._pending_streams.discard(stream)
+
+    async def wait_cancelled(self) -> None:
+        await self._cancelled_event.wait()
+
+    async def cancel(self) -> None:
+        """取消生成并关闭上游HTTP流，服务商随即停止生成（和计费）"""
+        if self.cancelled:
+            return
+        self.cancelled = True
+        self._cancelled_event.set()
+        for stream in list(self._pending_streams):
+            await self._close(stream)
+        await self.close_stream()
+
+    async def close_stream(self) -> None:
+        """关闭上游流（已读完的流关闭无副作用）"""
+        if self.stream is not None:
+            await self._close(self.stream)
+
+    @staticmethod
+    async def _close(stream: openai.AsyncStream) -> None:
+        try:
+            await stream.close()
+        except Exception as e:
+            logger.warning(f"关闭上游流失败: {e}")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "session_id": self.session_id,
+            "message_id": self.message_id,
+            "model": self.model,
+            "started_at": self.started_at,
+            "elapsed": time.time() - self.started_at,
+            "response_chars": self.response_chars,
+            "cancelled": self.cancelled,
+        }
+
+
+class GenerationRegistry:
+    """进行中的生成登记表，按 (会话, 消息) 取消，并可查看当前所有生成"""
+
+    _generations: Dict[int, Generation] = {}
+    _ids = itertools.count(1)
+
+    @staticmethod
+    def start(session_id: int, model: str) -> Generation:
+        generation = Generation(next(GenerationRegistry._ids), session_id, model)
+        GenerationRegistry._generations[generation.id] = generation
+        return generation
+
+    @staticmethod
+    def finish(generation: Generation) -> None:
+        GenerationRegistry._generations.pop(generation.id, None)
+
+    @staticmethod
+    async def cancel(session_id: int, message_id: Optional[int] = None) -> int:
+        """取消会话中的生成，指定message_id时只取消该消息，返回取消的数量"""
+        targets = [
+            generation
+            for generation in list(GenerationRegistry._generations.values())
+            if generation.session_id == session_id
+            and (message_id is None or generation.message_id == message_id)
+        ]
+        for generation in targets:
+            logger.info(f"取消会话 {session_id} 的生成 {generation.id}")
+            await generation.cancel()
+        return len(targets)
+
+    @staticmethod
+    def list_generations() -> List[Dict[str, Any]]:
+        """当前进行中的生成"""
+        return [
+            generation.to_dict()
+            for generation in GenerationRegistry._generations.values()
+        ]
@@ -0,0 +1,205 @@
+import json
+import re
+from typing import Any, Dict, List, Optional
+
+# 字符串内部需要特殊处理的字符，其余字符可以整段复制
+_STRING_SPECIAL = re.compile(r'["\\]')
+_ESCAPES = {
+    '"': '"',
+    "\\": "\\",
+    "/": "/",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+}
+_SCALAR_END = ",}] \t\r\n"
+
+_VALUE, _STRING, _ESCAPE, _UNICODE, _SCALAR = range(5)
+
+
+class JsonStreamParser:
+    """增量解析模型流式输出的JSON对象，每个字符只处理一次
+
+    - stream_field 对应的顶层字符串字段（默认 response）在到达时逐段解码输出；
+    - 其他顶层字段（title、suggestions、secondary_response 等）解析完成后即可从 fields 读取；
+    - 忽略第一个 { 之前的内容（如 ```json 包裹），容忍多余的逗号。
+    """
+
+    def __init__(self, stream_field: str = "response"):
+        self.stream_field = stream_field
+        self.root: Optional[Dict[str, Any]] = None
+        self.done = False
+        # 已解码的流式字段内容
+        self._stream_parts: List[str] = []
+        self._stream_ended = False
+        # 容器栈，元素为 [容器, 当前键]
+        self._stack: List[list] = []
+        self._mode = _VALUE
+        self._emitting = False
+        self._is_key = False
+        self._parts: List[str] = []
+        self._hex = ""
+        self._high_surrogate: Optional[int] = None
+        self._scalar: List[str] = []
+
+    @property
+    def fields(self) -> Dict[str, Any]:
+        """已解析的顶层字段，未完成的字符串字段不包含在内"""
+        return self.root if self.root is not None else {}
+
+    @property
+    def text(self) -> str:
+        """流式字段当前已解码的全部内容"""
+        if len(self._stream_parts) > 1:
+            self._stream_parts = ["".join(self._stream_parts)]
+        return self._stream_parts[0] if self._stream_parts else ""
+
+    @property
+    def stream_ended(self) -> bool:
+        """流式字段是否已经完整"""
+        return self._stream_ended
+
+    def feed(self, chunk: str) -> str:
+        """输入一段文本，返回流式字段本次新增的解码内容"""
+        new_parts: List[str] = []
+        i, n = 0, len(chunk)
+        while i < n and not self.done:
+            mode = self._mode
+            if mode == _STRING:
+                match = _STRING_SPECIAL.search(chunk, i)
+                end = match.start() if match else n
+                if end > i:
+                    self._append(chunk[i:end], new_parts)
+                if not match:
+                    break
+                i = end + 1
+                if chunk[end] == '"':
+                    self._end_string(new_parts)
+                else:
+                    self._mode = _ESCAPE
+                continue
+
+            ch = chunk[i]
+            i += 1
+            if mode == _ESCAPE:
+                if ch == "u":
+                    self._hex = ""
+                    self._mode = _UNICODE
+                else:
+                    self._append(_ESCAPES.get(ch, ch), new_parts)
+                    self._mode = _STRING
+            elif mode == _UNICODE:
+                self._hex += ch
+                if len(self._hex) == 4:
+                    self._append_code(self._hex, new_parts)
+                    self._mode = _STRING
+            elif mode == _SCALAR:
+                if ch in _SCALAR_END:
+                    self._end_scalar()
+                    i -= 1
+                else:
+                    self._scalar.append(ch)
+            else:
+                self._structural(ch)
+
+        if new_parts:
+            self._stream_parts.extend(new_parts)
+        return "".join(new_parts)
+
+    def _structural(self, ch: str) -> None:
+        if self.root is None:
+            if ch == "{":
+                self._open({})
+            return
+        if ch in " \t\r\n,:":
+            return
+        if ch == "{":
+            self._open({})
+        elif ch == "[":
+            self._open([])
+        elif ch in "}]":
+            self._stack.pop()
+            if not self._stack:
+                self.done = True
+        elif ch == '"':
+            top = self._stack[-1]
+            self._is_key = isinstance(top[0], dict) and top[1] is None
+            self._emitting = (
+                not self._is_key
+                and len(self._stack) == 1
+                and top[1] == self.stream_field
+            )
+            self._parts = []
+            self._mode = _STRING
+        else:
+            self._scalar = [ch]
+            self._mode = _SCALAR
+
+    def _open(self, container: Any) -> None:
+        if self.root is None:
+            self.root = container
+        else:
+            self._add_value(container)
+        self._stack.append([container, None])
+
+    def _add_value(self, value: Any) -> None:
+        top = self._stack[-1]
+        if isinstance(top[0], dict):
+            if top[1] is not None:
+                top[0][top[1]] = value
+                top[1] = None
+        else:
+            top[0].append(value)
+
+    def _append(self, text: str, new_parts: List[str]) -> None:
+        if self._high_surrogate is not None:
+            text = chr(self._high_surrogate) + text
+            self._high_surrogate = None
+        self._parts.append(text)
+        if self._emitting:
+            new_parts.append(text)
+
+    def _append_code(self, hex_digits: str, new_parts: List[str]) -> None:
+        try:
+            code = int(hex_digits, 16)
+        except ValueError:
+            self._append("\\u" + hex_digits, new_parts)
+            return
+        high = self._high_surrogate
+        if 0xD800 <= code < 0xDC00:
+            # 高位代理，等待后续的低位代理
+            if high is not None:
+                self._append("", new_parts)
+            self._high_surrogate = code
+        elif high is not None and 0xDC00 <= code < 0xE000:
+            self._high_surrogate = None
+            combined = 0x10000 + ((high - 0xD800) << 10) + (code - 0xDC00)
+            self._append(chr(combined), new_parts)
+        else:
+            self._append(chr(code), new_parts)
+
+    def _end_string(self, new_parts: List[str]) -> None:
+        if self._high_surrogate is not None:
+            self._append("", new_parts)
+        value = "".join(self._parts)
+        self._parts = []
+        self._mode = _VALUE
+        if self._is_key:
+            self._stack[-1][1] = value
+            return
+        if self._emitting:
+            self._emitting = False
+            self._stream_ended = True
+        self._add_value(value)
+
+    def _end_scalar(self) -> None:
+        raw = "".join(self._scalar)
+        self._scalar = []
+        self._mode = _VALUE
+        try:
+            value = json.loads(raw)
+        except json.JSONDecodeError:
+            value = raw
+        self._add_value(value)
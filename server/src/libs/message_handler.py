@@ -1,21 +1,29 @@
 import json
 import time
+import functools
 import threading
 import asyncio
 
 from fastapi import WebSocket
 from websockets.asyncio.client import ClientConnection
 from libs.log_config import logger
-from libs.openai_chat_api import OpenAIChatAPI
 from libs.common import Utils
 from libs.session_manager import SessionManager
-
-thread_api: OpenAIChatAPI
+from libs.stream_frames import StreamFrameEncoder
+from libs.generation_registry import GenerationRegistry
+from libs.chat_scheduler import ChatScheduler
+from libs.session_jobs import RetryableJobError, SessionJobQueue
+from libs.streaming_speech import StreamingSpeech
 
 
 class MessageHandler:
     """消息处理器，处理不同类型的WebSocket消息"""
 
+    # 由服务端维护的配置项，客户端提交的配置快照可能已过期，不能覆盖
+    SERVER_MANAGED_CONFIG_KEYS = frozenset(
+        ("top", "suggestions", "last_active_time", "ai_avatar_url")
+    )
+
     @staticmethod
     async def handle_iwin_message(ws: ClientConnection, data: str):
         """处理iWin消息"""
@@ -57,8 +65,10 @@ class MessageHandler:
                     )
                 )
             elif type == "create_new_session":
-                session_id, message_id, system_prompt = MessageHandler.create_session()
-                await SessionManager.send_all_sessions()
+                session_id, message_id, system_prompt = (
+                    await MessageHandler.create_session()
+                )
+                await SessionManager.broadcast_session_changes()
                 await SessionManager.broadcast_windows(
                     json.dumps(
                         {
@@ -122,6 +132,8 @@ class MessageHandler:
                 "update_theme": MessageHandler._handle_update_theme,
                 "update_system_config": MessageHandler._handle_update_system_config,
                 "get_all_sessions": MessageHandler._handle_get_all_sessions,
+                "get_session_list": MessageHandler._handle_get_session_list,
+                "sync_sessions": MessageHandler._handle_sync_sessions,
                 "create_session": MessageHandler._handle_create_session,
                 "copy_session": MessageHandler._handle_copy_session,
                 "copy_session_and_message": MessageHandler._handle_copy_session_and_message,
@@ -129,6 +141,7 @@ class MessageHandler:
                 "delete_session": MessageHandler._handle_delete_session,
                 "update_session_top": MessageHandler._handle_update_session_top,
                 "parse_create_session": MessageHandler._handle_parsed_create_session,
+                "search_messages": MessageHandler._handle_search_messages,
             }
 
             if message_type in handlers:
@@ -158,7 +171,20 @@ class MessageHandler:
         await SessionManager.send_all_sessions()
 
     @staticmethod
-    def create_session():
+    async def _handle_get_session_list(websocket: WebSocket, message: dict):
+        data = message["data"]
+        await SessionManager.send_session_list(
+            websocket, data.get("offset", 0), data.get("limit", -1)
+        )
+
+    @staticmethod
+    async def _handle_sync_sessions(websocket: WebSocket, message: dict):
+        await SessionManager.send_session_changes(
+            websocket, message["data"].get("revision", 0)
+        )
+
+    @staticmethod
+    async def create_session():
         system_prompt = Utils.AI_CONFIG_DEFAULT["system_prompt"]
         parsed_system_prompt = json.dumps({"sentences": [], "html": ""})
         title = Utils.AI_CONFIG_DEFAULT["chat_title"]
@@ -168,14 +194,14 @@ class MessageHandler:
         config["last_active_time"] = time.time()
         config["suggestions"] = []
 
-        session_id, message_id = Utils.api.create_new_session(
+        session_id, message_id = await Utils.async_api.create_new_session(
             title, config, system_prompt, parsed_system_prompt
         )
         return session_id, message_id, system_prompt
 
     @staticmethod
     async def _handle_create_session(websocket: WebSocket, message: dict):
-        session_id, message_id, system_prompt = MessageHandler.create_session()
+        session_id, message_id, system_prompt = await MessageHandler.create_session()
 
         response = {
             "type": "parse_create_session",
@@ -190,20 +216,23 @@ class MessageHandler:
     @staticmethod
     async def _handle_copy_session(websocket: WebSocket, message: dict):
         session_id = message["data"]["session_id"]
-        new_session_id = Utils.api.copy_session(session_id)
+        new_session_id = await Utils.async_api.copy_session(session_id)
 
         if new_session_id is None:
             raise ValueError("会话复制失败")
 
-        title = Utils.api.get_session_title(session_id)
-        config = Utils.api.get_session_ai_config(session_id)
-        config["ai_avatar_url"] = Utils.Avatar.copy_session_ai_avatar(
-            config["ai_avatar_url"], new_session_id
-        )
-        config["last_active_time"] = time.time()
-        config["suggestions"] = []
-        config["top"] = False
-        Utils.api.update_session_ai_config(new_session_id, config)
+        title = await Utils.async_api.get_session_title(session_id)
+        config = await Utils.async_api.get_session_ai_config(session_id)
+        patch = {
+            "ai_avatar_url": Utils.Avatar.copy_session_ai_avatar(
+                config["ai_avatar_url"], new_session_id
+            ),
+            "last_active_time": time.time(),
+            "suggestions": [],
+            "top": False,
+        }
+        await Utils.async_api.patch_session_config(new_session_id, patch)
+        config.update(patch)
 
         msg = {
             "type": "new_session",
@@ -214,23 +243,27 @@ class MessageHandler:
             },
         }
         await websocket.send_text(json.dumps(msg))
+        await SessionManager.broadcast_session_changes()
 
     @staticmethod
     async def _handle_copy_session_and_message(websocket: WebSocket, message: dict):
         session_id = message["data"]["session_id"]
-        new_session_id = Utils.api.copy_session_and_messages(session_id)
+        new_session_id = await Utils.async_api.copy_session_and_messages(session_id)
 
         if new_session_id is None:
             raise ValueError("会话复制失败")
 
-        title = Utils.api.get_session_title(session_id)
-        config = Utils.api.get_session_ai_config(session_id)
-        config["ai_avatar_url"] = Utils.Avatar.copy_session_ai_avatar(
-            config["ai_avatar_url"], new_session_id
-        )
-        config["last_active_time"] = time.time()
-        config["top"] = False
-        Utils.api.update_session_ai_config(new_session_id, config)
+        title = await Utils.async_api.get_session_title(session_id)
+        config = await Utils.async_api.get_session_ai_config(session_id)
+        patch = {
+            "ai_avatar_url": Utils.Avatar.copy_session_ai_avatar(
+                config["ai_avatar_url"], new_session_id
+            ),
+            "last_active_time": time.time(),
+            "top": False,
+        }
+        await Utils.async_api.patch_session_config(new_session_id, patch)
+        config.update(patch)
 
         msg = {
             "type": "new_session",
@@ -241,6 +274,7 @@ class MessageHandler:
             },
         }
         await websocket.send_text(json.dumps(msg))
+        await SessionManager.broadcast_session_changes()
 
     @staticmethod
     async def _handle_update_session_title(websocket: WebSocket, message: dict):
@@ -248,14 +282,17 @@ class MessageHandler:
         title = message["data"]["title"]
 
         await SessionManager.update_title(session_id, title)
-        Utils.api.update_session_property(session_id, "auto_gen_title", False)
+        await Utils.async_api.update_session_property(
+            session_id, "auto_gen_title", False
+        )
         await SessionManager.send_session_config(session_id)
 
     @staticmethod
     async def _handle_delete_session(websocket: WebSocket, message: dict):
         session_id = message["data"]["session_id"]
-        Utils.api.delete_session(session_id)
+        materialized = await Utils.async_api.delete_session(session_id)
         Utils.Avatar.remove_session_avatar(session_id)
+        await SessionManager.refresh_session_messages(materialized)
 
         msg = {
             "type": "delete_session",
@@ -264,13 +301,14 @@ class MessageHandler:
             },
         }
         await websocket.send_text(json.dumps(msg))
+        await SessionManager.broadcast_session_changes()
 
     @staticmethod
     async def _handle_update_session_top(websocket: WebSocket, message: dict):
         session_id = message["data"]["session_id"]
         top = message["data"]["top"]
 
-        Utils.api.update_session_top(session_id, top)
+        await Utils.async_api.update_session_top(session_id, top)
 
         msg = {
             "type": "update_session_top",
@@ -280,13 +318,14 @@ class MessageHandler:
             },
         }
         await SessionManager.broadcast_spa(json.dumps(msg))
+        await SessionManager.broadcast_session_changes()
 
     @staticmethod
     async def _handle_parsed_create_session(websocket: WebSocket, message: dict):
         data = message["data"]
         message_id = data["message_id"]
         session_id = data["session_id"]
-        config = Utils.api.get_session_ai_config(session_id)
+        config = await Utils.async_api.get_session_ai_config(session_id)
 
         title = Utils.AI_CONFIG_DEFAULT["chat_title"]
         system_prompt = Utils.AI_CONFIG_DEFAULT["system_prompt"]
@@ -295,7 +334,9 @@ class MessageHandler:
             "html": data["html"],
         }
 
-        Utils.api.update_message(message_id, parsed_text=json.dumps(parsed_text))
+        await Utils.async_api.update_message(
+            message_id, parsed_text=json.dumps(parsed_text)
+        )
 
         msg = {
             "type": "new_session",
@@ -307,6 +348,23 @@ class MessageHandler:
             },
         }
         await websocket.send_text(json.dumps(msg))
+        await SessionManager.broadcast_session_changes()
+
+    @staticmethod
+    async def _handle_search_messages(websocket: WebSocket, message: dict):
+        data = message["data"]
+        query = data["query"]
+        results = await Utils.async_api.search_messages(
+            query, data.get("limit", 20), data.get("session_id")
+        )
+        msg = {
+            "type": "search_results",
+            "data": {
+                "query": query,
+                "results": results,
+            },
+        }
+        await websocket.send_text(json.dumps(msg))
 
     @staticmethod
     async def handle_session_message(
@@ -324,9 +382,11 @@ class MessageHandler:
             handlers = {
                 "toggle_floating_pin": MessageHandler._handle_toggle_floating_pin,
                 "user_input": MessageHandler._handle_user_input,
+                "load_more": MessageHandler._handle_load_more,
                 "parsed_user_message": MessageHandler._handle_parsed_user_message,
                 "parsed_ai_response": MessageHandler._handle_parsed_ai_response,
                 "stop_response": MessageHandler._handle_stop_response,
+                "stream_resync": MessageHandler._handle_stream_resync,
                 "update_session_ai_config": MessageHandler._handle_update_session_config,
                 "update_message": MessageHandler._handle_update_message,
                 "delete_audio_files": MessageHandler._handle_delete_audio_files,
@@ -364,23 +424,38 @@ class MessageHandler:
         await Utils.iwin_ws_client.send(msg)
 
     @staticmethod
-    async def _handle_user_input(websocket: WebSocket, session_id: int, message: dict):
-        def handle_user_input():
-            asyncio.run(
-                MessageHandler._handle_user_input_imple(websocket, session_id, message)
-            )
+    async def _handle_load_more(websocket: WebSocket, session_id: int, message: dict):
+        data = message["data"]
+        limit = data.get("limit", SessionManager.SESSION_MESSAGES_PAGE_SIZE)
+        await SessionManager.send_session_messages_page(
+            websocket, session_id, limit, data.get("before")
+        )
 
-        threading.Thread(
-            target=handle_user_input,
-            daemon=True,
-        ).start()
+    @staticmethod
+    async def _handle_user_input(websocket: WebSocket, session_id: int, message: dict):
+        # 交给调度器：同一会话按顺序执行，并受排队上限约束
+        accepted = ChatScheduler.submit(
+            session_id,
+            lambda: MessageHandler._handle_user_input_imple(
+                websocket, session_id, message
+            ),
+        )
+        if not accepted:
+            msg = {
+                "type": "stream_response",
+                "data": {
+                    "message_id": -1,
+                    "is_streaming": False,
+                    "is_chat_error": True,
+                    "response": "Error: 服务繁忙，请稍后再试",
+                },
+            }
+            await websocket.send_text(json.dumps(msg))
 
     @staticmethod
     async def _handle_user_input_imple(
         websocket: WebSocket, session_id: int, message: dict
     ):
-        global thread_api
-        thread_api = Utils.create_api()
         user_message = message["data"]["user_message"]
 
         async def user_message_callback(message_id: int):
@@ -397,29 +472,53 @@ class MessageHandler:
             await websocket.send_text(json.dumps(msg))
 
         is_streaming_closed = False
+        # 客户端以 ?stream_delta=1 连接时只推送增量文本
+        stream_delta = websocket.query_params.get("stream_delta") == "1"
+        encoder = None
+        # 开启 auto_play_streaming 时由服务端分句，边生成边朗读
+        ai_config = await Utils.async_api.get_session_ai_config(session_id)
+        speech = None
+
+        async def speech_progress_callback(message_id: int, index: int, text: str):
+            msg = {
+                "type": "streaming_speech",
+                "data": {"message_id": message_id, "index": index, "text": text},
+            }
+            await websocket.send_text(json.dumps(msg))
 
         async def assistant_response_callback(
             message_id: int, response: str, is_streaming: bool, error: bool = False
         ):
-            nonlocal is_streaming_closed
+            nonlocal is_streaming_closed, encoder, speech
             if is_streaming_closed:
                 return
             if not is_streaming:
                 is_streaming_closed = True
+            if error:
+                if speech is not None:
+                    speech.finish()
+            elif ai_config.get("auto_play_streaming"):
+                if speech is None or speech.message_id != message_id:
+                    speech = StreamingSpeech(
+                        Utils.speaker,
+                        session_id,
+                        message_id,
+                        ai_config["tts_voice"],
+                        ai_config["speech_rate"],
+                        functools.partial(speech_progress_callback, message_id),
+                    )
+                speech.feed(response, not is_streaming)
+            if encoder is None or encoder.message_id != message_id:
+                encoder = StreamFrameEncoder(message_id, stream_delta)
             msg = {
                 "type": "stream_response",
-                "data": {
-                    "message_id": message_id,
-                    "is_streaming": is_streaming,
-                    "is_chat_error": error,
-                    "response": response,
-                },
+                "data": encoder.encode(response, is_streaming, error),
             }
             await websocket.send_text(json.dumps(msg))
 
         WITH_SYSTEM_PROMPT = True
 
-        response_dict = await thread_api.chat(
+        response_dict = await Utils.api.chat(
             WITH_SYSTEM_PROMPT,
             session_id,
             user_message,
@@ -446,64 +545,118 @@ class MessageHandler:
         if response is None:
             return
 
-        async def system_handle():
-            system_info = {}
-            if WITH_SYSTEM_PROMPT:
-                system_info = response_dict
-            else:
-                system_prompt_content = thread_api.get_session_system_message(
-                    session_id
-                )
-                system_ai_response = thread_api.system_chat(
-                    system_prompt_content, user_message, response
+        # 标题、建议等在后台处理，回复在最后一个字推送后即结束
+        if WITH_SYSTEM_PROMPT:
+            system_info = response_dict
+            if "secondary_response" in system_info:
+                secondary_response = system_info["secondary_response"]
+                SessionJobQueue.schedule(
+                    session_id,
+                    f"secondary_response:{message_id}",
+                    lambda: MessageHandler._apply_secondary_response(
+                        websocket, message_id, secondary_response
+                    ),
+                    delay=0,
                 )
-                if system_ai_response is None:
-                    return
-                system_info = json.loads(system_ai_response)
+            SessionJobQueue.schedule(
+                session_id,
+                "system_info",
+                lambda: MessageHandler._apply_system_info(
+                    websocket, session_id, system_info
+                ),
+            )
+        else:
+            SessionJobQueue.schedule(
+                session_id,
+                "system_info",
+                lambda: MessageHandler._generate_system_info(
+                    websocket, session_id, user_message, response
+                ),
+            )
 
-            title = system_info["title"]
-            suggestions = system_info["suggestions"]
-            logger.info("标题:%s, 建议:%s", title, suggestions)
+    @staticmethod
+    async def _generate_system_info(
+        websocket: WebSocket, session_id: int, user_message: str, response: str
+    ):
+        """单独请求系统模型生成标题和建议"""
+        system_prompt_content = await Utils.async_api.get_session_system_message(
+            session_id
+        )
+        try:
+            # 系统模型请求耗时较长，使用默认线程池以免占用数据库线程池
+            system_ai_response = await asyncio.get_running_loop().run_in_executor(
+                None,
+                Utils.api.system_chat,
+                system_prompt_content,
+                user_message,
+                response,
+            )
+            if system_ai_response is None:
+                return
+            system_info = json.loads(system_ai_response)
+        except Exception as e:
+            # 只重试上游请求，之后的写入和推送不重复执行
+            raise RetryableJobError(f"生成标题和建议失败: {e}") from e
+        await MessageHandler._apply_system_info(websocket, session_id, system_info)
 
-            config = thread_api.get_session_ai_config(session_id)
-            auto_gen_title = config["auto_gen_title"]
-            if auto_gen_title:
-                await SessionManager.update_title(session_id, title, thread_api)
+    @staticmethod
+    async def _apply_system_info(
+        websocket: WebSocket, session_id: int, system_info: dict
+    ):
+        """更新会话标题和建议并通知客户端"""
+        title = system_info["title"]
+        suggestions = system_info["suggestions"]
+        logger.info("标题:%s, 建议:%s", title, suggestions)
 
-            if "secondary_response" in system_info:
-                secondary_response = system_info["secondary_response"]
-                message = {
-                    "type": "secondary_response",
-                    "data": {
-                        "message_id": message_id,
-                        "secondary_response": secondary_response,
-                    },
-                }
-                await websocket.send_text(json.dumps(message))
-                parsed_text = thread_api.get_parsed_text(message_id)
-                if parsed_text:
-                    parsed_text["secondary_response"] = secondary_response
-                    thread_api.update_message(
-                        message_id,
-                        parsed_text=json.dumps(parsed_text, ensure_ascii=False),
-                    )
+        config = await Utils.async_api.get_session_ai_config(session_id)
+        auto_gen_title = config["auto_gen_title"]
+        if auto_gen_title:
+            await SessionManager.update_title(session_id, title)
 
-            msg = {
-                "type": "session_suggestions",
-                "data": {
-                    "session_id": session_id,
-                    "suggestions": suggestions,
-                },
-            }
-            await websocket.send_text(json.dumps(msg))
+        await Utils.async_api.patch_session_config(
+            session_id,
+            {"last_active_time": time.time(), "suggestions": suggestions},
+        )
+        await SessionManager.send_session_config(session_id)
+        await SessionManager.broadcast_session_changes()
+
+        msg = {
+            "type": "session_suggestions",
+            "data": {
+                "session_id": session_id,
+                "suggestions": suggestions,
+            },
+        }
+        await MessageHandler._send_if_connected(websocket, msg)
 
-            config["last_active_time"] = time.time()
-            config["suggestions"] = suggestions
-            thread_api.update_session_ai_config(session_id, config)
-            await SessionManager.send_session_config(session_id, api=thread_api)
-            await SessionManager.send_all_sessions(api=thread_api)
+    @staticmethod
+    async def _apply_secondary_response(
+        websocket: WebSocket, message_id: int, secondary_response: str
+    ):
+        """保存并推送消息的第二回复"""
+        parsed_text = await Utils.async_api.get_parsed_text(message_id)
+        if parsed_text:
+            parsed_text["secondary_response"] = secondary_response
+            await Utils.async_api.update_message(
+                message_id,
+                parsed_text=json.dumps(parsed_text, ensure_ascii=False),
+            )
+        message = {
+            "type": "secondary_response",
+            "data": {
+                "message_id": message_id,
+                "secondary_response": secondary_response,
+            },
+        }
+        await MessageHandler._send_if_connected(websocket, message)
 
-        await system_handle()
+    @staticmethod
+    async def _send_if_connected(websocket: WebSocket, message: dict):
+        """后台任务完成后推送给发起请求的客户端，客户端已断开时忽略"""
+        try:
+            await websocket.send_text(json.dumps(message))
+        except Exception as e:
+            logger.info(f"客户端已断开，未推送 {message['type']}: {e}")
 
     @staticmethod
     async def _handle_parsed_user_message(
@@ -512,7 +665,7 @@ class MessageHandler:
         message_id = message["data"]["message_id"]
         sentences = message["data"]["sentences"]
         html = message["data"]["html"]
-        Utils.api.update_message(
+        await Utils.async_api.update_message(
             message_id,
             json.dumps({"sentences": sentences, "html": html}, ensure_ascii=False),
         )
@@ -525,26 +678,41 @@ class MessageHandler:
         sentences = message["data"]["sentences"]
         html = message["data"]["html"]
         raw_text = message["data"]["raw_text"]
-        Utils.api.update_message(
+        config = await Utils.async_api.get_session_ai_config(session_id)
+        await Utils.async_api.update_message(
             message_id,
             json.dumps({"sentences": sentences, "html": html}, ensure_ascii=False),
             raw_text=raw_text,
+            model=config.get("model"),
         )
 
+    @staticmethod
+    async def _handle_stream_resync(
+        websocket: WebSocket, session_id: int, message: dict
+    ):
+        StreamFrameEncoder.request_snapshot(message["data"]["message_id"])
+
     @staticmethod
     async def _handle_stop_response(
         websocket: WebSocket, session_id: int, message: dict
     ):
-        global thread_api
-        if thread_api is not None:
-            thread_api.stop_response()
+        # 未指定 message_id 时取消该会话所有进行中的生成
+        message_id = (message.get("data") or {}).get("message_id")
+        # 先取消边生成边朗读，结束帧到达时不再朗读已生成的部分
+        StreamingSpeech.cancel_session(session_id, message_id)
+        await GenerationRegistry.cancel(session_id, message_id)
 
     @staticmethod
     async def _handle_update_session_config(
         websocket: WebSocket, session_id: int, message: dict
     ):
-        ai_config = message["data"]["ai_config"]
-        Utils.api.update_session_ai_config(session_id, ai_config)
+        # 只更新用户可编辑的配置项，避免覆盖后台任务同时写入的建议、活动时间等
+        patch = {
+            key: value
+            for key, value in message["data"]["ai_config"].items()
+            if key not in MessageHandler.SERVER_MANAGED_CONFIG_KEYS
+        }
+        await Utils.async_api.patch_session_config(session_id, patch)
         await SessionManager.send_session_config(session_id)
 
     @staticmethod
@@ -556,17 +724,24 @@ class MessageHandler:
         sentences = message["data"]["sentences"]
         html = message["data"]["html"]
 
-        Utils.speaker.remove_audio_directory(session_id, message_id)
         parsed_text = {"sentences": sentences, "html": html}
 
-        Utils.api.update_message(
-            message_id, raw_text=raw_text, parsed_text=json.dumps(parsed_text)
+        # 编辑继承自父会话的消息时，实际修改的是本会话中的副本
+        edited_id, materialized = await Utils.async_api.edit_message(
+            session_id, message_id, raw_text, json.dumps(parsed_text)
+        )
+        if edited_id is None:
+            return
+        await Utils.async_api.run(
+            Utils.speaker.remove_audio_directory, session_id, edited_id
         )
+        # 先刷新被实体化的会话，客户端拿到副本的ID后再确认修改
+        await SessionManager.refresh_session_messages(materialized)
 
         msg = {
             "type": "update_message",
             "data": {
-                "message_id": message_id,
+                "message_id": edited_id,
                 "raw_text": raw_text,
             },
         }
@@ -577,7 +752,19 @@ class MessageHandler:
         websocket: WebSocket, session_id: int, message: dict
     ):
         message_id = message["data"]["message_id"]
-        Utils.speaker.remove_audio_directory(session_id, message_id)
+        await Utils.async_api.run(
+            Utils.speaker.remove_audio_directory, session_id, message_id
+        )
+        # 共享缓存中的音频按内容存储，只删除该消息在当前音色和语速下的音频
+        sentences = await Utils.async_api.get_sentences(message_id)
+        if sentences:
+            ai_config = await Utils.async_api.get_session_ai_config(session_id)
+            await Utils.async_api.run(
+                Utils.speaker.forget_audio,
+                sentences,
+                ai_config["tts_voice"],
+                ai_config["speech_rate"],
+            )
 
     @staticmethod
     async def _handle_delete_message(
@@ -585,8 +772,10 @@ class MessageHandler:
     ):
         message_id = message["data"]["message_id"]
 
-        Utils.api.delete_message(message_id)
-        Utils.speaker.remove_audio_directory(session_id, message_id)
+        materialized = await Utils.async_api.remove_message(session_id, message_id)
+        await Utils.async_api.run(
+            Utils.speaker.remove_audio_directory, session_id, message_id
+        )
 
         msg = {
             "type": "delete_message",
@@ -595,6 +784,7 @@ class MessageHandler:
             },
         }
         await websocket.send_text(json.dumps(msg))
+        await SessionManager.refresh_session_messages(materialized)
 
     @staticmethod
     async def _handle_start_speech_recognize(
@@ -630,11 +820,11 @@ class MessageHandler:
         sentence_id_start = message["data"]["sentence_id_start"]
         sentence_id_end = message["data"]["sentence_id_end"]
 
-        ai_config = Utils.api.get_session_ai_config(session_id)
+        ai_config = await Utils.async_api.get_session_ai_config(session_id)
         voice_name = ai_config["tts_voice"]
         speech_rate = ai_config["speech_rate"]
 
-        sentences = Utils.api.get_sentences(message_id)
+        sentences = await Utils.async_api.get_sentences(message_id)
         if sentences is None:
             logger.warning(f"消息ID:{message_id} 未找到句子")
             return
@@ -660,11 +850,11 @@ class MessageHandler:
         message_id = message["data"]["message_id"]
         sentence_id = message["data"]["sentence_id"]
 
-        ai_config = Utils.api.get_session_ai_config(session_id)
+        ai_config = await Utils.async_api.get_session_ai_config(session_id)
         voice_name = ai_config["tts_voice"]
         speech_rate = ai_config["speech_rate"]
 
-        sentences = Utils.api.get_sentences(message_id)
+        sentences = await Utils.async_api.get_sentences(message_id)
         if sentences is None:
             logger.warning(f"消息ID:{message_id} 未找到句子")
             return
@@ -709,11 +899,11 @@ class MessageHandler:
         message_id = message["data"]["message_id"]
         sentence_id_start = message["data"]["sentence_id"]
 
-        ai_config = Utils.api.get_session_ai_config(session_id)
+        ai_config = await Utils.async_api.get_session_ai_config(session_id)
         voice_name = ai_config["tts_voice"]
         speech_rate = ai_config["speech_rate"]
 
-        sentences = Utils.api.get_sentences(message_id)
+        sentences = await Utils.async_api.get_sentences(message_id)
         if sentences is None:
             logger.warning(f"消息ID:{message_id} 未找到句子")
             return
@@ -743,12 +933,12 @@ class MessageHandler:
         else:
             message_id = message["data"]["message_id"]
 
-            ai_config = Utils.api.get_session_ai_config(session_id)
+            ai_config = await Utils.async_api.get_session_ai_config(session_id)
             voice_name = ai_config["tts_voice"]
             speech_rate = ai_config["speech_rate"]
             sentence_id_start = 0
 
-            sentences = Utils.api.get_sentences(message_id)
+            sentences = await Utils.async_api.get_sentences(message_id)
             if sentences is not None:
                 await MessageHandler._play_sentences_impl(
                     websocket,
@@ -763,6 +953,8 @@ class MessageHandler:
     @staticmethod
     async def _handle_stop(websocket: WebSocket, session_id: int, message: dict):
         Utils.speaker.stop_playback()
+        # 同时停止边生成边朗读中尚未播放的句子
+        Utils.speaker.stop_generating()
 
     @staticmethod
     async def _play_sentences_impl(
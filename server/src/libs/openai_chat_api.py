@@ -1,43 +1,59 @@
-import openai
 import json
-import ast
+import math
 import time
+import asyncio
+import threading
+from concurrent.futures import Executor
 from datetime import datetime
-from typing import List, Dict, Any, Optional, Callable, Union
+from typing import List, Dict, Any, Optional, Callable, Union, Tuple, Set, AsyncIterator
 from functools import partial
 from libs.chat_database import ChatDatabase
+from libs.openai_client_pool import OpenAIClientPool
+from libs.provider_router import ProviderRouter, RoutedStream
+from libs.json_stream_parser import JsonStreamParser
+from libs.stream_frames import StreamCoalescer
+from libs.stream_trace import StreamTrace, StreamTraceRecorder
+from libs.tokenizer import get_tokenizer
+from libs.generation_registry import (
+    Generation,
+    GenerationCancelled,
+    GenerationRegistry,
+)
 from libs.log_config import logger
 from libs.config import UtilsBase
 
 
 class OpenAIChatAPI:
+    # 聊天格式中每条消息额外占用的token数（角色、分隔符）
+    MESSAGE_TOKEN_OVERHEAD = 4
+    # 每次滚动摘要请求最多合并的消息数
+    SUMMARY_BATCH_MESSAGES = 40
+    # 正在生成滚动摘要的会话，同一会话同时只运行一个摘要任务
+    _compacting: Set[int] = set()
+    _compacting_lock = threading.Lock()
+
     def __init__(
         self,
         db: ChatDatabase,
+        executor: Optional[Executor] = None,
     ):
         self.db = db
-        self._stop_response = False
+        # 聊天流程运行在主事件循环中，其中的数据库操作放到该线程池中执行
+        self.executor = executor
         self.init_system_ai_config()
 
     def init_system_ai_config(self):
-        self.system_client = openai.OpenAI(
-            base_url=UtilsBase.SYSTEM_AI_CONFIG["base_url"],
-            api_key=UtilsBase.SYSTEM_AI_CONFIG["api_key"],
+        self.system_client = OpenAIClientPool.get_sync(
+            UtilsBase.SYSTEM_AI_CONFIG["base_url"],
+            UtilsBase.SYSTEM_AI_CONFIG["api_key"],
         )
         self.system_model = UtilsBase.SYSTEM_AI_CONFIG["model"]
         self.system_temperature = 0.5
 
-    @staticmethod
-    def unescape_string(s: str) -> Optional[str]:
-        """安全地反转义字符串，处理各种转义字符"""
-        try:
-            return ast.literal_eval(f'"{s}"')
-        except Exception:
-            return None
-
-    def stop_response(self) -> None:
-        """停止当前的响应"""
-        self._stop_response = True
+    async def _run_sync(self, func: Callable, *args: Any) -> Any:
+        """在线程池中执行同步的数据库操作，避免阻塞事件循环"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args))
 
     def _create_system_prompt(
         self,
@@ -73,73 +89,112 @@ class OpenAIChatAPI:
         max_messages: int = 100,
     ) -> List[Dict[str, str]]:
         """获取用于提示的消息列表，考虑token限制和消息顺序"""
-        messages = self.db.get_session_messages(session_id, max_messages)
-        messages = self._sort_messages(messages)
+        return self._select_prompt_messages(
+            with_system_prompt, session_id, config, max_tokens, max_messages
+        )[0]
+
+    def _select_prompt_messages(
+        self,
+        with_system_prompt: bool,
+        session_id: int,
+        config: Dict[str, Any],
+        max_tokens: int,
+        max_messages: int,
+    ) -> Tuple[List[Dict[str, str]], Optional[int]]:
+        """选择提示消息，返回 (提示消息, 被挤出上下文且未概括的最新消息seq或None)
+
+        token数按会话模型对应的分词器统计并缓存在消息上，
+        选择上下文时只需从最新消息开始累加缓存的整数。
+        开启滚动摘要（rolling_summary）时，已被摘要概括的消息以摘要代替。
+        """
+        tokenizer = get_tokenizer(config.get("model"))
+        messages = self.db.get_session_prompt_messages(session_id, max_messages)
+        secondary_prompt = (
+            config.get("secondary_prompt")
+            if config.get("secondary_prompt_switch")
+            else None
+        )
+        summary = None
+        if config.get("rolling_summary"):
+            summary = self.db.get_conversation_summary(session_id)
+        covered_seq = summary["covered_seq"] if summary else 0
 
         system_messages = []
         user_assistant_messages = []
+        message_seqs = []
+        message_tokens = []
+        stale_counts = []
 
         # 分离系统消息和用户/助手消息
-        has_system_prompt = False
         for msg in messages:
             role = msg["role"]
             raw_text = msg["raw_text"]
             if role == "system":
-                has_system_prompt = True
                 system_messages.append(
                     {
                         "role": role,
                         "content": self._create_system_prompt(
-                            raw_text,
-                            with_system_prompt,
-                            (
-                                config.get("secondary_prompt")
-                                if config.get("secondary_prompt_switch")
-                                else None
-                            ),
+                            raw_text, with_system_prompt, secondary_prompt
                         ),
                     }
                 )
-            else:
-                user_assistant_messages.append({"role": role, "content": raw_text})
+                continue
+            if msg["seq"] <= covered_seq:
+                continue
+
+            user_assistant_messages.append({"role": role, "content": raw_text})
+            message_seqs.append(msg["seq"])
+            token_count = msg["token_count"]
+            if token_count is None or msg["token_family"] != tokenizer.name:
+                # 尚未统计或换了分词器，补算并写回缓存
+                token_count = tokenizer.count(raw_text or "")
+                stale_counts.append((msg["id"], token_count, tokenizer.name))
+            message_tokens.append(token_count + self.MESSAGE_TOKEN_OVERHEAD)
+
+        if stale_counts:
+            self.db.set_message_token_counts(stale_counts)
 
         # 如果没有系统消息，添加默认系统提示
-        if not has_system_prompt:
+        if not system_messages:
             system_prompt = self.get_session_system_message(session_id)
             system_messages.append(
                 {
                     "role": "system",
                     "content": self._create_system_prompt(
-                        system_prompt or "",
-                        with_system_prompt,
-                        (
-                            config.get("secondary_prompt")
-                            if config.get("secondary_prompt_switch")
-                            else None
-                        ),
+                        system_prompt or "", with_system_prompt, secondary_prompt
                     ),
                 }
             )
+        if summary:
+            system_messages.append(
+                {
+                    "role": "system",
+                    "content": f"此前对话的摘要：{summary['summary']}",
+                }
+            )
         # 构建最终提示消息，考虑token限制
-        prompt_messages = system_messages
-        used_tokens = sum(len(msg["content"]) // 4 for msg in prompt_messages)
-
-        # 从最新消息开始添加，直到达到token限制
-        reversed_messages = user_assistant_messages[::-1]
-        messages_to_send = []
+        used_tokens = sum(
+            tokenizer.count(msg["content"]) + self.MESSAGE_TOKEN_OVERHEAD
+            for msg in system_messages
+        )
 
-        for msg in reversed_messages:
-            msg_tokens = len(msg["content"]) // 4
-            if used_tokens + msg_tokens > max_tokens:
-                break
-            messages_to_send.append(msg)
-            used_tokens += msg_tokens
+        # 从最新消息开始累加，直到达到token限制
+        start = len(user_assistant_messages)
+        while start > 0 and used_tokens + message_tokens[start - 1] <= max_tokens:
+            start -= 1
+            used_tokens += message_tokens[start]
 
-        # 恢复正确顺序
-        messages_to_send = messages_to_send[::-1]
+        # 被挤出的消息：窗口内没放下的，或窗口已满时窗口之前可能还有未概括的消息
+        evicted_seq = None
+        if config.get("rolling_summary"):
+            if start > 0:
+                evicted_seq = message_seqs[start - 1]
+            elif len(messages) >= max_messages > 0:
+                evicted_seq = messages[0]["seq"] - 1
+            if evicted_seq is not None and evicted_seq <= covered_seq:
+                evicted_seq = None
 
-        return prompt_messages + messages_to_send
-        # return messages_to_send + prompt_messages
+        return system_messages + user_assistant_messages[start:], evicted_seq
 
     def _create_system_chat_system_prompt(self) -> str:
         """创建用于系统聊天的系统提示词"""
@@ -211,6 +266,85 @@ class OpenAIChatAPI:
         logger.info(completion.choices[0].message.content)
         return completion.choices[0].message.content
 
+    def _create_summary_system_prompt(self, max_tokens: int) -> str:
+        """创建用于滚动摘要的系统提示词"""
+        return f"""
+        你的任务是维护一段对话的滚动摘要。你会收到已有的摘要（可能为空）以及之后新增的对话（json格式）。
+        请把新增对话的内容合并进摘要，保留关键事实、用户的偏好和要求、已得出的结论以及尚未解决的问题，删去寒暄和重复内容。
+        摘要使用与对话相同的语种，用第三人称客观陈述，长度不超过{max_tokens}个token。直接输出摘要正文，不要添加任何额外说明。
+        """
+
+    def summarize_history(
+        self,
+        previous_summary: Optional[str],
+        messages: List[Dict[str, Any]],
+        max_tokens: int,
+    ) -> Optional[str]:
+        """用系统模型把新增的历史消息合并进已有摘要"""
+        content = [
+            {"role": msg["role"], "content": msg["raw_text"]} for msg in messages
+        ]
+        prompt_messages = [
+            {
+                "role": "system",
+                "content": self._create_summary_system_prompt(max_tokens),
+            },
+            {
+                "role": "user",
+                "content": json.dumps(
+                    {"summary": previous_summary or "", "messages": content},
+                    ensure_ascii=False,
+                ),
+            },
+        ]
+        logger.info("----- 滚动摘要请求 -----")
+        completion = self.system_client.chat.completions.create(
+            model=self.system_model,
+            messages=prompt_messages,  # type: ignore
+            temperature=self.system_temperature,
+            max_tokens=max_tokens * 2,
+        )
+        summary = completion.choices[0].message.content
+        return summary.strip() if summary else None
+
+    def compact_session_history(
+        self, session_id: int, upto_seq: int, config: Dict[str, Any]
+    ) -> None:
+        """把 seq 不大于 upto_seq 且尚未概括的消息分批合并进会话的滚动摘要"""
+        with OpenAIChatAPI._compacting_lock:
+            if session_id in OpenAIChatAPI._compacting:
+                return
+            OpenAIChatAPI._compacting.add(session_id)
+        try:
+            tokenizer = get_tokenizer(config.get("model"))
+            max_tokens = config.get("summary_max_tokens", 500)
+            summary = self.db.get_conversation_summary(session_id)
+            text = summary["summary"] if summary else None
+            covered_seq = summary["covered_seq"] if summary else 0
+            while covered_seq < upto_seq:
+                messages = self.db.get_session_messages_after(
+                    session_id, covered_seq, upto_seq, self.SUMMARY_BATCH_MESSAGES
+                )
+                if not messages:
+                    break
+                text = self.summarize_history(text, messages, max_tokens)
+                if not text:
+                    break
+                covered_seq = messages[-1]["seq"]
+                self.db.save_conversation_summary(
+                    session_id,
+                    text,
+                    covered_seq,
+                    tokenizer.count(text),
+                    tokenizer.name,
+                )
+                logger.info(f"会话 {session_id} 滚动摘要已更新至 seq {covered_seq}")
+        except Exception as e:
+            logger.error(f"生成滚动摘要失败: {e}", exc_info=True)
+        finally:
+            with OpenAIChatAPI._compacting_lock:
+                OpenAIChatAPI._compacting.discard(session_id)
+
     async def chat(
         self,
         with_system_prompt: bool,
@@ -220,15 +354,22 @@ class OpenAIChatAPI:
         user_message_callback_async_: Callable,
         assistant_response_callback_async_: Callable,
     ) -> Dict:
+        # 获取会话配置
+        ai_config = await self._run_sync(self.get_session_ai_config, session_id)
+
         # 保存用户消息到数据库
-        user_message_id = self.db.add_message(
-            session_id=session_id,
-            role="user",
-            raw_text=user_message,
-            parsed_text=parsed_text,
+        user_message_id = await self._run_sync(
+            self.add_message,
+            session_id,
+            "user",
+            user_message,
+            parsed_text,
+            ai_config.get("model"),
         )
         await user_message_callback_async_(user_message_id)
 
+        # 登记本次生成，用于按会话/消息取消
+        generation = GenerationRegistry.start(session_id, ai_config.get("model", ""))
         message_id = -1
 
         async def assistant_response_callback_async(
@@ -236,8 +377,12 @@ class OpenAIChatAPI:
         ):
             nonlocal message_id
             if message_id == -1:
-                message_id = self.add_assistant_message(
-                    session_id, "", json.dumps({"sentences": [], "html": ""})
+                message_id = await self._run_sync(
+                    self.add_assistant_message,
+                    session_id,
+                    "",
+                    json.dumps({"sentences": [], "html": ""}),
+                    ai_config.get("model"),
                 )
 
                 if message_id is None:
@@ -245,6 +390,7 @@ class OpenAIChatAPI:
                         message_id, "Error: Acquire message id failed", True, True
                     )
                     raise Exception("Error: Acquire message id failed")
+                generation.message_id = message_id
 
             await assistant_response_callback_async_(
                 message_id, response, is_streaming, error
@@ -254,37 +400,54 @@ class OpenAIChatAPI:
             response_dict = await self._chat_imple(
                 with_system_prompt,
                 session_id,
+                ai_config,
+                generation,
                 assistant_response_callback_async,
             )
             response_dict["message_id"] = message_id
             return response_dict
+        except GenerationCancelled:
+            # 收到首字之前被取消：没有助手消息，发送空的结束帧让客户端结束等待
+            logger.info("生成在收到首字之前已取消")
+            await assistant_response_callback_async_(message_id, "", False, True)
+            return {}
         except Exception as e:
             logger.error(f"聊天错误: {e}", exc_info=True)
-            self.db.delete_message(message_id)
+            await self._run_sync(self.db.delete_message, message_id)
             await assistant_response_callback_async_(
                 message_id, f"Error: {e}", True, True
             )
             return {}
+        finally:
+            # 出错（如客户端断开）时也要关闭上游流，避免服务商继续生成
+            await generation.close_stream()
+            GenerationRegistry.finish(generation)
 
     async def _chat_imple(
         self,
         with_system_prompt: bool,
         session_id: int,
+        ai_config: Dict[str, Any],
+        generation: Generation,
         assistant_response_callback_async: Callable,
     ) -> Dict:
         """处理用户聊天请求，支持流式响应"""
 
-        # 获取会话配置
-        ai_config = self.get_session_ai_config(session_id)
-
         # 获取历史消息用于提示
-        prompt_messages = self.get_messages_for_prompt(
+        prompt_messages, evicted_seq = await self._run_sync(
+            self._select_prompt_messages,
             with_system_prompt,
             session_id,
             ai_config,
-            max_tokens=ai_config.get("context_max_tokens", 4000),
-            max_messages=ai_config.get("max_messages", 10),
+            ai_config.get("context_max_tokens", 4000),
+            ai_config.get("max_messages", 10),
         )
+        if evicted_seq is not None:
+            # 被挤出上下文的历史在后台合并进滚动摘要，不阻塞本次回复；
+            # 摘要请求耗时较长，使用默认线程池以免占用数据库线程池
+            asyncio.get_running_loop().run_in_executor(
+                None, self.compact_session_history, session_id, evicted_seq, ai_config
+            )
 
         # 添加格式控制消息
         prompt_messages.append(
@@ -296,159 +459,175 @@ class OpenAIChatAPI:
 
         logger.info(f"@@@@@提示消息:{prompt_messages}")
 
-        # 创建OpenAI客户端并发送请求
-        client = openai.OpenAI(
-            api_key=ai_config["api_key"], base_url=ai_config["base_url"]
+        logger.info("----- 流式请求 -----")
+        request_started = time.monotonic()
+        trace = StreamTraceRecorder.start(with_system_prompt)
+        # 按会话的路由策略选择服务商发送流式请求（复用长连接，失败时切换备用服务商）
+        routed = await ProviderRouter.open_stream(
+            ai_config, prompt_messages, generation
         )
+        await generation.attach_stream(routed)
 
-        logger.info("----- 流式请求 -----")
-        self._stop_response = False
-        # 发送流式请求
-        response_stream = client.chat.completions.create(  # type: ignore
-            model=ai_config.get("model", "gpt-3.5-turbo"),
-            messages=prompt_messages,  # type: ignore
-            temperature=ai_config.get("temperature", 0.7),
-            max_tokens=ai_config.get("max_tokens", 800),
-            stream=True,
+        # 按会话配置的策略合并推送流式内容
+        coalescer = StreamCoalescer.from_config(
+            assistant_response_callback_async, ai_config
         )
+        try:
+            # 根据是否需要系统提示词，采用不同的处理方式
+            contents = self._stream_contents(routed, generation, trace)
+            if with_system_prompt:
+                result = await self._process_stream_response(contents, coalescer)
+            else:
+                result = await self._process_simple_stream(contents, coalescer)
+        finally:
+            coalescer.cancel()
 
-        # 根据是否需要系统提示词，采用不同的处理方式
-        if with_system_prompt:
-            return await self._process_stream_response(
-                response_stream, assistant_response_callback_async
+        await self._record_generation_metrics(
+            generation, routed, prompt_messages, request_started
+        )
+        if trace is not None and generation.message_id != -1:
+            # 录制文件在后台写入，不阻塞回复
+            trace.header.update(
+                provider=routed.provider,
+                model=routed.model,
+                cancelled=generation.cancelled,
+            )
+            trace.result = dict(result)
+            asyncio.get_running_loop().run_in_executor(
+                None, StreamTraceRecorder.save, trace, session_id, generation.message_id
             )
+        return result
+
+    async def _record_generation_metrics(
+        self,
+        generation: Generation,
+        routed: RoutedStream,
+        prompt_messages: List[Dict[str, str]],
+        request_started: float,
+    ) -> None:
+        """记录本次生成的指标，服务商未返回token用量时用分词器估算
+
+        首字延迟从发出请求算起，包含路由切换服务商所花的时间。
+        """
+        if generation.message_id == -1:
+            return
+        usage = routed.usage
+        if usage is not None:
+            prompt_tokens = usage.prompt_tokens
+            completion_tokens = usage.completion_tokens
         else:
-            return await self._process_simple_stream(
-                response_stream, assistant_response_callback_async
+            tokenizer = get_tokenizer(routed.model)
+            prompt_tokens = sum(
+                tokenizer.count(message["content"]) + self.MESSAGE_TOKEN_OVERHEAD
+                for message in prompt_messages
+            )
+            completion_tokens = tokenizer.count(routed.text)
+        metrics = {
+            "provider": routed.provider,
+            "model": routed.model,
+            "created_at": time.time(),
+            "ttft_ms": (routed.first_token_at - request_started) * 1000,
+            "duration_ms": (time.monotonic() - request_started) * 1000,
+            "chunk_count": routed.chunks,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "usage_reported": usage is not None,
+            "cancelled": generation.cancelled,
+        }
+        try:
+            await self._run_sync(
+                self.db.add_generation_metrics, generation.message_id, metrics
             )
+        except Exception as e:
+            logger.warning(f"记录生成指标失败: {e}")
+
+    async def _stream_contents(
+        self,
+        routed: RoutedStream,
+        generation: Generation,
+        trace: Optional[StreamTrace] = None,
+    ) -> AsyncIterator[str]:
+        """逐段产出上游流的文本内容，生成被取消（上游流已关闭）时正常结束"""
+        try:
+            async for content in routed.contents():
+                if generation.cancelled:
+                    break
+                if content:
+                    generation.response_chars += len(content)
+                    if trace is not None:
+                        trace.record(content)
+                    yield content
+        except Exception:
+            if not generation.cancelled:
+                raise
+        if generation.cancelled:
+            logger.info("流式响应已停止")
 
     async def _process_simple_stream(
         self,
-        response_stream: openai.Stream,
-        callback: Callable,
+        contents: AsyncIterator[str],
+        coalescer: StreamCoalescer,
     ) -> dict:
         """处理简单流式响应（非JSON格式）"""
-        full_response = ""
-        for chunk in response_stream:
-            if self._stop_response:
-                logger.info("流式响应已停止")
-                break
-            # 检查是否有内容
-            if chunk.choices and chunk.choices[0].delta.content:
-                content = chunk.choices[0].delta.content
-                full_response += content
-                await callback(full_response, True)
-                print(content, end="", flush=True)
-
-        print()
-        await callback(full_response, False)
+        parts: List[str] = []
+
+        def current_text() -> str:
+            if len(parts) > 1:
+                parts[:] = ["".join(parts)]
+            return parts[0] if parts else ""
+
+        async for content in contents:
+            parts.append(content)
+            await coalescer.push(current_text, len(content))
+
+        full_response = current_text()
+        logger.info(f"完整响应: {full_response}")
+        await coalescer.close(full_response)
         return {"response": full_response}
 
     async def _process_stream_response(
         self,
-        response_stream: openai.Stream,
-        callback: Callable,
+        contents: AsyncIterator[str],
+        coalescer: StreamCoalescer,
     ) -> dict:
-        """处理JSON格式的流式响应，提取response字段内容"""
-        full_response = ""
-        response_content = ""
-        in_response_field = False
-        response_ended = False
-        escaped = False
-
-        for chunk in response_stream:
-            if self._stop_response:
-                logger.info("流式响应已停止")
-                break
-            if chunk.choices and chunk.choices[0].delta.content:
-                content = chunk.choices[0].delta.content
-                full_response += content
-
-                if response_ended:
-                    unescaped = self.unescape_string(response_content)
-                    if unescaped:
-                        await callback(unescaped, False)
-                    continue
-
-                # 状态机解析"response"字段内容
-                if not in_response_field:
-                    response_pos = full_response.find('"response":')
-                    if response_pos != -1:
-                        response_pos = full_response.find(
-                            '"', response_pos + len('"response":')
-                        )
-                        if response_pos != -1:
-                            in_response_field = True
-                            response_start = response_pos + 1
-                            content = full_response[response_start:]
-                            clean_content, escaped, response_ended = (
-                                self._parse_stream_content(
-                                    content, escaped, response_ended
-                                )
-                            )
-
-                            if clean_content:
-                                response_content += clean_content
-                                print(clean_content, end="", flush=True)
-                                await self._send_response_chunk(
-                                    response_content, callback
-                                )
-                else:
-                    clean_content, escaped, response_ended = self._parse_stream_content(
-                        content, escaped, response_ended
-                    )
-                    if clean_content:
-                        print(clean_content, end="", flush=True)
-                        response_content += clean_content
-                        await self._send_response_chunk(response_content, callback)
+        """处理JSON格式的流式响应，增量解析并推送response字段内容"""
+        full_response: List[str] = []
+        parser = JsonStreamParser("response")
+        response_closed = False
+
+        async for content in contents:
+            full_response.append(content)
+            new_text = parser.feed(content)
+            if response_closed:
+                continue
+            if parser.stream_ended:
+                # response字段已完整，提前结束流式推送，其余字段继续解析
+                response_closed = True
+                await coalescer.close(parser.text)
+            elif new_text:
+                await coalescer.push(lambda: parser.text, len(new_text))
 
         logger.info("-----------------------------------------------")
-        logger.info(f"完整响应: {full_response}")
-        await callback(response_content, False)
-
-        # 解析完整响应JSON
-        return self._parse_response_json(full_response, response_content)
-
-    def _parse_stream_content(
-        self, content: str, escaped: bool, response_ended: bool
-    ) -> tuple[str, bool, bool]:
-        """解析流式响应内容，处理转义字符和引号"""
-        clean_content = ""
-        for char in content:
-            if escaped:
-                clean_content += char
-                escaped = False
-            elif char == "\\":
-                clean_content += char
-                escaped = True
-            elif char == '"':
-                response_ended = True
-                break
-            else:
-                clean_content += char
-        return clean_content, escaped, response_ended
+        logger.info(f"完整响应: {''.join(full_response)}")
+        await coalescer.close(parser.text)
 
-    async def _send_response_chunk(self, content: str, callback: Callable) -> None:
-        """发送响应块到回调函数"""
-        unescaped = self.unescape_string(content)
-        if unescaped:
-            await callback(unescaped, True)
+        return self._parse_response_json(parser)
 
-    def _parse_response_json(self, full_response: str, response_content: str) -> dict:
-        """解析响应JSON，处理解析失败的情况"""
-        try:
-            return json.loads(full_response)
-        except json.JSONDecodeError:
+    def _parse_response_json(self, parser: JsonStreamParser) -> dict:
+        """取增量解析得到的响应JSON，缺失的字段使用回退值"""
+        fallback = {
+            "response": parser.text,
+            "title": "问题总结",
+            "suggestions": [
+                "能否提供更多细节？",
+                "还有其他补充信息吗？",
+                "请解释得更清楚一些",
+            ],
+        }
+        if not parser.done or not isinstance(parser.fields.get("response"), str):
             logger.warning("解析响应JSON失败，使用回退方案")
-            return {
-                "response": response_content,
-                "title": "问题总结",
-                "suggestions": [
-                    "能否提供更多细节？",
-                    "还有其他补充信息吗？",
-                    "请解释得更清楚一些",
-                ],
-            }
+            return fallback
+        return {**fallback, **parser.fields}
 
     # 会话管理方法
     def create_new_session(
@@ -478,28 +657,112 @@ class OpenAIChatAPI:
         return new_session_id
 
     def copy_session_and_messages(self, session_id: int) -> Optional[int]:
-        """复制会话及其所有消息"""
-        return self.db.copy_session_and_messages(session_id)
+        """复制会话及其所有消息（分叉会话，共享已有消息）"""
+        return self.db.fork_session(session_id)
 
     def get_all_session_id_title_config(self) -> List[Any]:
         """获取所有会话的ID、标题和配置"""
         return self.db.get_all_session_id_title_config()
 
+    def get_session_summaries(self, offset: int = 0, limit: int = -1) -> List[Dict]:
+        """获取会话列表摘要（不含完整AI配置）"""
+        return self.db.get_session_summaries(offset, limit)
+
+    def get_session_revision(self) -> int:
+        """获取会话列表的当前版本号"""
+        return self.db.get_session_revision()
+
+    def get_session_changes(
+        self, since_revision: int
+    ) -> Tuple[List[Dict], List[Dict], int]:
+        """获取某版本之后变更的会话"""
+        return self.db.get_session_changes(since_revision)
+
+    def get_session_count(self) -> int:
+        """获取会话总数"""
+        return self.db.get_session_count()
+
     def get_session_title(self, session_id: int) -> Optional[str]:
         """获取会话标题"""
         return self.db.get_session_title(session_id)
 
-    def _sort_messages(self, messages: List[Dict]) -> List[Dict]:
-        """对消息进行排序"""
-        # 先比较时间，时间相同比较id
-        return sorted(messages, key=lambda x: (x["timestamp"], x["id"]))
-
     def get_session_messages(
         self, session_id: int, limit: int = -1
     ) -> Optional[List[Dict]]:
-        """获取会话消息"""
-        messages = self.db.get_session_messages(session_id, limit)
-        return self._sort_messages(messages) if messages else []
+        """获取会话消息，数据库已按显示顺序返回"""
+        return self.db.get_session_messages(session_id, limit)
+
+    def get_session_messages_page(
+        self,
+        session_id: int,
+        limit: int,
+        before_seq: Optional[int] = None,
+    ) -> Tuple[List[Dict], bool]:
+        """按 seq 游标分页获取会话消息"""
+        return self.db.get_session_messages_page(session_id, limit, before_seq)
+
+    def get_session_messages_from(
+        self, session_id: int, from_seq: Optional[int]
+    ) -> Tuple[List[Dict], bool]:
+        """获取客户端已加载窗口（seq 不小于 from_seq）内的会话消息"""
+        return self.db.get_session_messages_from(session_id, from_seq)
+
+    def search_messages(
+        self, query: str, limit: int = 20, session_id: Optional[int] = None
+    ) -> List[Dict]:
+        """全文检索历史消息"""
+        return self.db.search_messages(query, limit, session_id)
+
+    def get_generation_metrics_summary(self, window_seconds: float) -> List[Dict]:
+        """按服务商和模型汇总最近 window_seconds 秒内的生成指标"""
+        rows = self.db.get_generation_metrics(time.time() - window_seconds)
+        groups: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        for row in rows:
+            groups.setdefault((row["provider"], row["model"]), []).append(row)
+
+        summary = []
+        for (provider, model), items in groups.items():
+            # 输出速率：首字之后每秒生成的token数
+            rates = [
+                row["completion_tokens"]
+                / ((row["duration_ms"] - (row["ttft_ms"] or 0)) / 1000)
+                for row in items
+                if row["completion_tokens"]
+                and row["duration_ms"] > (row["ttft_ms"] or 0)
+            ]
+            summary.append(
+                {
+                    "provider": provider,
+                    "model": model,
+                    "count": len(items),
+                    "cancelled": sum(row["cancelled"] for row in items),
+                    "ttft_ms": self._percentiles(
+                        [row["ttft_ms"] for row in items if row["ttft_ms"] is not None]
+                    ),
+                    "duration_ms": self._percentiles(
+                        [row["duration_ms"] for row in items]
+                    ),
+                    "tokens_per_second": self._percentiles(rates),
+                    "prompt_tokens": sum(row["prompt_tokens"] or 0 for row in items),
+                    "completion_tokens": sum(
+                        row["completion_tokens"] or 0 for row in items
+                    ),
+                }
+            )
+        return summary
+
+    @staticmethod
+    def _percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+        """最近秩法计算 p50/p90/p99"""
+        ordered = sorted(values)
+
+        def pick(p: int) -> Optional[float]:
+            if not ordered:
+                return None
+            index = max(0, math.ceil(p * len(ordered) / 100) - 1)
+            return round(ordered[index], 1)
+
+        return {"p50": pick(50), "p90": pick(90), "p99": pick(99)}
 
     def get_session_ai_config(self, session_id: int) -> dict:
         """获取会话AI配置"""
@@ -518,12 +781,41 @@ class OpenAIChatAPI:
         """获取会话系统消息"""
         return self.db.get_session_system_message(session_id)
 
+    def get_session_system_message_row(self, session_id: int) -> Optional[Dict]:
+        """获取会话的系统消息（完整字段）"""
+        return self.db.get_session_system_message_row(session_id)
+
+    def add_message(
+        self,
+        session_id: int,
+        role: str,
+        raw_text: str,
+        parsed_text: str,
+        model: Optional[str] = None,
+    ) -> Optional[int]:
+        """添加消息，同时按会话模型的分词器缓存token数"""
+        tokenizer = get_tokenizer(model)
+        return self.db.add_message(
+            session_id,
+            role,
+            raw_text,
+            parsed_text,
+            token_count=tokenizer.count(raw_text),
+            token_family=tokenizer.name,
+        )
+
     def add_assistant_message(
-        self, session_id: int, raw_response: str, parsed_text: str
+        self,
+        session_id: int,
+        raw_response: str,
+        parsed_text: str,
+        model: Optional[str] = None,
     ) -> Optional[int]:
         """添加助手消息"""
         # 保存AI回复到数据库
-        return self.db.add_message(session_id, "assistant", raw_response, parsed_text)
+        return self.add_message(
+            session_id, "assistant", raw_response, parsed_text, model
+        )
 
     def update_session_ai_config(self, session_id: int, ai_config: dict) -> None:
         """更新会话AI配置"""
@@ -533,11 +825,13 @@ class OpenAIChatAPI:
         """更新会话标题"""
         self.db.update_session_title(session_id, title)
 
+    def patch_session_config(self, session_id: int, patch: Dict[str, Any]) -> None:
+        """原子地更新会话AI配置中的部分属性"""
+        self.db.patch_session_ai_config(session_id, patch)
+
     def update_session_property(self, session_id: int, key: str, value: Any) -> None:
         """更新会话属性"""
-        ai_config = self.get_session_ai_config(session_id)
-        ai_config[key] = value
-        self.update_session_ai_config(session_id, ai_config)
+        self.patch_session_config(session_id, {key: value})
 
     def update_session_top(self, session_id: int, top: bool) -> None:
         """更新会话置顶状态"""
@@ -556,28 +850,54 @@ class OpenAIChatAPI:
         self.update_session_property(session_id, "suggestions", suggestions)
 
     def update_session_last_active_time(
-        self, session_id: int, last_active_time: float = time.time()
+        self, session_id: int, last_active_time: Optional[float] = None
     ) -> None:
         """更新会话最后活动时间"""
+        if last_active_time is None:
+            last_active_time = time.time()
         self.update_session_property(session_id, "last_active_time", last_active_time)
 
     def update_session_ai_avatar_url(self, session_id: int, avatar_url: str) -> None:
         """更新会话AI头像"""
         self.update_session_property(session_id, "ai_avatar_url", avatar_url)
 
-    def delete_session(self, session_id: int) -> None:
-        """删除会话及其所有消息"""
-        self.db.delete_session_and_messages(session_id)
+    def delete_session(self, session_id: int) -> List[int]:
+        """删除会话及其所有消息，返回因此被实体化的分叉会话ID"""
+        return self.db.delete_session_and_messages(session_id)
 
     def delete_message(self, message_id: int) -> None:
         """删除消息"""
         self.db.delete_message(message_id)
 
+    def edit_message(
+        self, session_id: int, message_id: int, raw_text: str, parsed_text: str
+    ) -> Tuple[Optional[int], List[int]]:
+        """用户编辑会话中的消息，对分叉会话共享的消息写时复制"""
+        return self.db.edit_message(session_id, message_id, raw_text, parsed_text)
+
+    def remove_message(self, session_id: int, message_id: int) -> List[int]:
+        """用户删除会话中的消息，对分叉会话共享的消息写时复制"""
+        return self.db.remove_message(session_id, message_id)
+
     def update_message(
-        self, message_id: int, parsed_text: str, raw_text: Optional[str] = None
+        self,
+        message_id: int,
+        parsed_text: str,
+        raw_text: Optional[str] = None,
+        model: Optional[str] = None,
     ) -> None:
-        """更新消息内容"""
-        self.db.update_message(message_id, parsed_text, raw_text)
+        """更新消息内容，提供 model 时按其分词器缓存新内容的token数"""
+        if raw_text is None or model is None:
+            self.db.update_message(message_id, parsed_text, raw_text)
+            return
+        tokenizer = get_tokenizer(model)
+        self.db.update_message(
+            message_id,
+            parsed_text,
+            raw_text,
+            token_count=tokenizer.count(raw_text),
+            token_family=tokenizer.name,
+        )
 
     def get_parsed_text(self, message_id: int) -> Optional[Dict]:
         parsed_text = self.db.get_parsed_text(message_id)
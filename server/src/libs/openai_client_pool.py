@@ -0,0 +1,75 @@
+import threading
+from typing import Dict, Tuple
+import httpx
+import openai
+from libs.log_config import logger
+
+
+class OpenAIClientPool:
+    """进程级 OpenAI 客户端缓存，按 (base_url, api_key) 复用，保持HTTP长连接
+
+    异步客户端的连接绑定在创建它的事件循环上，只能在主事件循环中使用。
+    """
+
+    # 每个服务商保持的空闲长连接数量和空闲超时时间
+    MAX_KEEPALIVE_CONNECTIONS = 8
+    KEEPALIVE_EXPIRY = 120.0
+
+    _async_clients: Dict[Tuple[str, str], openai.AsyncOpenAI] = {}
+    _sync_clients: Dict[Tuple[str, str], openai.OpenAI] = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _limits() -> httpx.Limits:
+        return httpx.Limits(
+            max_keepalive_connections=OpenAIClientPool.MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OpenAIClientPool.KEEPALIVE_EXPIRY,
+        )
+
+    @staticmethod
+    def get_async(base_url: str, api_key: str) -> openai.AsyncOpenAI:
+        """获取异步客户端，不存在时创建"""
+        key = (base_url, api_key)
+        with OpenAIClientPool._lock:
+            client = OpenAIClientPool._async_clients.get(key)
+            if client is None:
+                logger.info(f"创建异步OpenAI客户端: {base_url}")
+                client = openai.AsyncOpenAI(
+                    base_url=base_url,
+                    api_key=api_key,
+                    http_client=openai.DefaultAsyncHttpxClient(
+                        limits=OpenAIClientPool._limits()
+                    ),
+                )
+                OpenAIClientPool._async_clients[key] = client
+            return client
+
+    @staticmethod
+    def get_sync(base_url: str, api_key: str) -> openai.OpenAI:
+        """获取同步客户端（用于线程池中执行的系统分析请求），不存在时创建"""
+        key = (base_url, api_key)
+        with OpenAIClientPool._lock:
+            client = OpenAIClientPool._sync_clients.get(key)
+            if client is None:
+                client = openai.OpenAI(
+                    base_url=base_url,
+                    api_key=api_key,
+                    http_client=openai.DefaultHttpxClient(
+                        limits=OpenAIClientPool._limits()
+                    ),
+                )
+                OpenAIClientPool._sync_clients[key] = client
+            return client
+
+    @staticmethod
+    async def close_all() -> None:
+        """关闭所有缓存的客户端"""
+        with OpenAIClientPool._lock:
+            async_clients = list(OpenAIClientPool._async_clients.values())
+            sync_clients = list(OpenAIClientPool._sync_clients.values())
+            OpenAIClientPool._async_clients.clear()
+            OpenAIClientPool._sync_clients.clear()
+        for client in async_clients:
+            await client.close()
+        for client in sync_clients:
+            client.close()
@@ -0,0 +1,339 @@
+import asyncio
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+import openai
+from libs.chat_scheduler import ChatScheduler
+from libs.config import UtilsBase
+from libs.generation_registry import Generation, GenerationCancelled
+from libs.log_config import logger
+from libs.openai_client_pool import OpenAIClientPool
+
+
+class ProviderStats:
+    """服务商的滑动统计：首字延迟、错误率、吞吐量（指数加权平均）"""
+
+    ALPHA = 0.3
+    # 连续失败达到该次数后，在冷却时间内排到最后
+    COOLDOWN_FAILURES = 3
+    COOLDOWN_SECONDS = 60.0
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.ttft: Optional[float] = None
+        self.error_rate = 0.0
+        self.throughput: Optional[float] = None
+        self.consecutive_failures = 0
+        self.last_failure = 0.0
+
+    def _ewma(self, current: Optional[float], value: float) -> float:
+        if current is None:
+            return value
+        return current + self.ALPHA * (value - current)
+
+    def record_first_token(self, ttft: float) -> None:
+        self.ttft = self._ewma(self.ttft, ttft)
+
+    def record_success(self, chars: int, duration: float) -> None:
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.error_rate = self._ewma(self.error_rate, 0.0)
+        if duration > 0:
+            self.throughput = self._ewma(self.throughput, chars / duration)
+
+    def record_error(self) -> None:
+        self.requests += 1
+        self.errors += 1
+        self.consecutive_failures += 1
+        self.last_failure = time.monotonic()
+        self.error_rate = self._ewma(self.error_rate, 1.0)
+
+    def cooling_down(self) -> bool:
+        return (
+            self.consecutive_failures >= self.COOLDOWN_FAILURES
+            and time.monotonic() - self.last_failure < self.COOLDOWN_SECONDS
+        )
+
+    def score(self) -> float:
+        """预估的首字延迟，越小越好；没有数据时按1秒估计"""
+        ttft = self.ttft if self.ttft is not None else 1.0
+        return ttft / max(0.05, 1.0 - self.error_rate)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate": round(self.error_rate, 4),
+            "ttft_ms": None if self.ttft is None else round(self.ttft * 1000, 1),
+            "throughput_cps": (
+                None if self.throughput is None else round(self.throughput, 1)
+            ),
+            "cooling_down": self.cooling_down(),
+        }
+
+
+class RoutedStream:
+    """已收到首段内容的上游流，逐段产出文本并在结束时记录服务商统计
+
+    持有服务商的并发槽位，读完或关闭时释放。
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        model: str,
+        stream: openai.AsyncStream,
+        iterator: AsyncIterator,
+        first_content: str,
+        first_token_at: float,
+    ):
+        self.provider = provider
+        self.model = model
+        self.stream = stream
+        self._iterator = iterator
+        self._first_content = first_content
+        self.first_token_at = first_token_at
+        # 内容分块数，以及服务商在流末尾返回的token用量（需开启 stream_usage）
+        self.chunks = 1
+        self.usage: Optional[Any] = None
+        self._parts = [first_content]
+        self._closed = False
+        self._released = False
+
+    def _release(self) -> None:
+        if not self._released:
+            self._released = True
+            ChatScheduler.release_provider(self.provider)
+
+    async def contents(self) -> AsyncIterator[str]:
+        chars = len(self._first_content)
+        yield self._first_content
+        try:
+            async for chunk in self._iterator:
+                if getattr(chunk, "usage", None):
+                    self.usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    content = chunk.choices[0].delta.content
+                    chars += len(content)
+                    self.chunks += 1
+                    self._parts.append(content)
+                    yield content
+        except Exception:
+            if not self._closed:
+                ProviderRouter.stats_for(self.provider).record_error()
+            raise
+        finally:
+            self._release()
+        if not self._closed:
+            ProviderRouter.stats_for(self.provider).record_success(
+                chars, time.monotonic() - self.first_token_at
+            )
+
+    @property
+    def text(self) -> str:
+        """目前收到的完整回复文本"""
+        return "".join(self._parts)
+
+    async def close(self) -> None:
+        """主动关闭（取消生成），不计为服务商错误"""
+        self._closed = True
+        try:
+            await self.stream.close()
+        finally:
+            self._release()
+
+
+class ProviderRouter:
+    """在 UtilsBase.APIS 配置的服务商之间路由聊天请求
+
+    会话 ai_config 中的 routing 策略（未配置时只使用会话自身的服务商，首字超时取默认值）：
+        {
+            "strategy": "failover" | "latency",  # 按配置顺序 / 按预估首字延迟排序
+            "fallbacks": ["备用服务商名称", ...],   # 取自 apis 中的 name
+            "first_token_timeout_ms": 20000,     # 超时未收到首字视为失败，切换到下一个
+            "hedge_after_ms": 0                  # >0 时首字迟迟未到则并行请求下一个，先到者胜出
+        }
+    只在收到首字之前切换服务商；开始输出后的错误直接返回给用户。
+    每次请求前在 ChatScheduler 中获取该服务商的并发槽位，等待槽位的时间计入首字超时。
+    收到首字之前生成被取消时，关闭所有进行中的请求并抛出 GenerationCancelled。
+    """
+
+    DEFAULT_FIRST_TOKEN_TIMEOUT_MS = 20000
+
+    _stats: Dict[str, ProviderStats] = {}
+
+    @staticmethod
+    def stats_for(provider: str) -> ProviderStats:
+        stats = ProviderRouter._stats.get(provider)
+        if stats is None:
+            stats = ProviderStats()
+            ProviderRouter._stats[provider] = stats
+        return stats
+
+    @staticmethod
+    def stats() -> Dict[str, Dict[str, Any]]:
+        return {
+            provider: stats.to_dict()
+            for provider, stats in ProviderRouter._stats.items()
+        }
+
+    @staticmethod
+    def _provider_name(config: Dict[str, Any]) -> str:
+        return config.get("name") or config.get("base_url", "")
+
+    @staticmethod
+    def candidates(ai_config: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """按路由策略排列候选服务商配置，备用服务商沿用会话的生成参数"""
+        policy = ai_config.get("routing") or {}
+        candidates = [ai_config]
+        names = {ProviderRouter._provider_name(ai_config)}
+        apis = {api.get("name"): api for api in UtilsBase.APIS}
+        for name in policy.get("fallbacks", []):
+            api = apis.get(name)
+            if api is None or name in names or not api.get("api_key"):
+                continue
+            names.add(name)
+            candidates.append(
+                {
+                    **ai_config,
+                    "name": name,
+                    "base_url": api["base_url"],
+                    "api_key": api["api_key"],
+                    "model": api["model"],
+                }
+            )
+
+        def order(item: Tuple[int, Dict[str, Any]]) -> Tuple[bool, float]:
+            index, config = item
+            stats = ProviderRouter.stats_for(ProviderRouter._provider_name(config))
+            key = stats.score() if policy.get("strategy") == "latency" else index
+            return stats.cooling_down(), key
+
+        return [config for _, config in sorted(enumerate(candidates), key=order)]
+
+    @staticmethod
+    async def _attempt(
+        config: Dict[str, Any],
+        messages: List[Dict[str, str]],
+        timeout: float,
+        generation: Generation,
+    ) -> RoutedStream:
+        """向一个服务商发起流式请求，等到首段内容后返回"""
+        provider = ProviderRouter._provider_name(config)
+        client = OpenAIClientPool.get_async(config["base_url"], config["api_key"])
+        started = time.monotonic()
+        stream = None
+        acquired = False
+        options = {}
+        if config.get("stream_usage"):
+            # 让服务商在流的最后一个分块中返回token用量
+            options["stream_options"] = {"include_usage": True}
+
+        async def first_content() -> Tuple[AsyncIterator, str]:
+            nonlocal stream, acquired
+            await ChatScheduler.acquire_provider(provider)
+            acquired = True
+            stream = await client.chat.completions.create(  # type: ignore
+                model=config.get("model", "gpt-3.5-turbo"),
+                messages=messages,  # type: ignore
+                temperature=config.get("temperature", 0.7),
+                max_tokens=config.get("max_tokens", 800),
+                stream=True,
+                **options,
+            )
+            await generation.track_stream(stream)
+            iterator = stream.__aiter__()
+            async for chunk in iterator:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    return iterator, chunk.choices[0].delta.content
+            return iterator, ""
+
+        try:
+            try:
+                iterator, content = await asyncio.wait_for(first_content(), timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"服务商 {provider} 超过 {timeout} 秒未返回首字")
+        except BaseException as e:
+            if stream is not None:
+                await stream.close()
+            if not acquired:
+                # 未等到槽位（本地排队）不计为服务商错误
+                raise
+            ChatScheduler.release_provider(provider)
+            if not isinstance(e, asyncio.CancelledError) and not generation.cancelled:
+                ProviderRouter.stats_for(provider).record_error()
+            raise
+        finally:
+            if stream is not None:
+                generation.untrack_stream(stream)
+        now = time.monotonic()
+        ProviderRouter.stats_for(provider).record_first_token(now - started)
+        model = config.get("model", "gpt-3.5-turbo")
+        return RoutedStream(provider, model, stream, iterator, content, now)
+
+    @staticmethod
+    async def open_stream(
+        ai_config: Dict[str, Any],
+        messages: List[Dict[str, str]],
+        generation: Generation,
+    ) -> RoutedStream:
+        """按路由策略打开流式请求，失败或超时时切换到下一个服务商"""
+        policy = ai_config.get("routing") or {}
+        candidates = ProviderRouter.candidates(ai_config)
+        timeout = (
+            policy.get(
+                "first_token_timeout_ms", ProviderRouter.DEFAULT_FIRST_TOKEN_TIMEOUT_MS
+            )
+            / 1000
+        )
+        hedge_after = policy.get("hedge_after_ms", 0) / 1000
+        running: Dict[asyncio.Task, str] = {}
+        last_error: Optional[BaseException] = None
+
+        def launch() -> None:
+            config = candidates.pop(0)
+            provider = ProviderRouter._provider_name(config)
+            if running or last_error is not None:
+                logger.warning(f"切换到服务商 {provider}")
+            task = asyncio.create_task(
+                ProviderRouter._attempt(config, messages, timeout, generation)
+            )
+            running[task] = provider
+
+        cancel_waiter = asyncio.create_task(generation.wait_cancelled())
+        launch()
+        try:
+            while running:
+                wait = hedge_after if hedge_after > 0 and candidates else None
+                done, _ = await asyncio.wait(
+                    [*running, cancel_waiter],
+                    timeout=wait,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if generation.cancelled:
+                    raise GenerationCancelled()
+                if not done:
+                    # 首字迟迟未到，并行请求下一个服务商
+                    launch()
+                    continue
+                for task in done:
+                    provider = running.pop(task)
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+                    logger.warning(f"服务商 {provider} 请求失败: {last_error}")
+                if not running and candidates:
+                    launch()
+        finally:
+            cancel_waiter.cancel()
+            for task in running:
+                task.cancel()
+            # 对冲时落败但已拿到首字的请求需要关闭上游流
+            for task in running:
+                try:
+                    routed = await task
+                except BaseException:
+                    continue
+                await routed.close()
+        assert last_error is not None
+        raise last_error
@@ -0,0 +1,104 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Set, Tuple
+from libs.log_config import logger
+
+_JobKey = Tuple[int, str]
+
+
+class RetryableJobError(Exception):
+    """可重试的任务失败（如上游模型请求失败），其他异常不重试"""
+
+
+class SessionJobQueue:
+    """会话的后台任务队列，运行在主事件循环中，不占用回复的关键路径
+
+    - 任务按 (会话, 类型) 去抖：等待期内再次提交同类任务时只执行最新的一个，
+      连续多轮对话只生成一次标题和建议；
+    - 同一 (会话, 类型) 的任务串行执行；
+    - 抛出 RetryableJobError 时按指数退避重试，重试前若已有更新的任务则放弃旧任务；
+      其他异常（如客户端已断开）直接视为失败，避免重复执行已完成的写入。
+    可重试的部分需可重复执行（幂等）。
+    """
+
+    DEBOUNCE_SECONDS = 1.0
+    MAX_RETRIES = 3
+    RETRY_BASE_DELAY = 1.0
+
+    # 待执行的任务及其提交时间
+    _pending: Dict[_JobKey, Tuple[Callable[[], Awaitable], float]] = {}
+    _workers: Dict[_JobKey, asyncio.Task] = {}
+    # 保持工作协程的引用，避免被垃圾回收
+    _tasks: Set[asyncio.Task] = set()
+    _metrics: Dict[str, int] = {
+        "scheduled": 0,
+        "debounced": 0,
+        "completed": 0,
+        "retried": 0,
+        "failed": 0,
+    }
+
+    @staticmethod
+    def schedule(
+        session_id: int,
+        kind: str,
+        job: Callable[[], Awaitable],
+        delay: float = DEBOUNCE_SECONDS,
+    ) -> None:
+        """提交任务，delay 秒内没有新的同类任务时才执行"""
+        key = (session_id, kind)
+        metrics = SessionJobQueue._metrics
+        metrics["scheduled"] += 1
+        if key in SessionJobQueue._pending:
+            metrics["debounced"] += 1
+        SessionJobQueue._pending[key] = (job, time.monotonic())
+        if key not in SessionJobQueue._workers:
+            worker = asyncio.create_task(SessionJobQueue._drain(key, delay))
+            SessionJobQueue._workers[key] = worker
+            SessionJobQueue._tasks.add(worker)
+            worker.add_done_callback(SessionJobQueue._tasks.discard)
+
+    @staticmethod
+    async def _drain(key: _JobKey, delay: float) -> None:
+        try:
+            while key in SessionJobQueue._pending:
+                _, submitted_at = SessionJobQueue._pending[key]
+                wait = submitted_at + delay - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    # 等待期间有新任务提交，重新计时
+                    continue
+                job, _ = SessionJobQueue._pending.pop(key)
+                await SessionJobQueue._run_with_retry(key, job)
+        finally:
+            SessionJobQueue._workers.pop(key, None)
+
+    @staticmethod
+    async def _run_with_retry(key: _JobKey, job: Callable[[], Awaitable]) -> None:
+        metrics = SessionJobQueue._metrics
+        for attempt in range(SessionJobQueue.MAX_RETRIES + 1):
+            try:
+                await job()
+                metrics["completed"] += 1
+                return
+            except Exception as e:
+                retryable = isinstance(e, RetryableJobError)
+                if not retryable or attempt == SessionJobQueue.MAX_RETRIES:
+                    metrics["failed"] += 1
+                    logger.error(f"后台任务 {key} 失败: {e}", exc_info=not retryable)
+                    return
+                logger.warning(f"后台任务 {key} 第 {attempt + 1} 次执行失败: {e}")
+            await asyncio.sleep(SessionJobQueue.RETRY_BASE_DELAY * 2**attempt)
+            if key in SessionJobQueue._pending:
+                # 已被更新的任务取代
+                return
+            metrics["retried"] += 1
+
+    @staticmethod
+    def stats() -> Dict[str, Any]:
+        """后台任务的提交、去抖、重试和失败次数"""
+        return {
+            **SessionJobQueue._metrics,
+            "pending": len(SessionJobQueue._pending),
+            "workers": len(SessionJobQueue._workers),
+        }
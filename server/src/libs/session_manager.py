@@ -1,15 +1,26 @@
 import json
 import time
-from typing import Optional
+import threading
+from typing import Dict, List, Optional
 from fastapi import WebSocket
 from libs.log_config import logger
 from libs.common import Utils
-from libs.openai_chat_api import OpenAIChatAPI
+from libs.async_chat_api import AsyncChatAPI
 
 
 class SessionManager:
     """会话管理器，负责会话的创建、删除、配置更新等操作"""
 
+    # load_more 未指定数量时每页的消息条数
+    SESSION_MESSAGES_PAGE_SIZE = 50
+
+    # 分页加载的连接已加载到的最早消息seq，None 表示已加载全部；不在其中的连接加载了全部消息
+    _loaded_from_seqs: Dict[WebSocket, Optional[int]] = {}
+
+    # 已广播给SPA的会话列表版本号
+    _broadcast_revision = -1
+    _broadcast_revision_lock = threading.Lock()
+
     @staticmethod
     def initialize_sessions():
         """初始化会话配置"""
@@ -19,13 +30,14 @@ class SessionManager:
             for session in sessions:
                 session_id = session["id"]
                 config = json.loads(session["ai_config"])
-                is_changed = False
+                patch = {}
 
                 # 更新缺失的配置项
                 for key, default_value in [
                     ("top", False),
                     ("speech_rate", 1.0),
                     ("auto_play", False),
+                    ("auto_play_streaming", False),
                     ("tts_voice", "zh-CN-XiaochenNeural"),
                     ("auto_gen_title", True),
                     ("suggestions", []),
@@ -34,11 +46,10 @@ class SessionManager:
                     ("show_separated_sentences", True),
                 ]:
                     if key not in config:
-                        config[key] = default_value
-                        is_changed = True
+                        patch[key] = default_value
 
-                if is_changed:
-                    Utils.api.update_session_ai_config(session_id, config)
+                if patch:
+                    Utils.api.patch_session_config(session_id, patch)
 
         initialize_sessions_imple()
 
@@ -104,9 +115,12 @@ class SessionManager:
             del Utils.session_websockets[session_id][key]
 
     @staticmethod
-    async def broadcast_session_title(session_id: int, api: OpenAIChatAPI = Utils.api):
+    async def broadcast_session_title(
+        session_id: int, api: Optional[AsyncChatAPI] = None
+    ):
         """向特定会话的所有WebSocket连接广播标题"""
-        title = api.get_session_title(session_id)
+        api = api or Utils.async_api
+        title = await api.get_session_title(session_id)
         msg = {
             "type": "session_title",
             "data": {
@@ -116,9 +130,12 @@ class SessionManager:
         await SessionManager.broadcast_session(session_id, json.dumps(msg))
 
     @staticmethod
-    async def update_title(session_id: int, title: str, api: OpenAIChatAPI = Utils.api):
+    async def update_title(
+        session_id: int, title: str, api: Optional[AsyncChatAPI] = None
+    ):
         """更新会话标题并广播"""
-        api.update_session_title(session_id, title)
+        api = api or Utils.async_api
+        await api.update_session_title(session_id, title)
         msg = {
             "type": "update_session_title",
             "data": {
@@ -128,10 +145,11 @@ class SessionManager:
         }
         await SessionManager.broadcast_spa(json.dumps(msg))
         await SessionManager.broadcast_session_title(session_id, api)
+        await SessionManager.broadcast_session_changes(api)
 
     @staticmethod
     async def update_session_ai_avatar(session_id: int, ai_avatar_url: str):
-        Utils.api.update_session_ai_avatar_url(session_id, ai_avatar_url)
+        await Utils.async_api.update_session_ai_avatar_url(session_id, ai_avatar_url)
         msg = {
             "type": "update_session_ai_avatar",
             "data": {
@@ -140,20 +158,89 @@ class SessionManager:
             },
         }
         await SessionManager.broadcast_spa(json.dumps(msg))
+        await SessionManager.broadcast_session_changes()
         await SessionManager.send_session_config(session_id)
 
     @staticmethod
-    async def send_all_sessions(api: OpenAIChatAPI = Utils.api):
-        """发送所有会话信息到SPA"""
-        sessions = api.get_all_session_id_title_config()
+    async def send_all_sessions(api: Optional[AsyncChatAPI] = None):
+        """发送所有会话摘要到SPA"""
+        api = api or Utils.async_api
+        revision = await api.get_session_revision()
+        sessions = await api.get_session_summaries()
         msg = {
             "type": "all_sessions",
             "data": {
                 "sessions": sessions,
+                "revision": revision,
             },
         }
+        with SessionManager._broadcast_revision_lock:
+            SessionManager._broadcast_revision = max(
+                SessionManager._broadcast_revision, revision
+            )
         await SessionManager.broadcast_spa(json.dumps(msg))
 
+    @staticmethod
+    async def broadcast_session_changes(api: Optional[AsyncChatAPI] = None):
+        """向SPA广播上次广播之后的会话列表增量（session_upserted / session_removed）"""
+        api = api or Utils.async_api
+        with SessionManager._broadcast_revision_lock:
+            since_revision = SessionManager._broadcast_revision
+        if since_revision < 0:
+            # 尚未发送过全量列表
+            await SessionManager.send_all_sessions(api)
+            return
+
+        upserted, removed, revision = await api.get_session_changes(since_revision)
+        with SessionManager._broadcast_revision_lock:
+            # 并发调用时只广播尚未被其他调用广播过的变更
+            since_revision = SessionManager._broadcast_revision
+            SessionManager._broadcast_revision = max(since_revision, revision)
+        messages = [
+            (change["revision"], "session_upserted", change)
+            for change in upserted
+            if change["revision"] > since_revision
+        ] + [
+            (change["revision"], "session_removed", change)
+            for change in removed
+            if change["revision"] > since_revision
+        ]
+        for _, message_type, data in sorted(messages, key=lambda x: x[0]):
+            msg = {"type": message_type, "data": data}
+            await SessionManager.broadcast_spa(json.dumps(msg))
+
+    @staticmethod
+    async def send_session_changes(websocket: WebSocket, since_revision: int):
+        """客户端从指定版本重新同步会话列表"""
+        upserted, removed, revision = await Utils.async_api.get_session_changes(
+            since_revision
+        )
+        msg = {
+            "type": "session_changes",
+            "data": {
+                "since_revision": since_revision,
+                "revision": revision,
+                "upserted": upserted,
+                "removed": removed,
+            },
+        }
+        await websocket.send_text(json.dumps(msg))
+
+    @staticmethod
+    async def send_session_list(websocket: WebSocket, offset: int, limit: int):
+        """分页发送会话摘要到指定WebSocket"""
+        sessions = await Utils.async_api.get_session_summaries(offset, limit)
+        total = await Utils.async_api.get_session_count()
+        msg = {
+            "type": "session_list",
+            "data": {
+                "sessions": sessions,
+                "offset": offset,
+                "total": total,
+            },
+        }
+        await websocket.send_text(json.dumps(msg))
+
     @staticmethod
     async def send_system_config():
         """发送系统配置到SPA"""
@@ -168,24 +255,127 @@ class SessionManager:
         await SessionManager.broadcast_spa(json.dumps(msg))
 
     @staticmethod
-    async def send_session_messages(websocket: WebSocket, session_id: int):
-        """发送会话消息到指定WebSocket"""
-        messages = Utils.api.get_session_messages(session_id, limit=-1)
+    async def send_session_messages(
+        websocket: WebSocket, session_id: int, page_size: int = -1
+    ):
+        """发送会话消息到指定WebSocket
+
+        page_size为-1时发送全部消息，否则只发送最近page_size条，客户端通过load_more继续加载
+        """
+        if page_size == -1:
+            messages = await Utils.async_api.get_session_messages(session_id, limit=-1)
+            msg = {
+                "type": "session_messages",
+                "data": {"messages": messages},
+            }
+        else:
+            messages, has_more = await Utils.async_api.get_session_messages_page(
+                session_id, page_size
+            )
+            SessionManager._remember_window(websocket, messages, has_more)
+            msg = {
+                "type": "session_messages",
+                "data": await SessionManager._session_messages_window(
+                    session_id, messages, has_more
+                ),
+            }
+        await websocket.send_text(json.dumps(msg))
+
+    @staticmethod
+    async def refresh_session_messages(session_ids: List[int]):
+        """会话被实体化（消息ID变化）后，向其所有连接重新发送已加载窗口内的消息"""
+        for session_id in session_ids:
+            if session_id not in Utils.session_websockets:
+                continue
+            api = Utils.async_api
+            full_messages = None
+            invalid_keys = []
+            connections = list(Utils.session_websockets[session_id].items())
+            for key, websocket in connections:
+                if websocket in SessionManager._loaded_from_seqs:
+                    messages, has_more = await api.get_session_messages_from(
+                        session_id, SessionManager._loaded_from_seqs[websocket]
+                    )
+                    data = await SessionManager._session_messages_window(
+                        session_id, messages, has_more
+                    )
+                else:
+                    if full_messages is None:
+                        full_messages = await api.get_session_messages(
+                            session_id, limit=-1
+                        )
+                    data = {"messages": full_messages}
+                msg = {"type": "session_messages", "data": data}
+                try:
+                    await websocket.send_text(json.dumps(msg))
+                except Exception as e:
+                    logger.error(f"会话广播错误: {e}")
+                    invalid_keys.append(key)
+
+            for key in invalid_keys:
+                Utils.session_websockets[session_id].pop(key, None)
+
+    @staticmethod
+    async def send_session_messages_page(
+        websocket: WebSocket,
+        session_id: int,
+        limit: int,
+        before_seq: Optional[int] = None,
+    ):
+        """发送游标之前的一页历史消息"""
+        messages, has_more = await Utils.async_api.get_session_messages_page(
+            session_id, limit, before_seq
+        )
+        SessionManager._remember_window(websocket, messages, has_more)
         msg = {
-            "type": "session_messages",
-            "data": {"messages": messages},
+            "type": "session_messages_page",
+            "data": SessionManager._session_messages_page(messages, has_more),
         }
         await websocket.send_text(json.dumps(msg))
 
+    @staticmethod
+    def _session_messages_page(messages: list, has_more: bool) -> dict:
+        """构造分页消息数据，cursor为本页最早一条消息的seq"""
+        cursor = messages[0]["seq"] if messages else None
+        return {"messages": messages, "has_more": has_more, "cursor": cursor}
+
+    @staticmethod
+    async def _session_messages_window(
+        session_id: int, messages: list, has_more: bool
+    ) -> dict:
+        """构造客户端消息窗口数据，还有更早消息时附带系统消息（作为会话设定显示）"""
+        data = SessionManager._session_messages_page(messages, has_more)
+        data["system_message"] = None
+        if has_more:
+            data["system_message"] = (
+                await Utils.async_api.get_session_system_message_row(session_id)
+            )
+        return data
+
+    @staticmethod
+    def _remember_window(websocket: WebSocket, messages: list, has_more: bool):
+        """记录连接已加载到的最早消息，刷新时只重新发送这部分"""
+        if has_more and not messages:
+            return
+        SessionManager._loaded_from_seqs[websocket] = (
+            messages[0]["seq"] if has_more else None
+        )
+
+    @staticmethod
+    def forget_connection(websocket: WebSocket):
+        """连接断开后清理其消息窗口记录"""
+        SessionManager._loaded_from_seqs.pop(websocket, None)
+
     @staticmethod
     async def send_session_config(
         session_id: int,
         websocket: Optional[WebSocket] = None,
-        api: OpenAIChatAPI = Utils.api,
+        api: Optional[AsyncChatAPI] = None,
         is_right_after_connection: bool = False,
     ):
         """发送会话配置到指定WebSocket或广播"""
-        ai_config = api.get_session_ai_config(session_id)
+        api = api or Utils.async_api
+        ai_config = await api.get_session_ai_config(session_id)
         msg = {
             "type": "session_ai_config",
             "data": {
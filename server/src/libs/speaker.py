@@ -7,8 +7,10 @@ import threading
 import shutil
 import time
 from collections import deque
-from typing import Dict, Callable, Awaitable, Optional, List
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Dict, Callable, Awaitable, Optional, List, Set, Tuple
 from libs.log_config import logger
+from libs.audio_cache import AudioCache
 import azure.cognitiveservices.speech as speechsdk
 import pygame
 from pygame import mixer
@@ -28,6 +30,10 @@ class SingletonMeta(type):
 class Speaker(metaclass=SingletonMeta):
     """语音合成和播放服务"""
 
+    # 合成的音频格式，与 mixer 的初始化参数一致，并作为缓存键的一部分
+    AUDIO_FORMAT = "riff-16khz-16bit-mono-pcm"
+    DEFAULT_CACHE_MAX_MB = 512
+
     def __init__(self, config: Dict, voichai_storage_path: str):
         """初始化语音合成器，支持延迟初始化"""
         if not hasattr(self, "_initialized"):
@@ -43,10 +49,32 @@ class Speaker(metaclass=SingletonMeta):
         self.azure_config = self.config["azure"]
         self.speaker_config = self.config["speaker"]
         self._init_audio_system()
+        # 保护 _stop_event、_generate_id 和播放队列的切换，只短暂持有
         self._audio_generation_lock = threading.Lock()
+        # 预生成的批次依次执行：新的一批先中止前一批，再等其退出后开始
+        self._generation_batch_lock = threading.Lock()
         self._generate_id = 0
-        self._is_stop_generating = False
+        # 当前这批预生成的停止信号，stop_generating 只影响正在进行的一批
+        self._stop_event = threading.Event()
         self._is_stopping = False
+        # 并行合成：同时进行的Azure合成请求数
+        self.synthesis_concurrency = max(
+            1, int(self.speaker_config.get("tts_concurrency", 4))
+        )
+        self._synthesis_executor = ThreadPoolExecutor(
+            max_workers=self.synthesis_concurrency, thread_name_prefix="tts"
+        )
+        self._active_synthesizers: Set[speechsdk.SpeechSynthesizer] = set()
+        self._synthesizers_lock = threading.Lock()
+        cache_max_mb = self.speaker_config.get(
+            "cache_max_mb", self.DEFAULT_CACHE_MAX_MB
+        )
+        self.audio_cache = AudioCache(
+            os.path.join(
+                self.voichai_storage_path, self.speaker_config["audio_dir"], "cache"
+            ),
+            int(cache_max_mb * 1024 * 1024),
+        )
 
     def _init_audio_system(self) -> None:
         """初始化Pygame音频系统"""
@@ -58,32 +86,26 @@ class Speaker(metaclass=SingletonMeta):
 
     def close(self) -> None:
         """关闭音频系统"""
+        self.stop_generating()
+        self._synthesis_executor.shutdown(wait=False, cancel_futures=True)
         pygame.mixer.quit()
 
-    def _get_audio_path(
-        self, session_id: int, message_id: int, sentence_id: int
-    ) -> str:
-        """获取音频文件的完整路径"""
-        dir_path = os.path.join(
-            self.voichai_storage_path,
-            self.speaker_config["audio_dir"],
-            str(session_id),
-            str(message_id),
-        )
-        return os.path.join(dir_path, f"{sentence_id}.wav")
+    def _audio_cache_key(self, text: str, voice_name: str, speech_rate: float) -> str:
+        return AudioCache.make_key(text, voice_name, speech_rate, self.AUDIO_FORMAT)
 
-    def _create_audio_directory(self, session_id: int, message_id: int) -> None:
-        """创建存储音频文件的目录"""
-        dir_path = os.path.join(
-            self.voichai_storage_path,
-            self.speaker_config["audio_dir"],
-            str(session_id),
-            str(message_id),
-        )
-        os.makedirs(dir_path, exist_ok=True)
+    def forget_audio(
+        self, sentences: List[Dict], voice_name: str, speech_rate: float
+    ) -> None:
+        """从缓存中删除这些句子在当前音色和语速下的音频，下次播放时重新合成"""
+        for sentence in sentences:
+            text = sentence.get("text", "")
+            if text:
+                self.audio_cache.remove(
+                    self._audio_cache_key(text, voice_name, speech_rate)
+                )
 
     def remove_audio_directory(self, session_id: int, message_id: int) -> None:
-        """删除存储音频文件的目录"""
+        """删除旧版按消息存储的音频目录（新音频保存在共享缓存中）"""
         dir_path = os.path.join(
             self.voichai_storage_path,
             self.speaker_config["audio_dir"],
@@ -101,6 +123,9 @@ class Speaker(metaclass=SingletonMeta):
             subscription=self.azure_config["key"], region=self.azure_config["region"]
         )
         speech_config.speech_synthesis_voice_name = voice_name
+        speech_config.set_speech_synthesis_output_format(
+            speechsdk.SpeechSynthesisOutputFormat.Riff16Khz16BitMonoPcm
+        )
         audio_config = speechsdk.audio.AudioOutputConfig(filename=output_file)
         return speechsdk.SpeechSynthesizer(
             speech_config=speech_config, audio_config=audio_config
@@ -112,10 +137,10 @@ class Speaker(metaclass=SingletonMeta):
         text: str,
         voice_name: str,
         speech_rate: float = 1.0,
-    ) -> None:
+    ) -> speechsdk.SpeechSynthesisResult:
         """执行语音合成，支持语速调整"""
         if speech_rate == 1.0:
-            synthesizer.speak_text(text)
+            return synthesizer.speak_text(text)
         else:
             ssml = f"""<speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis" xml:lang="en-US">
                     <voice name="{voice_name}">
@@ -125,7 +150,7 @@ class Speaker(metaclass=SingletonMeta):
                     </voice>
                 </speak>"""
             logger.info(f"SSML: {ssml}")
-            synthesizer.speak_ssml(ssml)
+            return synthesizer.speak_ssml(ssml)
 
     def _generate_audio_file(
         self,
@@ -135,17 +160,61 @@ class Speaker(metaclass=SingletonMeta):
         text: str,
         voice_name: str,
         speech_rate: float,
-    ) -> mixer.Sound:
-        """生成音频文件并返回Pygame Sound对象"""
-        audio_path = self._get_audio_path(session_id, message_id, sentence_id)
-
-        if not os.path.isfile(audio_path):
-            self._create_audio_directory(session_id, message_id)
-            synthesizer = self._create_speech_synthesizer(voice_name, audio_path)
-            self._synthesize_speech(synthesizer, text, voice_name, speech_rate)
+        stop_event: Optional[threading.Event] = None,
+    ) -> Optional[mixer.Sound]:
+        """获取句子的音频（缓存未命中时调用Azure合成），stop_event 已触发时返回 None"""
+        key = self._audio_cache_key(text, voice_name, speech_rate)
+        # 持有缓存项直到音频读入内存，避免其他线程放入新文件时把它淘汰
+        with self.audio_cache.hold(key):
+            return self._load_audio_file(key, text, voice_name, speech_rate, stop_event)
+
+    def _load_audio_file(
+        self,
+        key: str,
+        text: str,
+        voice_name: str,
+        speech_rate: float,
+        stop_event: Optional[threading.Event],
+    ) -> Optional[mixer.Sound]:
+        audio_path = self.audio_cache.lookup(key)
+
+        if audio_path is None:
+            # 先写入临时文件，合成完整后再放入缓存，被中断的合成不会留下残缺的音频
+            part_path = self.audio_cache.temp_path(key)
+            synthesizer = self._create_speech_synthesizer(voice_name, part_path)
+            with self._synthesizers_lock:
+                self._active_synthesizers.add(synthesizer)
+            # 登记之后再检查一次，避免错过登记前发出的停止信号
+            if stop_event is not None and stop_event.is_set():
+                with self._synthesizers_lock:
+                    self._active_synthesizers.discard(synthesizer)
+                return None
+            try:
+                result = self._synthesize_speech(
+                    synthesizer, text, voice_name, speech_rate
+                )
+            finally:
+                with self._synthesizers_lock:
+                    self._active_synthesizers.discard(synthesizer)
+                del synthesizer
+            # 合成期间收到停止信号时丢弃结果，被中止的合成可能只写了一部分
+            if stop_event is not None and stop_event.is_set():
+                Speaker._remove_file(part_path)
+                return None
+            if result.reason != speechsdk.ResultReason.SynthesizingAudioCompleted:
+                Speaker._remove_file(part_path)
+                raise RuntimeError(f"语音合成未完成: {result.reason}")
+            audio_path = self.audio_cache.commit(key, part_path)
 
         return mixer.Sound(audio_path)
 
+    @staticmethod
+    def _remove_file(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
     def pregenerate_audio_files(
         self,
         generate_id: int,
@@ -155,29 +224,69 @@ class Speaker(metaclass=SingletonMeta):
         voice_name: str,
         speech_rate: float,
     ) -> None:
-        """预生成一系列音频文件"""
+        """预生成一系列音频文件
+
+        最多 synthesis_concurrency 个句子并行合成，结果严格按句子顺序放入播放队列。
+        """
+        # 先发出停止信号，让进行中的一批尽快退出，而不是等它合成完所有句子
+        stop_event = self._begin_generation(generate_id)
+        with self._generation_batch_lock:
+            if stop_event.is_set():
+                # 等待期间已被更新的一批取代
+                return
+            pending = iter(
+                (sentence.get("sentenceId", -1), sentence.get("text", ""))
+                for sentence in sentences
+            )
+            in_flight: Deque[Tuple[int, Future]] = deque()
+
+            def submit_next() -> None:
+                for sentence_id, text in pending:
+                    if sentence_id == -1 or not text:
+                        continue
+                    future = self._synthesis_executor.submit(
+                        self._generate_audio_file,
+                        session_id,
+                        message_id,
+                        sentence_id,
+                        text,
+                        voice_name,
+                        speech_rate,
+                        stop_event,
+                    )
+                    in_flight.append((sentence_id, future))
+                    return
+
+            for _ in range(self.synthesis_concurrency):
+                submit_next()
+            while in_flight:
+                sentence_id, future = in_flight.popleft()
+                try:
+                    sound = future.result()
+                    with self._audio_generation_lock:
+                        # 被新的一批取代后不再放入播放队列
+                        if sound is not None and not stop_event.is_set():
+                            self.audio_queue.append((sentence_id, sound))
+                except Exception as e:
+                    if not stop_event.is_set():
+                        logger.error(f"生成音频文件失败: {e}")
+                if stop_event.is_set():
+                    for _, future in in_flight:
+                        future.cancel()
+                    break
+                submit_next()
+
+    def _begin_generation(self, generate_id: int) -> threading.Event:
+        """开始新的一批音频生成：中止上一批（含进行中的合成），返回本批的停止信号"""
         with self._audio_generation_lock:
+            self._stop_event.set()
+            stop_event = threading.Event()
+            self._stop_event = stop_event
             self._generate_id = generate_id
             self.audio_queue.clear()
-            for sentence in sentences:
-                sentence_id = sentence.get("sentenceId", -1)
-                text = sentence.get("text", "")
-                if sentence_id != -1 and text:
-                    try:
-                        sound = self._generate_audio_file(
-                            session_id,
-                            message_id,
-                            sentence_id,
-                            text,
-                            voice_name,
-                            speech_rate,
-                        )
-                        self.audio_queue.append((sentence_id, sound))
-                    except Exception as e:
-                        logger.error(f"生成音频文件失败: {e}")
-                    if self._is_stop_generating:
-                        self._is_stop_generating = False
-                        break
+        # 新的一批尚未提交合成，此时进行中的合成都属于被取代的批次
+        self._abort_synthesizers()
+        return stop_event
 
     def pause_playback(self) -> None:
         """暂停语音播放"""
@@ -204,8 +313,19 @@ class Speaker(metaclass=SingletonMeta):
         self.assistant_channel.stop()
 
     def stop_generating(self) -> None:
-        """停止生成音频"""
-        self._is_stop_generating = True
+        """停止生成音频：未开始的合成不再执行，进行中的合成请求立即中止"""
+        with self._audio_generation_lock:
+            self._stop_event.set()
+        self._abort_synthesizers()
+
+    def _abort_synthesizers(self) -> None:
+        with self._synthesizers_lock:
+            synthesizers = list(self._active_synthesizers)
+        for synthesizer in synthesizers:
+            try:
+                synthesizer.stop_speaking_async()
+            except Exception as e:
+                logger.warning(f"中止语音合成失败: {e}")
 
     async def play_sentence(
         self,
@@ -291,6 +411,80 @@ class Speaker(metaclass=SingletonMeta):
             await asyncio.sleep(0.1)
         await callback(-1)  # 播放结束
 
+    async def play_streaming(
+        self,
+        session_id: int,
+        message_id: int,
+        sentences: "asyncio.Queue[Optional[Tuple[int, str]]]",
+        callback: Callable[[int], Awaitable[None]],
+        voice_name: str,
+        speech_rate: float,
+    ) -> None:
+        """边生成边播放：句子陆续到达时立即并行合成，按顺序播放，队列中的 None 表示结束
+
+        首句合成完成即开始播放；其他播放请求或停止操作会中断本次播放。
+        """
+        self.stop_playback()
+        generate_id = int(time.time() * 1000)
+        stop_event = self._begin_generation(generate_id)
+        self._is_stopping = False
+        loop = asyncio.get_running_loop()
+        pending: Deque[Tuple[int, asyncio.Future]] = deque()
+        ended = False
+
+        def superseded() -> bool:
+            return (
+                stop_event.is_set()
+                or self._is_stopping
+                or self._generate_id != generate_id
+            )
+
+        while not superseded():
+            while not ended and not sentences.empty():
+                item = sentences.get_nowait()
+                if item is None:
+                    ended = True
+                    break
+                sentence_id, text = item
+                future = loop.run_in_executor(
+                    self._synthesis_executor,
+                    self._generate_audio_file,
+                    session_id,
+                    message_id,
+                    sentence_id,
+                    text,
+                    voice_name,
+                    speech_rate,
+                    stop_event,
+                )
+                pending.append((sentence_id, future))
+
+            if not self.assistant_channel.get_busy():
+                if pending and pending[0][1].done():
+                    sentence_id, future = pending.popleft()
+                    try:
+                        sound = future.result()
+                    except Exception as e:
+                        logger.error(f"生成音频文件失败: {e}")
+                        continue
+                    if sound is not None:
+                        self.assistant_channel.play(sound)
+                        await callback(sentence_id)
+                elif ended and not pending:
+                    break
+            await asyncio.sleep(0.05)
+
+        if superseded():
+            # 被停止或被其他播放取代：中止本次尚未完成的合成
+            with self._audio_generation_lock:
+                is_current = self._stop_event is stop_event
+                stop_event.set()
+            if is_current:
+                self._abort_synthesizers()
+        for _, future in pending:
+            future.cancel()
+        await callback(-1)  # 播放结束
+
     async def _play_audio(
         self,
         session_id: int,
@@ -315,7 +509,17 @@ class Speaker(metaclass=SingletonMeta):
             speech_rate,
         )
 
-        _, sound = self.audio_queue.popleft()
+        with self._audio_generation_lock:
+            ready = (
+                self._generate_id == generate_id
+                and self.audio_queue
+                and self.audio_queue[0][0] == sentence_id
+            )
+            _, sound = self.audio_queue.popleft() if ready else (None, None)
+        if sound is None:
+            # 合成失败、被停止或被新的播放取代
+            await callback(-1)
+            return
         # 播放音频
         self.assistant_channel.play(sound)
         await callback(int(sentence_id))
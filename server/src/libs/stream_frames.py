@@ -0,0 +1,167 @@
+import asyncio
+import time
+import zlib
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+class StreamFrameEncoder:
+    """把流式回复编码为 stream_response 帧的 data 部分
+
+    完整模式（默认，兼容旧客户端）：每帧携带完整的回复文本。
+    增量模式（客户端以 ?stream_delta=1 连接）：
+    - "delta" 帧只携带新增文本 delta 及其起始偏移 offset；
+    - 每隔 SNAPSHOT_INTERVAL 帧附带 length 和 checksum 作为快照校验，
+      客户端校验失败时发送 stream_resync，下一帧改为完整帧；
+    - 结束帧、错误帧以及文本不是追加关系时发送 "full" 完整帧。
+    offset 和 length 以 UTF-16 码元计（与前端字符串下标一致），
+    checksum 为 UTF-8 编码的 CRC32。
+    """
+
+    SNAPSHOT_INTERVAL = 32
+
+    # 正在推送的增量流，用于响应客户端的重新同步请求
+    _active: Dict[int, "StreamFrameEncoder"] = {}
+
+    def __init__(self, message_id: int, delta: bool = False):
+        self.message_id = message_id
+        self.delta = delta
+        self._text = ""
+        self._length = 0
+        self._checksum = 0
+        self._offset = 0
+        self._delta = ""
+        self._frames = 0
+        self._need_snapshot = False
+        if delta:
+            StreamFrameEncoder._active[message_id] = self
+
+    @staticmethod
+    def request_snapshot(message_id: int) -> None:
+        """客户端校验失败，下一帧发送完整内容"""
+        encoder = StreamFrameEncoder._active.get(message_id)
+        if encoder is not None:
+            encoder._need_snapshot = True
+
+    def encode(
+        self, response: str, is_streaming: bool, error: bool = False
+    ) -> Dict[str, Any]:
+        data: Dict[str, Any] = {
+            "message_id": self.message_id,
+            "is_streaming": is_streaming,
+            "is_chat_error": error,
+        }
+        if not self.delta:
+            data["response"] = response
+            return data
+
+        appended = response.startswith(self._text)
+        if appended:
+            self._advance(response[len(self._text) :])
+        else:
+            self._length = 0
+            self._checksum = 0
+            self._advance(response)
+        self._text = response
+        self._frames += 1
+
+        if error or not is_streaming:
+            StreamFrameEncoder._active.pop(self.message_id, None)
+        if error or not is_streaming or not appended or self._need_snapshot:
+            self._need_snapshot = False
+            data.update(
+                mode="full",
+                response=response,
+                length=self._length,
+                checksum=self._checksum,
+            )
+            return data
+
+        data.update(mode="delta", offset=self._offset, delta=self._delta)
+        if self._frames % self.SNAPSHOT_INTERVAL == 0:
+            data.update(length=self._length, checksum=self._checksum)
+        return data
+
+    def _advance(self, delta: str) -> None:
+        self._offset = self._length
+        self._delta = delta
+        encoded = delta.encode("utf-8", "surrogatepass")
+        self._length += len(delta.encode("utf-16-le", "surrogatepass")) // 2
+        self._checksum = zlib.crc32(encoded, self._checksum)
+
+
+class StreamCoalescer:
+    """按时间或字数合并流式输出，减少推送的WebSocket帧数
+
+    新增内容累计达到 max_chars 个字符，或距上次推送超过 interval 秒时推送一次
+    （以先到者为准）；没有新内容到达时由定时器补发，结束时立即推送。
+    """
+
+    DEFAULT_INTERVAL_MS = 30
+    DEFAULT_MAX_CHARS = 256
+
+    def __init__(
+        self,
+        send: Callable[[str, bool], Awaitable[Any]],
+        interval: float = DEFAULT_INTERVAL_MS / 1000,
+        max_chars: int = DEFAULT_MAX_CHARS,
+    ):
+        self._send = send
+        self.interval = interval
+        self.max_chars = max_chars
+        self._text: Callable[[], str] = str
+        self._pending = 0
+        # 第一段内容立即推送，不增加首字延迟
+        self._last_flush = float("-inf")
+        self._timer: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def from_config(
+        send: Callable[[str, bool], Awaitable[Any]], config: Dict[str, Any]
+    ) -> "StreamCoalescer":
+        """根据会话AI配置创建，未配置时使用默认策略"""
+        return StreamCoalescer(
+            send,
+            config.get(
+                "stream_flush_interval_ms", StreamCoalescer.DEFAULT_INTERVAL_MS
+            )
+            / 1000,
+            config.get("stream_flush_chars", StreamCoalescer.DEFAULT_MAX_CHARS),
+        )
+
+    async def push(self, text: Callable[[], str], added: int) -> None:
+        """记录新增的 added 个字符，text 在推送时才调用以获取当前完整文本"""
+        self._text = text
+        self._pending += added
+        if self._pending <= 0:
+            return
+        elapsed = time.monotonic() - self._last_flush
+        if self._pending >= self.max_chars or elapsed >= self.interval:
+            await self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(
+                self._flush_later(self.interval - elapsed)
+            )
+
+    async def close(self, text: str) -> None:
+        """流结束，取消定时器并立即推送最终内容"""
+        self.cancel()
+        self._pending = 0
+        await self._send(text, False)
+
+    async def _flush_later(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self._timer = None
+        if self._pending > 0:
+            await self._flush()
+
+    async def _flush(self) -> None:
+        self.cancel()
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        await self._send(self._text(), True)
+
+    def cancel(self) -> None:
+        """取消尚未触发的定时推送"""
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+        self._timer = None
@@ -0,0 +1,105 @@
+import asyncio
+import gzip
+import json
+import os
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from libs.config import UtilsBase
+from libs.log_config import logger
+
+
+class StreamTrace:
+    """一次上游流的录制：按到达顺序保存文本分块及其间隔，用于离线回放
+
+    文件格式为 gzip 压缩的 JSON Lines：
+        第一行    头部 {"version", "provider", "model", "with_system_prompt", ...}
+        中间各行  [距上一分块的毫秒数, "分块文本"]，第一个间隔即首字延迟
+        最后一行  {"result": 解析结果}，回放时用于回归比对
+    """
+
+    VERSION = 1
+
+    def __init__(self, header: Dict[str, Any]):
+        self.header = {"version": self.VERSION, **header}
+        self.chunks: List[Tuple[float, str]] = []
+        self.result: Optional[Dict[str, Any]] = None
+        self._last = time.monotonic()
+
+    def record(self, content: str) -> None:
+        now = time.monotonic()
+        self.chunks.append((round((now - self._last) * 1000, 1), content))
+        self._last = now
+
+    def save(self, path: str) -> None:
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            f.write(json.dumps(self.header, ensure_ascii=False) + "\n")
+            for chunk in self.chunks:
+                f.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+            f.write(json.dumps({"result": self.result}, ensure_ascii=False) + "\n")
+
+    @staticmethod
+    def load(path: str) -> "StreamTrace":
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        header = lines[0]
+        if header.get("version") != StreamTrace.VERSION:
+            raise ValueError(f"不支持的录制文件版本: {header.get('version')}")
+        trace = StreamTrace(header)
+        for line in lines[1:]:
+            if isinstance(line, list):
+                trace.chunks.append((line[0], line[1]))
+            elif "result" in line:
+                trace.result = line["result"]
+        return trace
+
+    async def replay(self, speed: float = 1.0) -> AsyncIterator[str]:
+        """按录制时的间隔产出分块，speed 为倍速，0 表示不等待（最快速度）"""
+        for delay_ms, content in self.chunks:
+            if speed > 0 and delay_ms > 0:
+                await asyncio.sleep(delay_ms / 1000 / speed)
+            yield content
+
+
+class StreamTraceRecorder:
+    """按配置 ai_assistant.stream_trace 录制上游流，默认关闭
+
+    录制文件保存在 STREAM_TRACES_PATH，超过 max_files 个时删除最旧的文件。
+    """
+
+    STREAM_TRACES_PATH = UtilsBase.DATA_PATH + "/stream-traces"
+    DEFAULT_MAX_FILES = 2000
+
+    @staticmethod
+    def _settings() -> Dict[str, Any]:
+        return UtilsBase.AI_CONFIG.get("stream_trace", {})
+
+    @staticmethod
+    def start(with_system_prompt: bool) -> Optional[StreamTrace]:
+        """未开启录制时返回 None"""
+        if not StreamTraceRecorder._settings().get("enabled"):
+            return None
+        return StreamTrace(
+            {"with_system_prompt": with_system_prompt, "created_at": time.time()}
+        )
+
+    @staticmethod
+    def save(trace: StreamTrace, session_id: int, message_id: int) -> None:
+        """写入录制文件并清理旧文件（阻塞，需在线程池中调用）"""
+        directory = StreamTraceRecorder.STREAM_TRACES_PATH
+        try:
+            UtilsBase.createDirIfnotExists(directory)
+            created = int(trace.header["created_at"] * 1000)
+            trace.save(f"{directory}/{created}-{session_id}-{message_id}.jsonl.gz")
+            StreamTraceRecorder._prune(directory)
+        except Exception as e:
+            logger.warning(f"保存流录制失败: {e}")
+
+    @staticmethod
+    def _prune(directory: str) -> None:
+        max_files = StreamTraceRecorder._settings().get(
+            "max_files", StreamTraceRecorder.DEFAULT_MAX_FILES
+        )
+        # 文件名以毫秒时间戳开头，按名称排序即按时间排序
+        names = sorted(name for name in os.listdir(directory) if name.endswith(".gz"))
+        for name in names[: max(0, len(names) - max_files)]:
+            os.remove(os.path.join(directory, name))
@@ -0,0 +1,168 @@
+import asyncio
+import re
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from libs.log_config import logger
+from libs.speaker import Speaker
+
+
+class SentenceSplitter:
+    """把流式到达的 Markdown 回复增量切分为适合朗读的句子
+
+    - 在中英文句末标点、换行处断句，英文句点需后跟空白才断句（避免切开小数）；
+    - 跳过代码块，去掉 Markdown 标记、链接地址和列表序号；
+    - 没有可朗读文字的片段（纯标点、序号）直接丢弃。
+    """
+
+    _BOUNDARY = re.compile(r"[。！？!?；;…]+[”’」』）)\"']*|\.(?=\s)|\n")
+    _LINK = re.compile(r"!?\[([^\]]*)\]\([^)]*\)")
+    _LIST_MARKER = re.compile(r"^\s*(?:[-+*]|\d+[.)])\s+")
+    _MARKUP = re.compile(r"[*_`#>|~]")
+    _SPEAKABLE = re.compile(
+        r"[A-Za-z\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]"
+    )
+
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._in_code = False
+
+    def feed(self, text: str) -> List[str]:
+        """传入目前为止的完整文本，返回新完成的句子"""
+        if not text.startswith(self._text):
+            # 文本不是追加关系（极少见），已朗读的部分不再重复
+            self._pos = min(self._pos, len(text))
+        self._text = text
+        return self._split(final=False)
+
+    def flush(self) -> List[str]:
+        """文本结束，返回剩余的句子"""
+        return self._split(final=True)
+
+    def _split(self, final: bool) -> List[str]:
+        sentences: List[str] = []
+        while True:
+            match = self._BOUNDARY.search(self._text, self._pos)
+            if match is None:
+                break
+            self._emit(self._text[self._pos : match.end()], sentences)
+            self._pos = match.end()
+        if final:
+            self._emit(self._text[self._pos :], sentences)
+            self._pos = len(self._text)
+        return sentences
+
+    def _emit(self, segment: str, sentences: List[str]) -> None:
+        if "```" in segment:
+            # 代码块的起止行本身不朗读
+            if segment.count("```") % 2:
+                self._in_code = not self._in_code
+            return
+        if self._in_code:
+            return
+        text = self._LINK.sub(r"\1", segment)
+        text = self._MARKUP.sub("", self._LIST_MARKER.sub("", text)).strip()
+        if self._SPEAKABLE.search(text):
+            sentences.append(text)
+
+
+class StreamingSpeech:
+    """一条回复的边生成边朗读：切分出的句子立即送入 Speaker 合成，首句就绪即开始播放"""
+
+    # 正在朗读的任务，保持引用避免被垃圾回收
+    _tasks: Set[asyncio.Task] = set()
+    # 各会话当前的边生成边朗读，停止回复时一并取消
+    _active: Dict[int, "StreamingSpeech"] = {}
+
+    def __init__(
+        self,
+        speaker: Speaker,
+        session_id: int,
+        message_id: int,
+        voice_name: str,
+        speech_rate: float,
+        callback: Callable[[int, str], Awaitable[None]],
+    ):
+        self.speaker = speaker
+        self.session_id = session_id
+        self.message_id = message_id
+        self.voice_name = voice_name
+        self.speech_rate = speech_rate
+        self._callback = callback
+        self._splitter = SentenceSplitter()
+        self._queue: "asyncio.Queue[Optional[Tuple[int, str]]]" = asyncio.Queue()
+        self._sentences: List[str] = []
+        self._task: Optional[asyncio.Task] = None
+        self._ended = False
+        StreamingSpeech._active[session_id] = self
+
+    @staticmethod
+    def cancel_session(session_id: int, message_id: Optional[int] = None) -> None:
+        """停止回复时取消会话的边生成边朗读，指定message_id时只取消该消息"""
+        speech = StreamingSpeech._active.get(session_id)
+        if speech is not None and message_id in (None, speech.message_id):
+            speech.cancel()
+
+    def feed(self, text: str, is_final: bool) -> None:
+        """传入目前为止的回复文本，is_final 表示回复结束"""
+        if self._ended:
+            return
+        for sentence in self._splitter.feed(text):
+            self._put(sentence)
+        if is_final:
+            self.finish()
+
+    def finish(self) -> None:
+        """回复结束（或出错），朗读完已有句子后停止"""
+        if self._ended:
+            return
+        for sentence in self._splitter.flush():
+            self._put(sentence)
+        self._ended = True
+        if self._task is not None:
+            self._queue.put_nowait(None)
+        else:
+            self._release()
+
+    def cancel(self) -> None:
+        """回复被停止：不再朗读剩余文本，停止正在进行的播放和合成"""
+        self._ended = True
+        if self._task is not None and not self._task.done():
+            self.speaker.stop_playback()
+            self.speaker.stop_generating()
+        self._release()
+
+    def _release(self) -> None:
+        if StreamingSpeech._active.get(self.session_id) is self:
+            del StreamingSpeech._active[self.session_id]
+
+    def _put(self, sentence: str) -> None:
+        index = len(self._sentences)
+        self._sentences.append(sentence)
+        self._queue.put_nowait((index, sentence))
+        if self._task is None:
+            # 第一句到达时才开始，打断正在进行的其他播放
+            self._task = asyncio.create_task(self._play())
+            StreamingSpeech._tasks.add(self._task)
+            self._task.add_done_callback(StreamingSpeech._tasks.discard)
+
+    async def _play(self) -> None:
+        try:
+            await self.speaker.play_streaming(
+                self.session_id,
+                self.message_id,
+                self._queue,
+                self._on_playing,
+                self.voice_name,
+                self.speech_rate,
+            )
+        except Exception as e:
+            logger.error(f"边生成边朗读失败: {e}", exc_info=True)
+        finally:
+            self._release()
+
+    async def _on_playing(self, index: int) -> None:
+        text = self._sentences[index] if index >= 0 else ""
+        try:
+            await self._callback(index, text)
+        except Exception as e:
+            logger.warning(f"发送朗读进度失败: {e}")
@@ -0,0 +1,116 @@
+import math
+import re
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import Callable, List, Optional, Tuple
+from libs.log_config import logger
+
+try:
+    import tiktoken
+except ImportError:  # 可选依赖，未安装时使用离线估算
+    tiktoken = None
+
+
+class Tokenizer(ABC):
+    """按模型家族统计文本的token数
+
+    name 会随token数一起存入数据库，换用不同的分词方式后缓存的token数自动失效。
+    """
+
+    name = "base"
+
+    @abstractmethod
+    def count(self, text: str) -> int:
+        """统计文本的token数"""
+
+
+class HeuristicTokenizer(Tokenizer):
+    """离线估算：中日韩字符按家族系数计，英文单词、数字、标点分别计数
+
+    对中文的估算远比 len(text) // 4 准确，且宁可略微高估，避免超出模型上下文窗口。
+    """
+
+    _PATTERN = re.compile(
+        r"(?P<cjk>[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+)"
+        r"|(?P<word>[A-Za-z]+)"
+        r"|(?P<digit>[0-9]+)"
+        r"|(?P<other>[^\sA-Za-z0-9])"
+    )
+
+    def __init__(self, family: str, cjk_ratio: float):
+        self.name = f"{family}:heuristic"
+        self.cjk_ratio = cjk_ratio
+
+    def count(self, text: str) -> int:
+        cjk = 0
+        tokens = 0
+        for match in self._PATTERN.finditer(text):
+            kind = match.lastgroup
+            length = match.end() - match.start()
+            if kind == "cjk":
+                cjk += length
+            elif kind == "word":
+                tokens += (length + 5) // 6
+            elif kind == "digit":
+                tokens += (length + 2) // 3
+            else:
+                tokens += 1
+        return tokens + math.ceil(cjk * self.cjk_ratio)
+
+
+class TiktokenTokenizer(Tokenizer):
+    """使用 tiktoken 精确计数（OpenAI 模型）"""
+
+    def __init__(self, encoding: "tiktoken.Encoding"):
+        self.name = f"tiktoken:{encoding.name}"
+        self.encoding = encoding
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+def _openai_tokenizer(model: str) -> Tokenizer:
+    if tiktoken is not None:
+        try:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding("o200k_base")
+            return TiktokenTokenizer(encoding)
+        except Exception as e:
+            # 编码文件需要首次下载，离线时回退到估算
+            logger.warning(f"加载 tiktoken 编码失败，使用估算: {e}")
+    return HeuristicTokenizer("openai", 1.0)
+
+
+# 模型名前缀 -> 分词器工厂，按顺序匹配；可通过 register_tokenizer 扩展
+_TOKENIZER_FACTORIES: List[Tuple[Tuple[str, ...], Callable[[str], Tokenizer]]] = [
+    (("gpt-", "chatgpt", "o1", "o3", "o4"), _openai_tokenizer),
+    (("doubao",), lambda model: HeuristicTokenizer("doubao", 0.7)),
+    (("qwen",), lambda model: HeuristicTokenizer("qwen", 0.7)),
+    (("deepseek",), lambda model: HeuristicTokenizer("deepseek", 0.65)),
+    (("glm", "chatglm"), lambda model: HeuristicTokenizer("glm", 0.75)),
+]
+
+
+def _default_tokenizer(model: str) -> Tokenizer:
+    # 未知模型按每个中日韩字符一个token估算，偏保守
+    return HeuristicTokenizer("default", 1.0)
+
+
+def register_tokenizer(
+    prefixes: Tuple[str, ...], factory: Callable[[str], Tokenizer]
+) -> None:
+    """注册模型家族的分词器，优先于内置规则"""
+    _TOKENIZER_FACTORIES.insert(0, (prefixes, factory))
+    get_tokenizer.cache_clear()
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(model: Optional[str]) -> Tokenizer:
+    """根据模型名获取对应家族的分词器"""
+    name = (model or "").lower()
+    for prefixes, factory in _TOKENIZER_FACTORIES:
+        if name.startswith(prefixes):
+            return factory(name)
+    return _default_tokenizer(name)
@@ -5,6 +5,7 @@ import json
 import os
 import time
 import asyncio
+from typing import Optional
 
 from fastapi import (
     FastAPI,
@@ -28,6 +29,11 @@ from libs.common import Utils
 from libs.websocket_client import WsClient
 from libs.session_manager import SessionManager
 from libs.message_handler import MessageHandler
+from libs.openai_client_pool import OpenAIClientPool
+from libs.generation_registry import GenerationRegistry
+from libs.chat_scheduler import ChatScheduler
+from libs.session_jobs import SessionJobQueue
+from libs.provider_router import ProviderRouter
 
 # 配置应用
 app = FastAPI(title="AI Chat Server", description="WebSocket-based AI chat server")
@@ -48,6 +54,12 @@ Utils.iwin_ws_client = WsClient(
 )
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    # 关闭复用的OpenAI客户端长连接
+    await OpenAIClientPool.close_all()
+
+
 @app.get("/api/connectiwin")
 async def connectiwin():
     if Utils.iwin_ws_client.is_connected():
@@ -101,7 +113,7 @@ async def upload_avatar(
         file_url = Utils.Avatar.get_ai_avatar_url(session_id, file.filename)
 
         # 删除旧文件
-        old_avatar_url = Utils.api.get_session_ai_avatar_url(session_id)
+        old_avatar_url = await Utils.async_api.get_session_ai_avatar_url(session_id)
         Utils.Avatar.delete_session_ai_avatar(old_avatar_url)
 
         # 保存文件
@@ -165,6 +177,46 @@ async def upload_user_avatar(file: UploadFile = File(...)):
         )
 
 
+@app.get("/api/sessions")
+async def list_sessions(offset: int = 0, limit: int = -1):
+    """分页获取会话列表摘要"""
+    sessions = await Utils.async_api.get_session_summaries(offset, limit)
+    total = await Utils.async_api.get_session_count()
+    return {"sessions": sessions, "offset": offset, "total": total}
+
+
+@app.get("/api/search")
+async def search_messages(q: str, limit: int = 20, session_id: Optional[int] = None):
+    """全文检索历史消息"""
+    results = await Utils.async_api.search_messages(q, limit, session_id)
+    return {"query": q, "results": results}
+
+
+@app.get("/api/metrics/generations")
+async def generation_metrics(hours: float = 24):
+    """按服务商和模型汇总最近若干小时的生成指标（首字延迟、耗时等分位数）"""
+    groups = await Utils.async_api.get_generation_metrics_summary(hours * 3600)
+    return {"window_hours": hours, "groups": groups}
+
+
+@app.get("/api/generations")
+async def list_generations():
+    """查看进行中的AI回复生成"""
+    return {"generations": GenerationRegistry.list_generations()}
+
+
+@app.get("/api/scheduler")
+async def scheduler_stats():
+    """查看聊天调度器的队列深度和并发情况，以及后台任务的执行情况"""
+    return {**ChatScheduler.stats(), "jobs": SessionJobQueue.stats()}
+
+
+@app.get("/api/providers")
+async def provider_stats():
+    """查看各服务商的首字延迟、错误率和吞吐量"""
+    return {"providers": ProviderRouter.stats()}
+
+
 class CommandRequest(BaseModel):
     type: str
     data: dict
@@ -252,7 +304,7 @@ async def session_websocket_endpoint(websocket: WebSocket, clientID: int):
     await websocket.accept()
 
     session_id = int(clientID)
-    if not Utils.api.is_session_exist(session_id):
+    if not await Utils.async_api.is_session_exist(session_id):
         msg = {"type": "error_session_not_exist", "data": {"session_id": session_id}}
         await websocket.send_text(json.dumps(msg))
         await websocket.close()
@@ -266,7 +318,9 @@ async def session_websocket_endpoint(websocket: WebSocket, clientID: int):
     Utils.session_websockets[session_id][connection_id] = websocket
 
     try:
-        await SessionManager.send_session_messages(websocket, session_id)
+        # 客户端可通过 ?page_size=N 只加载最近N条消息，其余通过 load_more 分页获取
+        page_size = int(websocket.query_params.get("page_size", -1))
+        await SessionManager.send_session_messages(websocket, session_id, page_size)
         await SessionManager.send_session_config(
             session_id, websocket, is_right_after_connection=True
         )
@@ -286,6 +340,7 @@ async def session_websocket_endpoint(websocket: WebSocket, clientID: int):
             and connection_id in Utils.session_websockets[session_id]
         ):
             del Utils.session_websockets[session_id][connection_id]
+        SessionManager.forget_connection(websocket)
 
 
 # 启动应用
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# _*_coding:utf-8_*_
+"""对比流式响应解析的耗时：旧的状态机（每个分块重新扫描并 literal_eval）与 JsonStreamParser
+
+用法: python3 server/tools/bench_stream_parser.py [--sizes 1000 4000 16000] [--chunk 4]
+"""
+
+import argparse
+import ast
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from libs.json_stream_parser import JsonStreamParser  # noqa: E402
+
+
+def legacy_parse(chunks):
+    """旧实现的解析逻辑（去掉回调和打印），用作对比基线"""
+
+    def unescape_string(s):
+        try:
+            return ast.literal_eval(f'"{s}"')
+        except Exception:
+            return None
+
+    def parse_stream_content(content, escaped, response_ended):
+        clean_content = ""
+        for char in content:
+            if escaped:
+                clean_content += char
+                escaped = False
+            elif char == "\\":
+                clean_content += char
+                escaped = True
+            elif char == '"':
+                response_ended = True
+                break
+            else:
+                clean_content += char
+        return clean_content, escaped, response_ended
+
+    full_response = ""
+    response_content = ""
+    in_response_field = False
+    response_ended = False
+    escaped = False
+    text = ""
+    for content in chunks:
+        full_response += content
+        if response_ended:
+            text = unescape_string(response_content) or text
+            continue
+        if not in_response_field:
+            response_pos = full_response.find('"response":')
+            if response_pos != -1:
+                response_pos = full_response.find(
+                    '"', response_pos + len('"response":')
+                )
+                if response_pos != -1:
+                    in_response_field = True
+                    content = full_response[response_pos + 1 :]
+                    clean_content, escaped, response_ended = parse_stream_content(
+                        content, escaped, response_ended
+                    )
+                    if clean_content:
+                        response_content += clean_content
+                        text = unescape_string(response_content) or text
+        else:
+            clean_content, escaped, response_ended = parse_stream_content(
+                content, escaped, response_ended
+            )
+            if clean_content:
+                response_content += clean_content
+                text = unescape_string(response_content) or text
+    try:
+        json.loads(full_response)
+    except json.JSONDecodeError:
+        pass
+    return text
+
+
+def incremental_parse(chunks):
+    parser = JsonStreamParser("response")
+    for content in chunks:
+        if parser.feed(content):
+            parser.text
+    parser.fields
+    return parser.text
+
+
+def make_chunks(size, chunk_size):
+    sentence = '这是一段测试回复，包含"引号"、换行\n和表情😀。Some English text too. '
+    response = (sentence * (size // len(sentence) + 1))[:size]
+    payload = json.dumps(
+        {
+            "response": response,
+            "title": "测试标题",
+            "suggestions": ["问题1", "问题2", "问题3"],
+        },
+        ensure_ascii=False,
+    )
+    chunks = [payload[i : i + chunk_size] for i in range(0, len(payload), chunk_size)]
+    return response, chunks
+
+
+def bench(func, chunks, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(chunks)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 4000, 16000])
+    parser.add_argument("--chunk", type=int, default=4, help="每个分块的字符数")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'字符数':>8} {'分块数':>8} {'旧实现(ms)':>12} {'增量解析(ms)':>14} {'加速':>8}")
+    for size in args.sizes:
+        response, chunks = make_chunks(size, args.chunk)
+        assert incremental_parse(chunks) == response
+        legacy = bench(legacy_parse, chunks, args.repeat)
+        incremental = bench(incremental_parse, chunks, args.repeat)
+        print(
+            f"{size:>8} {len(chunks):>8} {legacy * 1000:>12.1f} "
+            f"{incremental * 1000:>14.1f} {legacy / incremental:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
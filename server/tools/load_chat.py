@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# _*_coding:utf-8_*_
+"""端到端的聊天压测：并发打开多个会话 WebSocket 发送 user_input，统计流式指标
+
+报告首字延迟（TTFT）、推送帧率、端到端延迟的 p50/p99，以及服务端进程的CPU占用。
+配合 mock_openai_server.py 可在一台 Linux 机器上离线运行：
+
+    python3 server/tools/mock_openai_server.py --port 8899 &
+    python3 server/src/voichai-server.py &
+    python3 server/tools/load_chat.py --sessions 20 --turns 5 \\
+        --base-url http://127.0.0.1:8899/v1 --server-pid $(pgrep -f voichai-server)
+
+每个会话通过 /ws/aichat/spa 新建，并把 AI 配置指向 --base-url（不指定时沿用默认配置）。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+from typing import Dict, List, Optional
+
+from websockets.asyncio.client import connect
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def process_cpu_seconds(pid: int) -> float:
+    """读取 /proc/<pid>/stat 中进程累计的用户态和内核态CPU时间"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+class TurnResult:
+    def __init__(self):
+        self.sent_at = time.monotonic()
+        self.first_frame_at: Optional[float] = None
+        self.done_at: Optional[float] = None
+        self.frames = 0
+        self.error = False
+
+
+async def create_session(host: str) -> int:
+    async with connect(f"ws://{host}/ws/aichat/spa") as ws:
+        await ws.send(json.dumps({"type": "create_session", "data": {}}))
+        async for raw in ws:
+            message = json.loads(raw)
+            if message["type"] == "parse_create_session":
+                return message["data"]["session_id"]
+    raise RuntimeError("创建会话失败")
+
+
+async def receive_turn(ws, result: TurnResult) -> None:
+    """接收一轮回复的推送帧，直到结束帧或错误帧"""
+    async for raw in ws:
+        message = json.loads(raw)
+        if message["type"] != "stream_response":
+            continue
+        data = message["data"]
+        now = time.monotonic()
+        if result.first_frame_at is None:
+            result.first_frame_at = now
+        result.frames += 1
+        if data.get("is_chat_error"):
+            # 错误帧的 is_streaming 为 True，之后不会再有结束帧
+            result.error = True
+            return
+        if not data["is_streaming"]:
+            result.done_at = now
+            return
+
+
+async def run_session(args: argparse.Namespace, results: List[TurnResult]) -> None:
+    session_id = await create_session(args.host)
+    query = "?stream_delta=1" if args.delta else ""
+    async with connect(f"ws://{args.host}/ws/aichat/{session_id}{query}") as ws:
+        # 等待连接后的会话配置，必要时改为指向压测用的服务商
+        async for raw in ws:
+            message = json.loads(raw)
+            if message["type"] == "session_ai_config":
+                config = message["data"]["ai_config"]
+                break
+        if args.base_url:
+            config.update(
+                base_url=args.base_url, api_key=args.api_key, model=args.model
+            )
+            update = {"type": "update_session_ai_config", "data": {"ai_config": config}}
+            await ws.send(json.dumps(update))
+
+        for turn in range(args.turns):
+            result = TurnResult()
+            user_input = {
+                "type": "user_input",
+                "data": {"user_message": f"压测消息 {session_id}-{turn}"},
+            }
+            await ws.send(json.dumps(user_input))
+            try:
+                await asyncio.wait_for(receive_turn(ws, result), args.turn_timeout)
+            except asyncio.TimeoutError:
+                # 丢失了结束帧，连接上可能还有本轮的残留帧，不再继续该会话
+                result.error = True
+                results.append(result)
+                return
+            results.append(result)
+            if args.think_ms:
+                await asyncio.sleep(args.think_ms / 1000)
+
+
+def report(results: List[TurnResult], elapsed: float, cpu: Optional[float]) -> None:
+    ok = [r for r in results if not r.error and r.done_at is not None]
+    ttft = [(r.first_frame_at - r.sent_at) * 1000 for r in ok if r.first_frame_at]
+    e2e = [(r.done_at - r.sent_at) * 1000 for r in ok]
+    frame_rates = [
+        r.frames / (r.done_at - r.first_frame_at)
+        for r in ok
+        if r.first_frame_at and r.done_at > r.first_frame_at
+    ]
+    print(f"turns: {len(results)}  ok: {len(ok)}  errors: {len(results) - len(ok)}")
+    print(f"elapsed: {elapsed:.2f}s  throughput: {len(ok) / elapsed:.2f} turns/s")
+    for name, values in (("ttft_ms", ttft), ("e2e_ms", e2e)):
+        print(
+            f"{name}: p50={percentile(values, 50):.1f} "
+            f"p99={percentile(values, 99):.1f} max={max(values, default=0):.1f}"
+        )
+    if frame_rates:
+        print(f"frames/s per stream: mean={statistics.mean(frame_rates):.1f}")
+        print(f"frames per turn: mean={statistics.mean(r.frames for r in ok):.1f}")
+    if cpu is not None:
+        print(f"server cpu: {cpu:.2f}s ({cpu / elapsed * 100:.1f}% of one core)")
+
+
+async def main(args: argparse.Namespace) -> None:
+    results: List[TurnResult] = []
+    cpu_start = process_cpu_seconds(args.server_pid) if args.server_pid else None
+    started = time.monotonic()
+    outcomes = await asyncio.gather(
+        *(run_session(args, results) for _ in range(args.sessions)),
+        return_exceptions=True,
+    )
+    elapsed = time.monotonic() - started
+    failures: Dict[str, int] = {}
+    for outcome in outcomes:
+        if isinstance(outcome, Exception):
+            failures[repr(outcome)] = failures.get(repr(outcome), 0) + 1
+    for failure, count in failures.items():
+        print(f"session failed x{count}: {failure}")
+    cpu = None
+    if cpu_start is not None:
+        cpu = process_cpu_seconds(args.server_pid) - cpu_start
+    report(results, elapsed, cpu)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="localhost:4999")
+    parser.add_argument("--sessions", type=int, default=10, help="并发会话数")
+    parser.add_argument("--turns", type=int, default=3, help="每个会话的对话轮数")
+    parser.add_argument("--think-ms", type=float, default=0, help="两轮之间的间隔")
+    parser.add_argument(
+        "--turn-timeout", type=float, default=60, help="单轮等待结束帧的秒数"
+    )
+    parser.add_argument("--base-url", default=None, help="会话使用的服务商地址")
+    parser.add_argument("--api-key", default="mock")
+    parser.add_argument("--model", default="mock-model")
+    parser.add_argument("--delta", action="store_true", help="使用增量帧")
+    parser.add_argument("--server-pid", type=int, default=None)
+    asyncio.run(main(parser.parse_args()))
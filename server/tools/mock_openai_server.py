@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# _*_coding:utf-8_*_
+"""离线的 OpenAI 兼容接口桩，用于在没有真实服务商的情况下测量聊天链路
+
+支持 POST /v1/chat/completions（流式 SSE 与非流式），可配置：
+- 首字延迟及其分布（fixed / uniform / lognormal）
+- 输出速率（token/秒）和回复长度
+- 回复格式：json（按系统提示词要求的 response/title/suggestions 格式）、
+  text，或 auto（提示词中提到 json 时输出 json）
+- 错误注入：请求直接返回 500/429，或在流中途断开
+
+用法:
+    python3 server/tools/mock_openai_server.py --port 8899 --token-rate 50 \\
+        --first-token-ms 400 --latency-dist lognormal --error-rate 0.02
+然后把会话的 base_url 设置为 http://127.0.0.1:8899/v1（api_key 任意）。
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+
+WORDS = (
+    "你好 这是 一段 用于 压力 测试 的 模拟 回复 内容 ，"
+    " the quick brown fox jumps over the lazy dog ."
+).split()
+
+
+class MockConfig:
+    def __init__(self, args: argparse.Namespace):
+        self.token_rate = args.token_rate
+        self.tokens = args.tokens
+        self.first_token_ms = args.first_token_ms
+        self.latency_dist = args.latency_dist
+        self.mode = args.mode
+        self.error_rate = args.error_rate
+        self.drop_rate = args.drop_rate
+        self.seed = args.seed
+
+    def first_token_delay(self, rng: random.Random) -> float:
+        mean = self.first_token_ms / 1000
+        if self.latency_dist == "uniform":
+            return rng.uniform(0, 2 * mean)
+        if self.latency_dist == "lognormal":
+            # 均值为 mean、长尾的对数正态分布
+            sigma = 0.8
+            return rng.lognormvariate(math.log(mean) - sigma**2 / 2, sigma)
+        return mean
+
+
+def build_reply(request: dict, config: MockConfig, rng: random.Random) -> str:
+    """生成回复文本，json 模式下按聊天接口要求的格式输出"""
+    text = "".join(rng.choice(WORDS) for _ in range(config.tokens))
+    mode = config.mode
+    if mode == "auto":
+        prompt = " ".join(
+            str(message.get("content", "")) for message in request.get("messages", [])
+        )
+        mode = "json" if "json" in prompt.lower() else "text"
+    if mode == "text":
+        return text
+    return json.dumps(
+        {
+            "response": text,
+            "title": "模拟对话",
+            "suggestions": ["继续", "换个话题", "总结一下"],
+        },
+        ensure_ascii=False,
+    )
+
+
+def split_tokens(text: str, rng: random.Random):
+    """把回复切成 1~4 个字符的分块，近似服务商的 token 粒度"""
+    i = 0
+    while i < len(text):
+        size = rng.randint(1, 4)
+        yield text[i : i + size]
+        i += size
+
+
+def chunk_payload(completion_id: str, model: str, delta: dict, finish=None) -> bytes:
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+class MockServer:
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.requests = 0
+        self.errors = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # HTTP/1.1 长连接：循环处理同一连接上的请求
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                method, path, _ = lines[0].split(" ", 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                if method != "POST" or not path.endswith("/chat/completions"):
+                    await self.respond(writer, 404, {"error": {"message": "not found"}})
+                    continue
+                await self.completion(writer, json.loads(body or b"{}"))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer: asyncio.StreamWriter, status: int, payload: dict):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+
+    async def completion(self, writer: asyncio.StreamWriter, request: dict):
+        config = self.config
+        self.requests += 1
+        model = request.get("model", "mock")
+        if self.rng.random() < config.error_rate:
+            self.errors += 1
+            status = self.rng.choice([429, 500])
+            await self.respond(
+                writer, status, {"error": {"message": "injected", "code": status}}
+            )
+            return
+
+        reply = build_reply(request, config, self.rng)
+        await asyncio.sleep(config.first_token_delay(self.rng))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+        if not request.get("stream"):
+            await self.respond(
+                writer,
+                200,
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": reply},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                },
+            )
+            return
+
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\nTransfer-Encoding: chunked\r\n\r\n"
+        )
+
+        def send(data: bytes) -> None:
+            writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+        send(chunk_payload(completion_id, model, {"role": "assistant"}))
+        tokens = list(split_tokens(reply, self.rng))
+        drop_at = (
+            self.rng.randrange(len(tokens))
+            if tokens and self.rng.random() < config.drop_rate
+            else -1
+        )
+        interval = 1 / config.token_rate if config.token_rate > 0 else 0
+        started = time.monotonic()
+        for i, token in enumerate(tokens):
+            if i == drop_at:
+                # 模拟流中途断开
+                self.errors += 1
+                writer.transport.abort()
+                return
+            send(chunk_payload(completion_id, model, {"content": token}))
+            await writer.drain()
+            # 按绝对时间节拍发送，避免 sleep 误差累积
+            delay = started + (i + 1) * interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        send(chunk_payload(completion_id, model, {}, "stop"))
+        send(b"data: [DONE]\n\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+async def main(args: argparse.Namespace) -> None:
+    mock = MockServer(MockConfig(args))
+    server = await asyncio.start_server(mock.handle, args.host, args.port)
+    print(f"mock OpenAI server: http://{args.host}:{args.port}/v1")
+    async with server:
+        try:
+            await server.serve_forever()
+        finally:
+            print(f"requests={mock.requests} injected_errors={mock.errors}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8899)
+    parser.add_argument("--token-rate", type=float, default=50, help="token/秒")
+    parser.add_argument("--tokens", type=int, default=200, help="每次回复的词数")
+    parser.add_argument("--first-token-ms", type=float, default=300)
+    parser.add_argument(
+        "--latency-dist", choices=["fixed", "uniform", "lognormal"], default="fixed"
+    )
+    parser.add_argument("--mode", choices=["auto", "json", "text"], default="auto")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# _*_coding:utf-8_*_
+"""回放录制的上游流（ai_assistant.stream_trace 开启后生成），用于回归测试和解析吞吐量基准
+
+把录制的分块按原始间隔（或最快速度）送入 OpenAIChatAPI 的流式解析和推送合并流程，
+统计每条录制的推送帧数、解析耗时，并与录制时的解析结果比对。
+
+用法:
+    python3 server/tools/replay_streams.py <录制文件或目录>... [--speed 0] [--repeat 5]
+--speed 1 按录制时的节奏回放，0 为最快速度（默认）；存在结果不一致时退出码为 1。
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_PATH)
+# libs.config 从当前目录读取默认配置，命令行中的相对路径按原目录解析
+WORK_PATH = os.getcwd()
+os.chdir(SRC_PATH)
+
+from libs.chat_database import ChatDatabase  # noqa: E402
+from libs.openai_chat_api import OpenAIChatAPI  # noqa: E402
+from libs.stream_frames import StreamCoalescer  # noqa: E402
+from libs.stream_trace import StreamTrace  # noqa: E402
+
+
+def collect_paths(paths):
+    for path in paths:
+        path = os.path.join(WORK_PATH, path)
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(".jsonl.gz"):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+async def replay(api: OpenAIChatAPI, trace: StreamTrace, args: argparse.Namespace):
+    frames = 0
+
+    async def send(text: str, is_streaming: bool):
+        nonlocal frames
+        frames += 1
+
+    coalescer = StreamCoalescer(send, args.flush_ms / 1000, args.flush_chars)
+    contents = trace.replay(args.speed)
+    try:
+        if trace.header.get("with_system_prompt"):
+            result = await api._process_stream_response(contents, coalescer)
+        else:
+            result = await api._process_simple_stream(contents, coalescer)
+    finally:
+        coalescer.cancel()
+    return result, frames
+
+
+async def main(args: argparse.Namespace) -> int:
+    paths = list(collect_paths(args.paths))
+    if not paths:
+        print("没有找到录制文件")
+        return 1
+    mismatches = 0
+    total_chars = 0
+    total_seconds = 0.0
+    with tempfile.TemporaryDirectory() as tmp:
+        api = OpenAIChatAPI(ChatDatabase(os.path.join(tmp, "replay.db")))
+        for path in paths:
+            trace = StreamTrace.load(path)
+            chars = sum(len(content) for _, content in trace.chunks)
+            best = float("inf")
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                result, frames = await replay(api, trace, args)
+                best = min(best, time.perf_counter() - started)
+            matched = trace.result is None or result == trace.result
+            mismatches += not matched
+            total_chars += chars
+            total_seconds += best
+            print(
+                f"{os.path.basename(path)}: chunks={len(trace.chunks)} chars={chars} "
+                f"frames={frames} time={best * 1000:.2f}ms "
+                f"{'ok' if matched else 'MISMATCH'}"
+            )
+            if not matched and args.verbose:
+                print(f"  recorded: {trace.result}\n  replayed: {result}")
+    print(
+        f"traces: {len(paths)}  mismatches: {mismatches}  "
+        f"throughput: {total_chars / max(total_seconds, 1e-9):.0f} chars/s"
+    )
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+", help="录制文件（.jsonl.gz）或目录")
+    parser.add_argument("--speed", type=float, default=0, help="回放倍速，0为最快")
+    parser.add_argument("--repeat", type=int, default=1, help="重复次数，取最短耗时")
+    parser.add_argument("--flush-ms", type=float, default=30)
+    parser.add_argument("--flush-chars", type=int, default=256)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -1,5 +1,11 @@
 import { WebSocketService } from '@/common/websocket-client'
 
+// 打开会话时只加载最近的消息条数，更早的消息在滚动到顶部时分页加载
+export const MESSAGE_PAGE_SIZE = 50
+
+// 由服务端维护的会话配置项，提交配置时不携带，避免过期的快照覆盖服务端的新值
+const SERVER_MANAGED_CONFIG_KEYS = ['top', 'suggestions', 'last_active_time', 'ai_avatar_url']
+
 class ChatWebSocketService extends WebSocketService {
     constructor(url: string) {
         super(url)
@@ -53,6 +59,19 @@ class ChatWebSocketService extends WebSocketService {
         })
     }
 
+    // 增量流式回复校验失败，请求服务端发送完整内容
+    sendStreamResync(messageId: number) {
+        this._sendWithMessageId('stream_resync', messageId)
+    }
+
+    // 加载 seq 小于 before 的更早消息
+    sendLoadMore(before: number, limit: number = MESSAGE_PAGE_SIZE) {
+        this._send('load_more', {
+            before: before,
+            limit: limit,
+        })
+    }
+
     // 停止回应
     sendStopResponse() {
         this._send('stop_response')
@@ -96,7 +115,11 @@ class ChatWebSocketService extends WebSocketService {
     }
 
     sendUpdateSessionConfig(config: any) {
-        this._send('update_session_ai_config', { ai_config: config })
+        const editable = { ...config }
+        for (const key of SERVER_MANAGED_CONFIG_KEYS) {
+            delete editable[key]
+        }
+        this._send('update_session_ai_config', { ai_config: editable })
     }
 
     // 播放控制
@@ -136,7 +159,7 @@ class ChatWebSocketService extends WebSocketService {
 // 导出单例或工厂函数，根据项目需求选择
 let chatWebSocketInstance: ChatWebSocketService | null = null;
 export function useChatWebSocket(chatId: number) {
-    chatWebSocketInstance = new ChatWebSocketService("ws://localhost:4999/ws/aichat/" + chatId);
+    chatWebSocketInstance = new ChatWebSocketService("ws://localhost:4999/ws/aichat/" + chatId + "?stream_delta=1&page_size=" + MESSAGE_PAGE_SIZE);
     return chatWebSocketInstance;
 }
 export { ChatWebSocketService }
@@ -38,6 +38,7 @@ export interface AIConfig {
     language: string;
     tts_voice: string;
     auto_play: boolean;
+    auto_play_streaming: boolean;
     auto_gen_title: boolean;
     show_separated_sentences: boolean;
     speech_rate: number;
@@ -86,6 +87,7 @@ export interface AiApiConfig {
     language: string;
     tts_voice: string;
     auto_play: boolean;
+    auto_play_streaming: boolean;
     auto_gen_title: boolean;
     show_separated_sentences: boolean;
     speech_rate: number;
@@ -93,3 +93,23 @@ export const mapLanguageCode = (lang?: string): string => {
         default: return 'zh-CN'
     }
 }
+
+// 计算字符串UTF-8编码的CRC32，用于校验增量流式回复
+let crc32Table: Uint32Array | null = null
+export const crc32 = (text: string): number => {
+    if (!crc32Table) {
+        crc32Table = new Uint32Array(256)
+        for (let i = 0; i < 256; i++) {
+            let c = i
+            for (let k = 0; k < 8; k++) {
+                c = c & 1 ? 0xedb88320 ^ (c >>> 1) : c >>> 1
+            }
+            crc32Table[i] = c >>> 0
+        }
+    }
+    let crc = 0xffffffff
+    for (const byte of new TextEncoder().encode(text)) {
+        crc = crc32Table[(crc ^ byte) & 0xff] ^ (crc >>> 8)
+    }
+    return (crc ^ 0xffffffff) >>> 0
+}